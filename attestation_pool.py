@@ -0,0 +1,241 @@
+import heapq
+from typing import Dict, Iterator, List as PyList, Optional, Set, Tuple
+
+from fastspec import (
+    BeaconState, EpochsContext, Attestation, AttestationData, BLSSignature, Bitlist, CommitteeIndex, Root, Slot,
+    MAX_ATTESTATIONS, MAX_VALIDATORS_PER_COMMITTEE, MIN_ATTESTATION_INCLUSION_DELAY, SLOTS_PER_EPOCH,
+    bls, compute_epoch_at_slot, hash_tree_root,
+)
+
+# Pool of attestations for block production.
+#
+# Attestations are grouped by the root of their AttestationData. Aggregation bits are kept as python ints
+# (bit i = committee member i), so merging, subset checks and coverage counts are single int operations.
+# Attestations with disjoint bits are merged on insert, their signatures are only aggregated when
+# the attestation is selected for a block: BLS aggregation is expensive, most pooled attestations are never packed.
+#
+# select() picks up to MAX_ATTESTATIONS attestations that cover the most validators that the state has not seen
+# attest yet, greedily. Gains only go down as more is selected, so a candidate whose gain did not change since
+# it was last computed is the best choice: a lazy heap re-evaluates only the candidates that come out on top.
+
+AggregationBits = Bitlist[MAX_VALIDATORS_PER_COMMITTEE]
+
+CommitteeKey = Tuple[Slot, CommitteeIndex]
+
+
+def bits_to_int(bits: AggregationBits) -> Tuple[int, int]:
+    # The SSZ encoding of a bitlist is little-endian, with a delimiter bit right after the last bit.
+    value = int.from_bytes(bits.encode_bytes(), 'little')
+    length = value.bit_length() - 1
+    return value ^ (1 << length), length
+
+
+def int_to_bits(value: int, length: int) -> AggregationBits:
+    return AggregationBits.decode_bytes((value | (1 << length)).to_bytes(length // 8 + 1, 'little'))
+
+
+def _popcount(value: int) -> int:
+    return bin(value).count('1')
+
+
+# int.bit_count is python 3.10+
+popcount = getattr(int, 'bit_count', _popcount)
+
+
+class PooledAggregate(object):
+
+    __slots__ = 'bits', 'signatures', '_signature'
+
+    bits: int
+    signatures: PyList[BLSSignature]
+
+    def __init__(self, bits: int, signatures: PyList[BLSSignature]):
+        self.bits = bits
+        self.signatures = signatures
+        self._signature: Optional[BLSSignature] = None
+
+    def merge(self, other: "PooledAggregate"):
+        self.bits |= other.bits
+        self.signatures.extend(other.signatures)
+        self._signature = None
+
+    @property
+    def signature(self) -> BLSSignature:
+        if self._signature is None:
+            if len(self.signatures) == 1:
+                self._signature = self.signatures[0]
+            else:
+                self._signature = BLSSignature(bls.Aggregate(self.signatures))
+                self.signatures = [self._signature]
+        return self._signature
+
+
+class PoolEntry(object):
+    # All pooled attestations of one AttestationData
+
+    __slots__ = 'data', 'root', 'length', 'aggregates', 'target_epoch', 'source_epoch', 'source_root'
+
+    data: AttestationData
+    root: Root
+    length: int  # committee size, i.e. length of the aggregation bits
+    aggregates: PyList[PooledAggregate]
+    # Copied out of the data: reading fields of SSZ views is slow, select() checks them for every entry.
+    target_epoch: int
+    source_epoch: int
+    source_root: bytes
+
+    def __init__(self, data: AttestationData, root: Root, length: int):
+        self.data = data
+        self.root = root
+        self.length = length
+        self.aggregates = []
+        self.target_epoch = int(data.target.epoch)
+        source = data.source
+        self.source_epoch = int(source.epoch)
+        self.source_root = bytes(source.root)
+
+    def add(self, bits: int, signature: BLSSignature) -> bool:
+        # Returns False if the attestation adds nothing.
+        for agg in self.aggregates:
+            if bits & agg.bits == bits:
+                return False
+        new = PooledAggregate(bits, [signature])
+        # Drop what the new attestation covers, then merge it into the first disjoint aggregate.
+        self.aggregates = [agg for agg in self.aggregates if agg.bits & bits != agg.bits]
+        for agg in self.aggregates:
+            if agg.bits & bits == 0:
+                agg.merge(new)
+                return True
+        self.aggregates.append(new)
+        return True
+
+    def attestation(self, agg: PooledAggregate) -> Attestation:
+        return Attestation(aggregation_bits=int_to_bits(agg.bits, self.length), data=self.data,
+                           signature=agg.signature)
+
+
+class AttestationPool(object):
+    """
+    Attestations for block production, by data root and indexed by slot and committee:
+
+        pool.add(attestation)
+        pool.prune(state.slot)
+        block.body.attestations = pool.select(epochs_ctx, state)
+    """
+    entries: Dict[Root, PoolEntry]
+    by_slot: Dict[Slot, Dict[CommitteeIndex, Set[Root]]]
+    # Committee and bits of the pending attestations in states, by root: these do not change once in a state,
+    # and the roots are cached in the state tree. Decoding them again for every block would be slow.
+    included: Dict[Root, Tuple[CommitteeKey, int]]
+
+    def __init__(self):
+        self.entries = {}
+        self.by_slot = {}
+        self.included = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, attestation: Attestation, data_root: Optional[Root] = None) -> bool:
+        """Add a (valid) attestation. Returns False if the pool already covered its bits."""
+        data = attestation.data
+        if data_root is None:
+            data_root = hash_tree_root(data)
+        bits, length = bits_to_int(attestation.aggregation_bits)
+        entry = self.entries.get(data_root)
+        if entry is None:
+            entry = self.entries[data_root] = PoolEntry(data, data_root, length)
+            self.by_slot.setdefault(data.slot, {}).setdefault(data.index, set()).add(data_root)
+        elif entry.length != length:
+            raise ValueError(f"aggregation bits of length {length}, expected {entry.length}")
+        return entry.add(bits, attestation.signature)
+
+    def get(self, slot: Slot, index: CommitteeIndex) -> Iterator[PoolEntry]:
+        for root in self.by_slot.get(slot, {}).get(index, ()):
+            yield self.entries[root]
+
+    def prune(self, slot: Slot) -> int:
+        """Drop attestations that can no longer be included at ``slot`` or later. Returns the number of dropped entries."""
+        dropped = 0
+        for att_slot in [s for s in self.by_slot if s + SLOTS_PER_EPOCH < slot]:
+            for roots in self.by_slot.pop(att_slot).values():
+                for root in roots:
+                    del self.entries[root]
+                    dropped += 1
+        self.included = {root: v for root, v in self.included.items() if v[0][0] + SLOTS_PER_EPOCH >= slot}
+        return dropped
+
+    def _included_coverage(self, state: BeaconState) -> Dict[CommitteeKey, int]:
+        # Validators that the state already has attestations for, per committee
+        covered: Dict[CommitteeKey, int] = {}
+        included = self.included
+        for pending_attestations in (state.previous_epoch_attestations, state.current_epoch_attestations):
+            for pending in pending_attestations.readonly_iter():
+                root = pending.get_backing().merkle_root()
+                known = included.get(root)
+                if known is None:
+                    data = pending.data
+                    known = included[root] = ((Slot(data.slot), CommitteeIndex(data.index)),
+                                              bits_to_int(pending.aggregation_bits)[0])
+                key, bits = known
+                covered[key] = covered.get(key, 0) | bits
+        return covered
+
+    def candidates(self, epochs_ctx: EpochsContext, state: BeaconState) -> Iterator[Tuple[PoolEntry, CommitteeKey]]:
+        # Entries that pass the checks of process_attestation (except the signature) in a block at state.slot
+        slot = state.slot
+        current_epoch = epochs_ctx.current_shuffling.epoch
+        previous_epoch = epochs_ctx.previous_shuffling.epoch
+        current_source = state.current_justified_checkpoint
+        previous_source = state.previous_justified_checkpoint
+        sources = {
+            current_epoch: (int(current_source.epoch), bytes(current_source.root)),
+            previous_epoch: (int(previous_source.epoch), bytes(previous_source.root)),
+        }
+        for att_slot, committees in self.by_slot.items():
+            if not (att_slot + MIN_ATTESTATION_INCLUSION_DELAY <= slot <= att_slot + SLOTS_PER_EPOCH):
+                continue
+            epoch = compute_epoch_at_slot(att_slot)
+            if epoch not in sources:
+                continue
+            source_epoch, source_root = sources[epoch]
+            committee_count = epochs_ctx.get_committee_count_at_slot(att_slot)
+            for index, roots in committees.items():
+                if index >= committee_count:
+                    continue
+                committee_size = len(epochs_ctx.get_beacon_committee(att_slot, index))
+                for root in roots:
+                    entry = self.entries[root]
+                    if (entry.length != committee_size or entry.target_epoch != epoch
+                            or entry.source_epoch != source_epoch or entry.source_root != source_root):
+                        continue
+                    yield entry, (att_slot, index)
+
+    def select(self, epochs_ctx: EpochsContext, state: BeaconState,
+               max_count: int = MAX_ATTESTATIONS) -> PyList[Attestation]:
+        """Greedy max-coverage selection of attestations to include in a block at state.slot."""
+        covered = self._included_coverage(state)
+        heap = []
+        for entry, key in self.candidates(epochs_ctx, state):
+            seen = covered.get(key, 0)
+            for agg in entry.aggregates:
+                gain = popcount(agg.bits & ~seen)
+                if gain > 0:
+                    # The id breaks ties, the aggregates themselves are not comparable.
+                    heap.append((-gain, id(agg), key, entry, agg))
+        heapq.heapify(heap)
+
+        selected = []
+        while heap and len(selected) < max_count:
+            neg_gain, _, key, entry, agg = heapq.heappop(heap)
+            seen = covered.get(key, 0)
+            gain = popcount(agg.bits & ~seen)
+            if gain == 0:
+                continue
+            if gain < -neg_gain and heap and gain < -heap[0][0]:
+                # Stale gain, and something else may be better now: re-evaluate later.
+                heapq.heappush(heap, (-gain, id(agg), key, entry, agg))
+                continue
+            covered[key] = seen | agg.bits
+            selected.append(entry.attestation(agg))
+        return selected
@@ -0,0 +1,365 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import struct
+import subprocess
+import sys
+import time
+from hashlib import sha256
+from typing import Callable, Dict, List as PyList, Optional, Sequence, Tuple
+
+import fastspec
+from fastspec import (
+    BeaconState, EpochsContext, BeaconBlock, BeaconBlockBody, SignedBeaconBlock, Attestation, AttestationData,
+    PendingAttestation, Checkpoint, Validator, Gwei, Epoch, Slot, Root, Bitlist, List, Vector, Bytes32,
+    MAX_VALIDATORS_PER_COMMITTEE, VALIDATOR_REGISTRY_LIMIT, EPOCHS_PER_HISTORICAL_VECTOR, SLOTS_PER_HISTORICAL_ROOT,
+    SLOTS_PER_EPOCH, MAX_EFFECTIVE_BALANCE, FAR_FUTURE_EPOCH, MAX_ATTESTATIONS, MIN_ATTESTATION_INCLUSION_DELAY,
+    bls, compute_start_slot_at_epoch, get_block_root, get_block_root_at_slot, hash_tree_root,
+    process_slots, process_epoch, process_block, state_transition, unshuffle_list,
+)
+from parallel_epoch import ParallelEpochPreparer
+from snapshot import read_snapshot, write_snapshot
+
+DEFAULT_VALIDATOR_COUNTS = (16384, 100000, 500000)
+
+# The synthetic state sits at the last slot of this epoch, so the next slot runs process_epoch.
+BENCH_EPOCH = 4
+
+# Import time budgets (seconds) of the modules that pool workers import when they are spawned, e.g. the replay
+# decode workers. Importing fastspec must not pull in BLS (py_ecc) or the eth2spec phase0 spec: those take ~1s.
+IMPORT_BUDGETS = {
+    'fastspec': 0.15,
+    'snapshot': 0.2,
+    'replay': 0.25,
+    'block_store': 0.25,
+}
+
+# Fixed-size SSZ layout of a Validator: pubkey, withdrawal_credentials, effective_balance, slashed,
+# activation_eligibility_epoch, activation_epoch, exit_epoch, withdrawable_epoch.
+_VALIDATOR_SSZ = struct.Struct('<48s32sQ?QQQQ')
+
+
+def _fake_pubkey(i: int) -> bytes:
+    # Not a valid BLS pubkey: benchmarks run with BLS disabled.
+    return sha256(i.to_bytes(8, 'little')).digest() + i.to_bytes(16, 'little')
+
+
+def make_synthetic_state(validator_count: int, participation: float = 0.95, seed: int = 0) -> BeaconState:
+    """
+    Return a state of ``validator_count`` active validators at the last slot of ``BENCH_EPOCH``,
+    with ``participation`` of every committee attesting in the previous and current epoch.
+    """
+    rng = random.Random(seed)
+
+    # Build the big lists as SSZ bytes and decode them in one go, much faster than appending views.
+    registry = io.BytesIO()
+    for i in range(validator_count):
+        registry.write(_VALIDATOR_SSZ.pack(_fake_pubkey(i), b'\x00' * 32, MAX_EFFECTIVE_BALANCE, False,
+                                           0, 0, FAR_FUTURE_EPOCH, FAR_FUTURE_EPOCH))
+    validators = List[Validator, VALIDATOR_REGISTRY_LIMIT].decode_bytes(registry.getvalue())
+    balances = List[Gwei, VALIDATOR_REGISTRY_LIMIT].decode_bytes(
+        b''.join(int(MAX_EFFECTIVE_BALANCE + rng.randrange(10**9)).to_bytes(8, 'little')
+                 for _ in range(validator_count)))
+
+    slot = compute_start_slot_at_epoch(Epoch(BENCH_EPOCH + 1)) - 1
+    block_roots = [Root(rng.getrandbits(256).to_bytes(32, 'little')) for _ in range(slot)]
+    randao_mixes = [Bytes32(rng.getrandbits(256).to_bytes(32, 'little')) for _ in range(BENCH_EPOCH + 2)]
+
+    state = BeaconState(
+        genesis_time=1578009600,
+        slot=slot,
+        validators=validators,
+        balances=balances,
+        block_roots=Vector[Root, SLOTS_PER_HISTORICAL_ROOT](
+            *(block_roots + [Root()] * (SLOTS_PER_HISTORICAL_ROOT - len(block_roots)))),
+        randao_mixes=Vector[Bytes32, EPOCHS_PER_HISTORICAL_VECTOR](
+            *(randao_mixes + [Bytes32()] * (EPOCHS_PER_HISTORICAL_VECTOR - len(randao_mixes)))),
+    )
+    state.latest_block_header.slot = slot
+    justified_epoch = Epoch(BENCH_EPOCH - 2)
+    justified = Checkpoint(epoch=justified_epoch, root=get_block_root(state, justified_epoch))
+    state.previous_justified_checkpoint = justified
+    state.current_justified_checkpoint = justified
+    state.finalized_checkpoint = Checkpoint(epoch=justified_epoch - 1,
+                                            root=get_block_root(state, Epoch(justified_epoch - 1)))
+    state.justification_bits[1] = 1
+    state.justification_bits[2] = 1
+
+    epochs_ctx = EpochsContext()
+    epochs_ctx.load_state(state)
+
+    def make_pending(epoch: Epoch, end_slot: Slot) -> PyList[PendingAttestation]:
+        target = Checkpoint(epoch=epoch, root=get_block_root(state, epoch))
+        out = []
+        for att_slot in range(compute_start_slot_at_epoch(epoch), end_slot):
+            for index in range(epochs_ctx.get_committee_count_at_slot(att_slot)):
+                committee = epochs_ctx.get_beacon_committee(att_slot, index)
+                bits = [rng.random() < participation for _ in committee]
+                out.append(PendingAttestation(
+                    aggregation_bits=Bitlist[MAX_VALIDATORS_PER_COMMITTEE](*bits),
+                    data=AttestationData(slot=att_slot, index=index,
+                                         beacon_block_root=get_block_root_at_slot(state, att_slot),
+                                         source=justified, target=target),
+                    inclusion_delay=rng.randint(MIN_ATTESTATION_INCLUSION_DELAY, 4),
+                    proposer_index=rng.randrange(validator_count),
+                ))
+        return out
+
+    state.previous_epoch_attestations = make_pending(Epoch(BENCH_EPOCH - 1),
+                                                     compute_start_slot_at_epoch(Epoch(BENCH_EPOCH)))
+    state.current_epoch_attestations = make_pending(Epoch(BENCH_EPOCH), slot)
+    return state
+
+
+def load_or_make_state(validator_count: int, participation: float,
+                       cache_dir: Optional[str]) -> Tuple[BeaconState, EpochsContext]:
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, f"bench_state_{validator_count}_{int(participation * 100)}.snap")
+        if os.path.exists(path):
+            return read_snapshot(path)
+    state = make_synthetic_state(validator_count, participation)
+    epochs_ctx = EpochsContext()
+    epochs_ctx.load_state(state)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_snapshot(path, state, epochs_ctx)
+    return state, epochs_ctx
+
+
+def make_block(epochs_ctx: EpochsContext, state: BeaconState, slot: Slot) -> SignedBeaconBlock:
+    """
+    Return a block at ``slot`` on top of ``state``, packed with attestations of the slot before,
+    and with a correct state root. BLS is expected to be disabled: the block is not signed.
+    """
+    epochs_ctx = epochs_ctx.copy()
+    state = state.copy()
+    process_slots(epochs_ctx, state, slot)
+
+    att_slot = Slot(slot - MIN_ATTESTATION_INCLUSION_DELAY)
+    epoch = epochs_ctx.current_shuffling.epoch
+    source = state.current_justified_checkpoint if att_slot >= compute_start_slot_at_epoch(epoch) \
+        else state.previous_justified_checkpoint
+    target_epoch = Epoch(att_slot // SLOTS_PER_EPOCH)
+    target = Checkpoint(epoch=target_epoch, root=get_block_root(state, target_epoch))
+    attestations = []
+    for index in range(min(epochs_ctx.get_committee_count_at_slot(att_slot), MAX_ATTESTATIONS)):
+        committee = epochs_ctx.get_beacon_committee(att_slot, index)
+        attestations.append(Attestation(
+            aggregation_bits=Bitlist[MAX_VALIDATORS_PER_COMMITTEE](*([True] * len(committee))),
+            data=AttestationData(slot=att_slot, index=index,
+                                 beacon_block_root=get_block_root_at_slot(state, att_slot),
+                                 source=source, target=target),
+        ))
+
+    block = BeaconBlock(
+        slot=slot,
+        parent_root=hash_tree_root(state.latest_block_header),
+        body=BeaconBlockBody(eth1_data=state.eth1_data, attestations=attestations),
+    )
+    process_block(epochs_ctx, state, block)
+    block.state_root = hash_tree_root(state)
+    return SignedBeaconBlock(message=block)
+
+
+def _measure(fn: Callable[[], Callable[[], None]], repeat: int) -> PyList[float]:
+    # fn does the (untimed) setup of a run, and returns the function to time.
+    durations = []
+    for _ in range(repeat):
+        run = fn()
+        start = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - start)
+        # Drop the run before the next setup, nothing of it (e.g. shufflings) should carry over.
+        del run
+    return durations
+
+
+def bench_validator_count(validator_count: int, repeat: int, participation: float, empty_slots: int,
+                          only: Optional[Sequence[str]], cache_dir: Optional[str]) -> PyList[dict]:
+    setup_start = time.perf_counter()
+    state, epochs_ctx = load_or_make_state(validator_count, participation, cache_dir)
+    print(f"[{validator_count}] state ready in {time.perf_counter() - setup_start:.1f}s", file=sys.stderr)
+
+    def bench_unshuffle_list():
+        indices = list(range(validator_count))
+        seed = Bytes32(b'\x42' * 32)
+        return lambda: unshuffle_list(indices, seed)
+
+    # Shufflings are shared through the registry, across runs too: cleared for the cold timings,
+    # the warm timing is the load of a fork that shares its shufflings with a live EpochsContext.
+    def bench_load_state():
+        fastspec.shuffling_registry.clear()
+        ctx = EpochsContext()
+        return lambda: ctx.load_state(state)
+
+    def bench_load_state_warm():
+        fastspec.shuffling_registry.clear()
+        live = EpochsContext()
+        live.load_state(state)
+        ctx = EpochsContext()
+
+        def run():
+            ctx.load_state(state)
+            assert ctx.current_shuffling is live.current_shuffling
+        return run
+
+    def bench_rotate_epochs():
+        fastspec.shuffling_registry.clear()
+        ctx = epochs_ctx.copy()
+        return lambda: ctx.rotate_epochs(state)
+
+    # The per-validator pass of process_epoch, serial and spread over a process pool (see parallel_epoch.py).
+    def bench_prepare_serial():
+        return lambda: fastspec.prepare_epoch_process_state(epochs_ctx, state)
+
+    preparer = None
+
+    def bench_prepare_parallel():
+        nonlocal preparer
+        if preparer is None:
+            preparer = ParallelEpochPreparer(min_validators=0)
+            preparer.prepare(epochs_ctx, state)  # start the workers outside of the timings
+        return lambda: preparer.prepare(epochs_ctx, state)
+
+    def bench_process_epoch():
+        ctx, st = epochs_ctx.copy(), state.copy()
+        return lambda: process_epoch(ctx, st)
+
+    # Set up on first use: these run an epoch transition, skipped when only other benchmarks are selected.
+    post_ctx = post_state = signed_block = None
+
+    # Empty slots right after the epoch transition, without crossing the next epoch boundary.
+    def bench_process_slots():
+        nonlocal post_ctx, post_state
+        if post_state is None:
+            post_ctx, post_state = epochs_ctx.copy(), state.copy()
+            process_slots(post_ctx, post_state, Slot(state.slot + 1))
+        ctx, st = post_ctx.copy(), post_state.copy()
+        return lambda: process_slots(ctx, st, Slot(st.slot + empty_slots))
+
+    def bench_state_transition():
+        nonlocal signed_block
+        if signed_block is None:
+            signed_block = make_block(epochs_ctx, state, Slot(state.slot + 1))
+        ctx, st = epochs_ctx.copy(), state.copy()
+        block = signed_block
+        return lambda: state_transition(ctx, st, block)
+
+    benches: Dict[str, Callable[[], Callable[[], None]]] = {
+        'unshuffle_list': bench_unshuffle_list,
+        'epochs_ctx_load_state': bench_load_state,
+        'epochs_ctx_load_state_warm': bench_load_state_warm,
+        'rotate_epochs': bench_rotate_epochs,
+        'prepare_epoch_process_state': bench_prepare_serial,
+        'prepare_epoch_process_state_parallel': bench_prepare_parallel,
+        'process_epoch': bench_process_epoch,
+        'process_slots_empty': bench_process_slots,
+        'state_transition': bench_state_transition,
+    }
+    results = []
+    for name, fn in benches.items():
+        if only and name not in only:
+            continue
+        durations = _measure(fn, repeat)
+        result = {
+            'name': name,
+            'validators': validator_count,
+            'runs': len(durations),
+            'min_s': min(durations),
+            'mean_s': statistics.mean(durations),
+            'median_s': statistics.median(durations),
+            'max_s': max(durations),
+        }
+        if name == 'process_slots_empty':
+            result['slots'] = empty_slots
+        print(f"[{validator_count}] {name}: min {result['min_s']:.4f}s median {result['median_s']:.4f}s",
+              file=sys.stderr)
+        results.append(result)
+    if preparer is not None:
+        preparer.close()
+    return results
+
+
+def measure_import_time(module: str) -> float:
+    # In a fresh interpreter, like a spawned worker: nothing is imported yet.
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(out.decode().strip().splitlines()[-1])
+
+
+def bench_imports(repeat: int, only: Optional[Sequence[str]]) -> PyList[dict]:
+    results = []
+    for module, budget in IMPORT_BUDGETS.items():
+        name = 'import_' + module
+        if only and name not in only:
+            continue
+        durations = [measure_import_time(module) for _ in range(repeat)]
+        result = {
+            'name': name,
+            'runs': len(durations),
+            'min_s': min(durations),
+            'mean_s': statistics.mean(durations),
+            'median_s': statistics.median(durations),
+            'max_s': max(durations),
+            'budget_s': budget,
+            'over_budget': statistics.median(durations) > budget,
+        }
+        print(f"{name}: median {result['median_s']:.4f}s (budget {budget:.2f}s)"
+              + (" OVER BUDGET" if result['over_budget'] else ""), file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark fastspec hot paths on synthetic states.")
+    parser.add_argument('--validators', type=int, nargs='*', default=list(DEFAULT_VALIDATOR_COUNTS),
+                        help="validator counts of the synthetic states (none: only the import benchmarks)")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--participation', type=float, default=0.95,
+                        help="fraction of each committee that attested, in the synthetic states")
+    parser.add_argument('--empty-slots', type=int, default=8, help="slots per process_slots_empty run")
+    parser.add_argument('--only', nargs='*', help="names of the benchmarks to run (default: all)")
+    parser.add_argument('--cache-dir', default=None, help="keep generated states as snapshots in this directory")
+    parser.add_argument('--out', default=None, help="JSON output file (default: stdout)")
+    args = parser.parse_args(args)
+
+    # Synthetic keys are not valid BLS keys, and signatures are not what is measured here.
+    bls.bls_active = False
+
+    results = bench_imports(args.repeat, args.only)
+    for validator_count in args.validators:
+        results.extend(bench_validator_count(validator_count, args.repeat, args.participation, args.empty_slots,
+                                             args.only, args.cache_dir))
+
+    output = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'participation': args.participation,
+        'results': results,
+    }
+    if args.out is None:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        with io.open(args.out, 'w') as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
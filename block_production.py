@@ -0,0 +1,125 @@
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from fastspec import (
+    BeaconState, EpochsContext, BeaconBlock, BeaconBlockBody, Root, Slot, ValidatorIndex,
+    hash_tree_root, process_slots, process_block,
+)
+
+# Block production without a full state transition in the proposal path.
+#
+# Filling in the state root of a new block takes a transition of the head state to the proposal slot,
+# and a hash_tree_root of the post-state. Most of that does not depend on the block: the (possibly epoch-crossing)
+# process_slots, and the hashing of everything the block does not touch. So a slot is prepared ahead of time:
+# the head state is advanced to the proposal slot and hashed, which caches the roots in its tree.
+# Producing the block then only copies that state (cheap, the tree is immutable and shared), applies
+# the block operations, and re-hashes the changed paths of the tree.
+
+DEFAULT_MAX_PREPARED = 4
+
+
+class PreparedSlot(object):
+    slot: Slot
+    parent_root: Root  # root of the head block the state is on
+    proposer_index: ValidatorIndex
+    state: BeaconState  # advanced to slot, with a cached tree hash
+    epochs_ctx: EpochsContext
+    prepare_time: float  # seconds spent preparing
+
+    def __init__(self, slot: Slot, parent_root: Root, proposer_index: ValidatorIndex,
+                 state: BeaconState, epochs_ctx: EpochsContext, prepare_time: float):
+        self.slot = slot
+        self.parent_root = parent_root
+        self.proposer_index = proposer_index
+        self.state = state
+        self.epochs_ctx = epochs_ctx
+        self.prepare_time = prepare_time
+
+
+def prepare_slot(epochs_ctx: EpochsContext, state: BeaconState, slot: Slot) -> PreparedSlot:
+    """Advance a copy of the head ``state`` to ``slot``, and hash it. ``state`` and ``epochs_ctx`` are not modified."""
+    start = time.perf_counter()
+    epochs_ctx = epochs_ctx.copy()
+    state = state.copy()
+    process_slots(epochs_ctx, state, slot)
+    # The latest header has its state root filled in by process_slot, so this is the root of the head block.
+    parent_root = hash_tree_root(state.latest_block_header)
+    hash_tree_root(state)
+    return PreparedSlot(slot, parent_root, epochs_ctx.get_beacon_proposer(slot), state, epochs_ctx,
+                        time.perf_counter() - start)
+
+
+def produce_block(prepared: PreparedSlot, body: BeaconBlockBody,
+                  verify_signatures: bool = True) -> Tuple[BeaconBlock, BeaconState, EpochsContext]:
+    """
+    Build the block of the prepared slot with ``body``, and return it with its state root filled in,
+    along with the post-state and context. The prepared state and context are not modified,
+    they can produce other blocks.
+
+    With verify_signatures=False, the randao reveal and the signatures of the operations are not checked,
+    for operations that were verified before (e.g. on gossip). Deposit signatures are still checked.
+    """
+    state = prepared.state.copy()
+    # Copied also when the block does not change it: the caller may advance the returned context.
+    epochs_ctx = prepared.epochs_ctx.copy()
+    block = BeaconBlock(slot=prepared.slot, parent_root=prepared.parent_root, body=body)
+    process_block(epochs_ctx, state, block, verify_signatures)
+    block.state_root = hash_tree_root(state)
+    return block, state, epochs_ctx
+
+
+class BlockProducer(object):
+    """
+    Keeps the last few prepared slots, by head block root and slot:
+
+        producer.prepare(epochs_ctx, head_state, slot)  # ahead of time, e.g. during the previous slot
+        ...
+        block, post_state, post_ctx = producer.produce(head_root, slot, body)
+        signed_block = SignedBeaconBlock(message=block, signature=sign(block))
+    """
+    max_prepared: int
+    hits: int
+    misses: int
+
+    def __init__(self, max_prepared: int = DEFAULT_MAX_PREPARED):
+        self.max_prepared = max_prepared
+        self._prepared: "OrderedDict[Tuple[Root, Slot], PreparedSlot]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def prepare(self, epochs_ctx: EpochsContext, state: BeaconState, slot: Slot) -> PreparedSlot:
+        prepared = prepare_slot(epochs_ctx, state, slot)
+        key = (prepared.parent_root, prepared.slot)
+        self._prepared[key] = prepared
+        self._prepared.move_to_end(key)
+        while len(self._prepared) > self.max_prepared:
+            self._prepared.popitem(last=False)
+        return prepared
+
+    def get(self, parent_root: Root, slot: Slot) -> Optional[PreparedSlot]:
+        return self._prepared.get((bytes(parent_root), Slot(slot)))
+
+    def produce(self, parent_root: Root, slot: Slot, body: BeaconBlockBody, verify_signatures: bool = True,
+                epochs_ctx: Optional[EpochsContext] = None, state: Optional[BeaconState] = None
+                ) -> Tuple[BeaconBlock, BeaconState, EpochsContext]:
+        """
+        Produce the block of ``slot`` on ``parent_root``. If the slot was not prepared,
+        it is prepared now from the head ``state`` and ``epochs_ctx``, if given, which is slow.
+        """
+        prepared = self.get(parent_root, slot)
+        if prepared is None:
+            self.misses += 1
+            if state is None or epochs_ctx is None:
+                raise KeyError(f"slot {slot} on {bytes(parent_root).hex()} was not prepared")
+            prepared = self.prepare(epochs_ctx, state, slot)
+            if prepared.parent_root != parent_root:
+                raise ValueError(f"state is on {prepared.parent_root.hex()}, not on {bytes(parent_root).hex()}")
+        else:
+            self.hits += 1
+        return produce_block(prepared, body, verify_signatures)
+
+    def prune(self, min_slot: Slot):
+        # Prepared slots before min_slot can no longer be proposed.
+        for key in [key for key in self._prepared if key[1] < min_slot]:
+            del self._prepared[key]
@@ -0,0 +1,328 @@
+import argparse
+import io
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterable, List as PyList, Optional, Sequence, Tuple
+
+from fastspec import SignedBeaconBlock, Root, Slot
+from reqresp_codec import RESULT_SUCCESS, compress_frames, encode_uvarint
+from replay import iter_block_files
+
+# Append-only store of SSZ encoded SignedBeaconBlocks, for serving blocks_by_range and blocks_by_root
+# straight from disk: blocks are stored in their wire encoding, so a response never decodes or re-encodes them.
+#
+# Files in the store directory:
+#
+#   blocks.dat: records, appended back to back: ssz bytes | snappy frames of the ssz bytes (optional)
+#   blocks.idx: header (magic | version u32 | reserved u32), then one fixed-size row per record:
+#               slot u64 | block root (32) | offset u64 | ssz length u32 | frames length u32
+#
+# Records are written before their index row, so a crash leaves at most an unindexed tail of blocks.dat,
+# which is truncated again on the next open. Blocks are normally appended in slot order,
+# so the blocks of a range request are one contiguous region of blocks.dat.
+
+INDEX_MAGIC = b'FSBLKIDX'
+INDEX_VERSION = 1
+
+DATA_FILE = 'blocks.dat'
+INDEX_FILE = 'blocks.idx'
+
+# Max. blocks of a single blocks_by_range or blocks_by_root request, as per the phase0 networking spec.
+MAX_REQUEST_BLOCKS = 1024
+
+_INDEX_HEADER = struct.Struct('<8sII')
+_ROOT_SIZE = 32
+_INDEX_ROW = struct.Struct('<Q32sQII')
+
+# Offset of the parent root in an SSZ SignedBeaconBlock:
+# message offset u32 | signature (96) | message: slot u64 | parent_root (32) | ...
+_PARENT_ROOT_OFFSET = 4 + 96 + 8
+
+
+class BlockStoreError(Exception):
+    pass
+
+
+def request_roots(ssz_bytes: bytes) -> PyList[bytes]:
+    """
+    Return the roots of an SSZ encoded BlocksByRoot request. The encoding is just the concatenated roots,
+    slicing them is a lot cheaper than decoding the request into a list view of up to 1024 Bytes32 views.
+    """
+    if len(ssz_bytes) % _ROOT_SIZE != 0:
+        raise ValueError(f"invalid BlocksByRoot request length {len(ssz_bytes)}")
+    if len(ssz_bytes) > MAX_REQUEST_BLOCKS * _ROOT_SIZE:
+        raise ValueError(f"BlocksByRoot request of {len(ssz_bytes) // _ROOT_SIZE} roots exceeds {MAX_REQUEST_BLOCKS}")
+    return [ssz_bytes[i:i + _ROOT_SIZE] for i in range(0, len(ssz_bytes), _ROOT_SIZE)]
+
+
+class BlockEntry(object):
+
+    __slots__ = 'slot', 'root', 'offset', 'length', 'frames_length'
+
+    slot: Slot
+    root: Root
+    offset: int  # offset of the ssz bytes in the data file, the frames directly follow them
+    length: int
+    frames_length: int  # 0 if the block was stored without pre-compressed frames
+
+    def __init__(self, slot: Slot, root: Root, offset: int, length: int, frames_length: int):
+        self.slot = slot
+        self.root = root
+        self.offset = offset
+        self.length = length
+        self.frames_length = frames_length
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.length + self.frames_length
+
+    def __repr__(self):
+        return f"BlockEntry(slot={self.slot}, root={self.root.hex()}, offset={self.offset}, length={self.length})"
+
+
+class BlockStore(object):
+    """
+    Slot- and root-indexed block store. Reads are served from a read-only mmap of the data file:
+
+        with BlockStore('blocks') as store:
+            for entry in store.range(start_slot, count, step):
+                send(store.block_bytes(entry))
+
+    The returned memoryviews stay valid while they are referenced, also after later appends re-map the file.
+    """
+    directory: str
+    store_frames: bool  # off by default: Rumor compresses responses itself, only response_chunk uses frames
+    by_slot: Dict[Slot, BlockEntry]
+    by_root: Dict[Root, BlockEntry]
+
+    def __init__(self, directory: str, store_frames: bool = False, sync: bool = False):
+        self.directory = directory
+        self.store_frames = store_frames
+        self.sync = sync
+        self.by_slot = {}
+        self.by_root = {}
+        os.makedirs(directory, exist_ok=True)
+        self._data = io.open(os.path.join(directory, DATA_FILE), 'a+b')
+        try:
+            self._index = io.open(os.path.join(directory, INDEX_FILE), 'a+b')
+        except Exception:
+            self._data.close()
+            raise
+        self._mmap: Optional[mmap.mmap] = None
+        self._mapped = 0
+        try:
+            self._load_index()
+        except Exception:
+            self.close()
+            raise
+
+    def _load_index(self):
+        self._index.seek(0)
+        raw = self._index.read()
+        if not raw:
+            self._index.write(_INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, 0))
+            self._index.flush()
+            raw = b''
+        else:
+            if len(raw) < _INDEX_HEADER.size:
+                raise BlockStoreError("block index too small")
+            magic, version, _ = _INDEX_HEADER.unpack_from(raw, 0)
+            if magic != INDEX_MAGIC:
+                raise BlockStoreError(f"not a block index, bad magic: {magic!r}")
+            if version != INDEX_VERSION:
+                raise BlockStoreError(f"unsupported block index version {version}, expected {INDEX_VERSION}")
+            raw = raw[_INDEX_HEADER.size:]
+
+        data_size = self._data.seek(0, io.SEEK_END)
+        valid_rows = 0
+        data_end = 0
+        for slot, root, offset, length, frames_length in _INDEX_ROW.iter_unpack(
+                raw[:len(raw) - len(raw) % _INDEX_ROW.size]):
+            entry = BlockEntry(Slot(slot), Root(root), offset, length, frames_length)
+            if entry.end > data_size:
+                break  # torn write: the row made it to disk, the record did not
+            self._add(entry)
+            valid_rows += 1
+            data_end = max(data_end, entry.end)
+
+        # Drop a partial or dangling index tail, and unindexed data, left by an interrupted append.
+        index_size = _INDEX_HEADER.size + valid_rows * _INDEX_ROW.size
+        if index_size != _INDEX_HEADER.size + len(raw):
+            self._index.truncate(index_size)
+        if data_end != data_size:
+            self._data.truncate(data_end)
+
+    def _add(self, entry: BlockEntry):
+        # A later block of the same slot (e.g. after a re-org) replaces the earlier one in the slot index,
+        # the earlier one can still be found by root.
+        self.by_slot[entry.slot] = entry
+        self.by_root[entry.root] = entry
+
+    def __len__(self) -> int:
+        return len(self.by_root)
+
+    def __contains__(self, root: Root) -> bool:
+        return root in self.by_root
+
+    def append(self, signed_block: SignedBeaconBlock) -> BlockEntry:
+        return self._append(signed_block.encode_bytes(), signed_block.message.slot,
+                            signed_block.message.hash_tree_root())
+
+    def append_bytes(self, ssz_bytes: bytes) -> BlockEntry:
+        signed_block = SignedBeaconBlock.decode_bytes(ssz_bytes)
+        return self._append(ssz_bytes, signed_block.message.slot, signed_block.message.hash_tree_root())
+
+    def _append(self, ssz_bytes: bytes, slot: Slot, root: Root) -> BlockEntry:
+        existing = self.by_root.get(root)
+        if existing is not None:
+            return existing
+        frames = compress_frames(ssz_bytes) if self.store_frames else b''
+        offset = self._data.seek(0, io.SEEK_END)
+        self._data.write(ssz_bytes)
+        self._data.write(frames)
+        self._data.flush()
+        if self.sync:
+            os.fsync(self._data.fileno())
+        entry = BlockEntry(Slot(slot), Root(root), offset, len(ssz_bytes), len(frames))
+        self._index.write(_INDEX_ROW.pack(entry.slot, entry.root, entry.offset, entry.length, entry.frames_length))
+        self._index.flush()
+        if self.sync:
+            os.fsync(self._index.fileno())
+        self._add(entry)
+        return entry
+
+    def get_slot(self, slot: Slot) -> Optional[BlockEntry]:
+        return self.by_slot.get(slot)
+
+    def get_root(self, root: Root) -> Optional[BlockEntry]:
+        return self.by_root.get(root)
+
+    def range(self, start_slot: Slot, count: int, step: int = 1) -> PyList[BlockEntry]:
+        """
+        Return the entries of a blocks_by_range request, in slot order. Empty slots are skipped.
+        The mapped region of the range is prefetched, so streaming it is a sequential read.
+        """
+        if step < 1:
+            raise ValueError(f"invalid step {step}")
+        count = min(count, MAX_REQUEST_BLOCKS)
+        by_slot = self.by_slot
+        entries = [by_slot[slot] for slot in range(start_slot, start_slot + count * step, step) if slot in by_slot]
+        if entries:
+            self._prefetch(min(e.offset for e in entries), max(e.end for e in entries))
+        return entries
+
+    def lookup_roots(self, roots: Iterable[bytes]) -> PyList[BlockEntry]:
+        """
+        Return the entries of a blocks_by_root request in request order, skipping unknown roots.
+        Roots can be plain bytes, e.g. from request_roots. The records are prefetched in file order.
+        """
+        get = self.by_root.get
+        entries = [entry for entry in map(get, roots) if entry is not None]
+        if entries:
+            self._prefetch_entries(entries)
+        return entries
+
+    def _view(self, end: int) -> memoryview:
+        if end > self._mapped:
+            # Appends grew the file. Views of the previous map keep it alive until they are released.
+            self._mmap = mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped = len(self._mmap)
+            if end > self._mapped:
+                raise BlockStoreError(f"record end {end} beyond data file size {self._mapped}")
+        return memoryview(self._mmap)
+
+    def _prefetch(self, start: int, end: int):
+        self._view(end).release()
+        if hasattr(self._mmap, 'madvise'):
+            page_start = start - start % mmap.PAGESIZE
+            self._mmap.madvise(mmap.MADV_WILLNEED, page_start, end - page_start)
+
+    def _prefetch_entries(self, entries: Sequence[BlockEntry]):
+        # Spans of records that are close together are merged, so the kernel can read them in a few sequential runs.
+        spans = sorted((e.offset, e.end) for e in entries)
+        start, end = spans[0]
+        for span_start, span_end in spans[1:]:
+            if span_start - end > mmap.PAGESIZE:
+                self._prefetch(start, end)
+                start = span_start
+            end = max(end, span_end)
+        self._prefetch(start, end)
+
+    def block_bytes(self, entry: BlockEntry) -> memoryview:
+        # SSZ bytes of the SignedBeaconBlock, a view into the mmap.
+        return self._view(entry.end)[entry.offset:entry.offset + entry.length]
+
+    def block_frames(self, entry: BlockEntry) -> memoryview:
+        # Snappy frames of the ssz bytes, as sent on the wire after the ssz_snappy length prefix.
+        if not entry.frames_length:
+            raise BlockStoreError(f"block {entry.root.hex()} was stored without frames")
+        start = entry.offset + entry.length
+        return self._view(entry.end)[start:start + entry.frames_length]
+
+    def response_chunk(self, entry: BlockEntry, compression: bool = True) -> bytes:
+        # Complete success response chunk of the block, see reqresp_codec.encode_response_chunk.
+        prefix = bytes((RESULT_SUCCESS,)) + encode_uvarint(entry.length)
+        if compression:
+            if entry.frames_length:
+                return prefix + self.block_frames(entry)
+            return prefix + compress_frames(self.block_bytes(entry))
+        return prefix + self.block_bytes(entry)
+
+    def parent_root(self, entry: BlockEntry) -> bytes:
+        # Read from the stored bytes, without decoding the block.
+        with self.block_bytes(entry) as view:
+            return bytes(view[_PARENT_ROOT_OFFSET:_PARENT_ROOT_OFFSET + _ROOT_SIZE])
+
+    def read_block(self, entry: BlockEntry) -> SignedBeaconBlock:
+        with self.block_bytes(entry) as view:
+            return SignedBeaconBlock.decode_bytes(bytes(view))
+
+    def slot_bounds(self) -> Tuple[Optional[Slot], Optional[Slot]]:
+        if not self.by_slot:
+            return None, None
+        return min(self.by_slot), max(self.by_slot)
+
+    def close(self):
+        # Outstanding views keep the map itself alive, it is unmapped once they are gone.
+        self._mmap = None
+        self._mapped = 0
+        self._index.close()
+        self._data.close()
+
+    def __enter__(self) -> "BlockStore":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Build or inspect a block store.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    import_cmd = sub.add_parser('import', help="append a directory of SignedBeaconBlock SSZ files")
+    import_cmd.add_argument('store', help="block store directory")
+    import_cmd.add_argument('blocks_dir', help="directory of block files, sorted by name")
+    import_cmd.add_argument('--frames', action='store_true',
+                            help="also store pre-compressed snappy frames, for the in-process codec")
+    info_cmd = sub.add_parser('info', help="print the slot range and size of a block store")
+    info_cmd.add_argument('store', help="block store directory")
+    args = parser.parse_args(args)
+
+    if args.command == 'import':
+        with BlockStore(args.store, store_frames=args.frames) as store:
+            before = len(store)
+            for path in iter_block_files(args.blocks_dir):
+                with io.open(path, 'rb') as f:
+                    store.append_bytes(f.read())
+            print(f"imported {len(store) - before} blocks, {len(store)} total")
+    else:
+        with BlockStore(args.store) as store:
+            first, last = store.slot_bounds()
+            data_size = os.path.getsize(os.path.join(args.store, DATA_FILE))
+            print(f"{len(store)} blocks, slots {first}..{last}, {data_size} bytes of data")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
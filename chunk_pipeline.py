@@ -0,0 +1,127 @@
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+import trio
+
+from fastspec import SignedBeaconBlock
+
+# Pipelined consumption of a Rumor response stream: reading chunks off the stream is decoupled from decoding
+# (and whatever validation the decode function does) by a bounded memory channel. Decoding runs in worker threads,
+# so the trio loop keeps reading the stream meanwhile. When the consumer or the decoders fall behind,
+# the channel fills up and the reader stops pulling chunks, i.e. backpressure on the stream,
+# instead of the socket being drained only between two blocks.
+#
+# Note: decoding holds the GIL, worker threads keep the event loop responsive, they do not add CPU parallelism.
+
+DEFAULT_BUFFER_SIZE = 32  # raw chunks read ahead of the decoders
+DEFAULT_WORKERS = 2
+
+
+class DecodedChunk(object):
+
+    __slots__ = 'index', 'value', 'error', 'size'
+
+    index: int
+    value: Any
+    error: Optional[Exception]
+    size: int  # bytes of chunk data
+
+    def __init__(self, index: int, value: Any, error: Optional[Exception], size: int):
+        self.index = index
+        self.value = value
+        self.error = error
+        self.size = size
+
+
+class PipelineStats(object):
+    received: int
+    decoded: int
+    failed: int
+    bytes: int
+    read_blocked: float  # seconds the reader waited on a full buffer
+    decode_time: float  # seconds spent in decode (including the thread hand-off), summed over the workers
+
+    def __init__(self):
+        self.received = 0
+        self.decoded = 0
+        self.failed = 0
+        self.bytes = 0
+        self.read_blocked = 0.0
+        self.decode_time = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+
+def decode_block_chunk(chunk: Dict[str, Any]) -> SignedBeaconBlock:
+    # Chunk entry of a raw Rumor blocks_by_range/blocks_by_root response.
+    result_code = chunk.get('result_code', 0)
+    if result_code != 0:
+        raise ValueError(f"error response {result_code}: {chunk.get('msg', chunk.get('data'))}")
+    return SignedBeaconBlock.decode_bytes(bytes.fromhex(chunk['data']))
+
+
+async def pipeline_chunks(chunks: AsyncIterator[Dict[str, Any]], send: trio.MemorySendChannel,
+                          decode: Callable[[Dict[str, Any]], Any] = decode_block_chunk,
+                          buffer_size: int = DEFAULT_BUFFER_SIZE, workers: int = DEFAULT_WORKERS,
+                          stats: Optional[PipelineStats] = None):
+    """
+    Read ``chunks`` (e.g. ``call.chunk()`` of a Rumor request) and send a DecodedChunk per chunk to ``send``,
+    in stream order. Decode errors are reported per chunk, they do not stop the stream. Closes ``send`` when done.
+    """
+    assert buffer_size > 0 and workers > 0
+    if stats is None:
+        stats = PipelineStats()
+    raw_send, raw_recv = trio.open_memory_channel(buffer_size)
+    limiter = trio.CapacityLimiter(workers)
+    # Decoded out of order by the workers, emitted in order.
+    done: Dict[int, DecodedChunk] = {}
+    emit_lock = trio.Lock()
+    emitted = trio.Event()
+    next_index = 0
+
+    async def reader():
+        async with raw_send:
+            index = 0
+            async for chunk in chunks:
+                stats.received += 1
+                start = trio.current_time()
+                await raw_send.send((index, chunk))
+                stats.read_blocked += trio.current_time() - start
+                index += 1
+
+    async def emit():
+        nonlocal next_index, emitted
+        async with emit_lock:
+            while next_index in done:
+                # Blocks on a slow consumer, which in turn fills the buffer and pauses the reader.
+                await send.send(done.pop(next_index))
+                next_index += 1
+                emitted.set()
+                emitted = trio.Event()
+
+    async def decoder(recv: trio.MemoryReceiveChannel):
+        async with recv:
+            async for index, chunk in recv:
+                size = len(chunk.get('data', '')) // 2
+                stats.bytes += size
+                start = time.perf_counter()
+                try:
+                    value = await trio.to_thread.run_sync(decode, chunk, limiter=limiter)
+                    done[index] = DecodedChunk(index, value, None, size)
+                    stats.decoded += 1
+                except Exception as e:
+                    done[index] = DecodedChunk(index, None, e, size)
+                    stats.failed += 1
+                stats.decode_time += time.perf_counter() - start
+                await emit()
+                # Behind a slow chunk, the other workers only decode up to the buffer size ahead of it.
+                while len(done) >= buffer_size:
+                    await emitted.wait()
+
+    async with send:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(reader)
+            async with raw_recv:
+                for _ in range(workers):
+                    nursery.start_soon(decoder, raw_recv.clone())
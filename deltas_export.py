@@ -0,0 +1,201 @@
+import argparse
+import io
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from typing import Dict, List as PyList, Optional
+
+from fastspec import (
+    BeaconState, EpochObserver, EpochProcess, AttestationDeltasDetail, Epoch, Gwei,
+)
+
+# Per-validator reward and penalty components of every epoch transition, as a columnar binary file per epoch.
+#
+# A DeltasExport is an EpochObserver: the caller that owns the canonical transition passes it to
+# state_transition (or process_slots), and only the epoch transitions of those calls are exported.
+# get_attestation_deltas records the components (see AttestationDeltasDetail) in the same pass,
+# and the export writes them out after the epoch. Without it, fastspec only checks a flag per component.
+#
+# Layout (all integers little-endian):
+#
+#   header:  magic (8) | version u32 | column count u32 | epoch u64 | validator count u64
+#   columns: count * (name (24, zero padded) | offset u64 | crc32 u32 | reserved u32)
+#   data:    every column is validator count * uint64, starting at a DELTAS_ALIGN boundary
+
+DELTAS_MAGIC = b'FSDELTAS'
+DELTAS_VERSION = 1
+DELTAS_ALIGN = 64
+
+_HEADER = struct.Struct('<8sIIQQ')
+_COLUMN = struct.Struct('<24sQII')
+
+_NATIVE_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+class DeltasError(Exception):
+    pass
+
+
+def _align(n: int) -> int:
+    return (n + DELTAS_ALIGN - 1) // DELTAS_ALIGN * DELTAS_ALIGN
+
+
+def deltas_path(directory: str, epoch: Epoch) -> str:
+    return os.path.join(directory, f"deltas_{epoch:09d}.bin")
+
+
+def write_deltas(path: str, detail: AttestationDeltasDetail) -> None:
+    columns = []
+    for name, values in detail.columns().items():
+        if not _NATIVE_LITTLE_ENDIAN:
+            values = array('Q', values)
+            values.byteswap()
+        columns.append((name, values.tobytes()))
+
+    offset = _align(_HEADER.size + _COLUMN.size * len(columns))
+    table = io.BytesIO()
+    offsets = []
+    for name, data in columns:
+        table.write(_COLUMN.pack(name.encode(), offset, zlib.crc32(data), 0))
+        offsets.append(offset)
+        offset = _align(offset + len(data))
+
+    # Write to a temporary file first, a crash while writing must not leave a broken file behind.
+    tmp_path = path + '.tmp'
+    with io.open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(DELTAS_MAGIC, DELTAS_VERSION, len(columns), detail.epoch, detail.validator_count))
+        f.write(table.getvalue())
+        for (name, data), column_offset in zip(columns, offsets):
+            f.write(b'\x00' * (column_offset - f.tell()))
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+class DeltasFile(object):
+    epoch: Epoch
+    validator_count: int
+
+    # Opens the file with a read-only mmap; columns are cast from it, not copied (on little-endian hosts).
+    def __init__(self, path: str):
+        self._file = io.open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        self._view = memoryview(self._mmap)
+        self._columns: Dict[str, tuple] = {}
+        self._casts: Dict[str, memoryview] = {}
+        try:
+            self._read_header()
+        except Exception:
+            self.close()
+            raise
+
+    def _read_header(self):
+        if len(self._view) < _HEADER.size:
+            raise DeltasError("deltas file too small")
+        magic, version, count, epoch, validator_count = _HEADER.unpack_from(self._view, 0)
+        if magic != DELTAS_MAGIC:
+            raise DeltasError(f"not a deltas file, bad magic: {magic!r}")
+        if version != DELTAS_VERSION:
+            raise DeltasError(f"unsupported deltas version {version}, expected {DELTAS_VERSION}")
+        self.epoch = Epoch(epoch)
+        self.validator_count = validator_count
+        length = validator_count * 8
+        for i in range(count):
+            name, offset, crc, _ = _COLUMN.unpack_from(self._view, _HEADER.size + i * _COLUMN.size)
+            if offset + length > len(self._view):
+                raise DeltasError(f"deltas column {name!r} is truncated")
+            self._columns[name.rstrip(b'\x00').decode()] = (offset, crc)
+
+    @property
+    def names(self) -> PyList[str]:
+        return list(self._columns)
+
+    def column(self, name: str, verify_checksum: bool = False):
+        """The values of a column, indexable by validator index."""
+        if name not in self._columns:
+            raise DeltasError(f"deltas file has no column {name!r}")
+        offset, crc = self._columns[name]
+        data = self._view[offset:offset + self.validator_count * 8]
+        if verify_checksum and zlib.crc32(data) != crc:
+            raise DeltasError(f"deltas column {name!r} checksum mismatch")
+        if _NATIVE_LITTLE_ENDIAN:
+            values = self._casts.get(name)
+            if values is None:
+                values = self._casts[name] = data.cast('Q')
+            return values
+        values = array('Q', data.tobytes())
+        values.byteswap()
+        return values
+
+    def validator(self, index: int) -> Dict[str, int]:
+        return {name: self.column(name)[index] for name in self._columns}
+
+    def close(self):
+        for view in self._casts.values():
+            view.release()
+        self._casts = {}
+        self._columns = {}
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "DeltasFile":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DeltasExport(EpochObserver):
+    """
+    Writes the reward and penalty components of the epoch transitions it is passed to:
+
+        export = DeltasExport('deltas')
+        state_transition(epochs_ctx, state, signed_block, observer=export)
+    """
+    directory: str
+    written: PyList[str]
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.written = []
+        self._detail: Optional[AttestationDeltasDetail] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def attestation_deltas_detail(self, process: EpochProcess) -> Optional[AttestationDeltasDetail]:
+        self._detail = AttestationDeltasDetail(process.prev_epoch, len(process.statuses))
+        return self._detail
+
+    def after_epoch(self, process: EpochProcess, state: BeaconState) -> None:
+        # No detail in the genesis epoch, there are no deltas then.
+        detail, self._detail = self._detail, None
+        if detail is None:
+            return
+        path = deltas_path(self.directory, detail.epoch)
+        write_deltas(path, detail)
+        self.written.append(path)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Show per-validator reward and penalty components of an epoch.")
+    parser.add_argument('path', help="deltas file, see DeltasExport")
+    parser.add_argument('--validator', type=int, nargs='*', help="show the components of these validators")
+    args = parser.parse_args(args)
+
+    with DeltasFile(args.path) as deltas:
+        print(f"epoch {deltas.epoch}, {deltas.validator_count} validators")
+        for name in deltas.names:
+            values = deltas.column(name, verify_checksum=True)
+            print(f"{name:<20} total {Gwei(sum(values)):>20} Gwei, non-zero for {sum(1 for v in values if v)}")
+        for index in args.validator or ():
+            print(f"validator {index}: {deltas.validator(index)}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,169 @@
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import trio
+
+# Request entries as produced by Rumor for a raw listener: req_id, from (the peer id), protocol, chunk (data hex), etc.
+Request = Dict[str, Any]
+Handler = Callable[[Request], Awaitable[None]]
+
+# Defaults of the dispatcher limits
+DEFAULT_MAX_CONCURRENT = 128  # requests handled at the same time, over all peers and protocols
+DEFAULT_PEER_CONCURRENCY = 2  # requests of one peer handled at the same time
+DEFAULT_PEER_PENDING = 16  # requests of one peer handled or waiting for a peer slot, before rejecting
+DEFAULT_PEER_RATE = 10.0  # sustained requests per second per peer
+DEFAULT_PEER_BURST = 20  # requests a peer can make at once after being idle
+
+
+def request_peer(req: Request) -> str:
+    # Per-peer limits are meaningless if requests without a peer all share one bucket, so this does not default.
+    peer_id = req.get('from')
+    if not peer_id:
+        raise ValueError(f"request {req.get('req_id')} has no peer ('from'), got keys: {sorted(req)}")
+    return peer_id
+
+
+class PeerState(object):
+    slots: trio.Semaphore
+    pending: int
+    tokens: float
+    last_refill: float
+
+    def __init__(self, concurrency: int, burst: int, now: float):
+        self.slots = trio.Semaphore(concurrency)
+        self.pending = 0
+        self.tokens = float(burst)
+        self.last_refill = now
+
+
+class DispatcherStats(object):
+    accepted: int
+    rate_limited: int
+    rejected_busy: int
+    failed: int
+    completed: int
+
+    def __init__(self):
+        self.accepted = 0
+        self.rate_limited = 0
+        self.rejected_busy = 0
+        self.failed = 0
+        self.completed = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return dict(vars(self))
+
+
+class RequestDispatcher(object):
+    """
+    Serves the requests of one or more Rumor RPC listeners concurrently, one trio task per request:
+
+        dispatcher = RequestDispatcher(nursery)
+        nursery.start_soon(dispatcher.serve, morty, 'status', status_handler)
+        nursery.start_soon(dispatcher.serve, morty, 'blocks_by_range', range_handler)
+
+    Backpressure: when ``max_concurrent`` requests are in flight, the listeners stop reading requests
+    until one completes. Per peer, at most ``peer_concurrency`` requests run at a time, and requests beyond
+    the token-bucket rate or ``peer_pending`` queued requests are answered with a server error right away,
+    so a single slow or greedy peer does not stall everyone else.
+    """
+    nursery: trio.Nursery
+    max_concurrent: int
+    peer_concurrency: int
+    peer_pending: int
+    peer_rate: float
+    peer_burst: int
+    stats: DispatcherStats
+
+    def __init__(self, nursery: trio.Nursery, max_concurrent: int = DEFAULT_MAX_CONCURRENT,
+                 peer_concurrency: int = DEFAULT_PEER_CONCURRENCY, peer_pending: int = DEFAULT_PEER_PENDING,
+                 peer_rate: float = DEFAULT_PEER_RATE, peer_burst: int = DEFAULT_PEER_BURST):
+        self.nursery = nursery
+        self.max_concurrent = max_concurrent
+        self.peer_concurrency = peer_concurrency
+        self.peer_pending = peer_pending
+        self.peer_rate = peer_rate
+        self.peer_burst = peer_burst
+        self.stats = DispatcherStats()
+        self._in_flight = trio.Semaphore(max_concurrent)
+        self._peers: Dict[str, PeerState] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return self.max_concurrent - self._in_flight.value
+
+    def _peer(self, peer_id: str) -> PeerState:
+        peer = self._peers.get(peer_id)
+        if peer is None:
+            peer = self._peers[peer_id] = PeerState(self.peer_concurrency, self.peer_burst, trio.current_time())
+        return peer
+
+    def _take_token(self, peer: PeerState) -> bool:
+        now = trio.current_time()
+        peer.tokens = min(float(self.peer_burst), peer.tokens + (now - peer.last_refill) * self.peer_rate)
+        peer.last_refill = now
+        if peer.tokens < 1.0:
+            return False
+        peer.tokens -= 1.0
+        return True
+
+    async def serve(self, actor: Any, method: str, handler: Handler, compression: Optional[str] = 'snappy'):
+        # Listens on the ``method`` protocol of ``actor`` (e.g. rumor.actor('morty')) until the listener stops.
+        rpc = getattr(actor.rpc, method)
+        call = rpc.listen(raw=True, compression=compression)
+        async for req in call.req():
+            await self.dispatch(rpc, req, handler)
+        print(f"dispatcher: stopped listening for {method} requests")
+
+    async def dispatch(self, rpc: Any, req: Request, handler: Handler):
+        peer_id = request_peer(req)
+        peer = self._peer(peer_id)
+        if not self._take_token(peer):
+            self.stats.rate_limited += 1
+            await rpc.resp.server_error(req['req_id'], "rate limited")
+            return
+        if peer.pending >= self.peer_pending:
+            self.stats.rejected_busy += 1
+            await rpc.resp.server_error(req['req_id'], "too many concurrent requests")
+            return
+
+        # Blocks the listener (and with that the reading of new requests) while at capacity.
+        await self._in_flight.acquire()
+        peer.pending += 1
+        self.stats.accepted += 1
+        self.nursery.start_soon(self._run, rpc, req, handler, peer_id, peer)
+
+    async def _run(self, rpc: Any, req: Request, handler: Handler, peer_id: str, peer: PeerState):
+        try:
+            async with peer.slots:
+                await handler(req)
+            self.stats.completed += 1
+        except Exception as e:
+            self.stats.failed += 1
+            print(f"dispatcher: request {req.get('req_id')} of peer {peer_id} failed: {e}")
+            try:
+                await rpc.resp.server_error(req['req_id'], "internal error")
+            except Exception:
+                pass  # the stream may be closed already
+        finally:
+            peer.pending -= 1
+            self._in_flight.release()
+            # Forget idle peers once their bucket is full again, to not grow with every peer ever seen.
+            if peer.pending == 0 and peer.tokens + self.peer_rate * (trio.current_time() - peer.last_refill) \
+                    >= self.peer_burst:
+                self._peers.pop(peer_id, None)
+
+    def peer_count(self) -> int:
+        return len(self._peers)
+
+
+async def serve_all(actor: Any, handlers: Dict[str, Handler], compression: Optional[str] = 'snappy',
+                    **kwargs) -> DispatcherStats:
+    """
+    Serve several RPC methods of one actor, e.g. ``{'status': ..., 'blocks_by_range': ...}``,
+    with one dispatcher, until all listeners stop.
+    """
+    async with trio.open_nursery() as nursery:
+        dispatcher = RequestDispatcher(nursery, **kwargs)
+        for method, handler in handlers.items():
+            nursery.start_soon(dispatcher.serve, actor, method, handler, compression)
+    return dispatcher.stats
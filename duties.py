@@ -0,0 +1,170 @@
+import weakref
+from typing import Dict, Iterable, List as PyList, Optional, Sequence, Tuple, Union
+
+from fastspec import (
+    EpochsContext, ShufflingEpoch, BLSPubkey, CommitteeIndex, Epoch, Slot, ValidatorIndex, SLOTS_PER_EPOCH,
+    compute_start_slot_at_epoch,
+)
+
+# Validator duties, answered from lookup tables instead of walking committees per validator.
+#
+# The attester table of an epoch maps every validator index to its committee assignment, it is built once per
+# ShufflingEpoch. Shufflings are immutable and replaced on rotate_epochs, so a table is keyed by its shuffling:
+# rotation invalidates it, and forks that share a shuffling (see ShufflingRegistry) share the table too.
+# Proposers are only known for the current epoch, they are keyed by the proposers list of the EpochsContext.
+
+# validator index -> (slot, committee index, position in committee, committee length, committees at slot)
+AttesterAssignment = Tuple[Slot, CommitteeIndex, int, int, int]
+
+_attester_tables: "weakref.WeakKeyDictionary[ShufflingEpoch, Dict[ValidatorIndex, AttesterAssignment]]" = \
+    weakref.WeakKeyDictionary()
+
+
+class AttesterDuty(object):
+
+    __slots__ = 'pubkey', 'validator_index', 'slot', 'committee_index', 'validator_committee_index', \
+        'committee_length', 'committees_at_slot'
+
+    pubkey: BLSPubkey
+    validator_index: ValidatorIndex
+    slot: Slot
+    committee_index: CommitteeIndex
+    validator_committee_index: int  # position in the committee, i.e. the aggregation bit
+    committee_length: int
+    committees_at_slot: int
+
+    def __init__(self, pubkey: BLSPubkey, validator_index: ValidatorIndex, assignment: AttesterAssignment):
+        self.pubkey = pubkey
+        self.validator_index = validator_index
+        (self.slot, self.committee_index, self.validator_committee_index,
+         self.committee_length, self.committees_at_slot) = assignment
+
+    def to_dict(self) -> dict:
+        return {
+            'pubkey': '0x' + self.pubkey.hex(),
+            'validator_index': int(self.validator_index),
+            'slot': int(self.slot),
+            'committee_index': int(self.committee_index),
+            'validator_committee_index': self.validator_committee_index,
+            'committee_length': self.committee_length,
+            'committees_at_slot': self.committees_at_slot,
+        }
+
+
+class ProposerDuty(object):
+
+    __slots__ = 'pubkey', 'validator_index', 'slot'
+
+    pubkey: BLSPubkey
+    validator_index: ValidatorIndex
+    slot: Slot
+
+    def __init__(self, pubkey: BLSPubkey, validator_index: ValidatorIndex, slot: Slot):
+        self.pubkey = pubkey
+        self.validator_index = validator_index
+        self.slot = slot
+
+    def to_dict(self) -> dict:
+        return {
+            'pubkey': '0x' + self.pubkey.hex(),
+            'validator_index': int(self.validator_index),
+            'slot': int(self.slot),
+        }
+
+
+def attester_table(shuffling: ShufflingEpoch) -> Dict[ValidatorIndex, AttesterAssignment]:
+    table = _attester_tables.get(shuffling)
+    if table is None:
+        table = {}
+        start_slot = compute_start_slot_at_epoch(shuffling.epoch)
+        for slot_offset, slot_committees in enumerate(shuffling.committees):
+            slot = Slot(start_slot + slot_offset)
+            committees_at_slot = len(slot_committees)
+            for committee_index, committee in enumerate(slot_committees):
+                committee_length = len(committee)
+                index = CommitteeIndex(committee_index)
+                for position, validator_index in enumerate(committee):
+                    table[validator_index] = (slot, index, position, committee_length, committees_at_slot)
+        _attester_tables[shuffling] = table
+    return table
+
+
+Validator = Union[BLSPubkey, bytes, int]  # pubkey, or validator index
+
+
+class Duties(object):
+    """
+    Bulk duty queries against an EpochsContext, which may be rotated in between:
+
+        duties = Duties(epochs_ctx)
+        duties.attester_duties(pubkeys, epoch)  # current or next epoch
+        duties.proposer_duties(pubkeys)  # current epoch
+    """
+    epochs_ctx: EpochsContext
+
+    def __init__(self, epochs_ctx: EpochsContext):
+        self.epochs_ctx = epochs_ctx
+        self._proposers_key: Optional[PyList[ValidatorIndex]] = None
+        self._proposer_slots: Dict[ValidatorIndex, PyList[Slot]] = {}
+
+    def validator_index(self, validator: Validator) -> Optional[ValidatorIndex]:
+        if isinstance(validator, int):
+            return ValidatorIndex(validator) if validator < len(self.epochs_ctx.index2pubkey) else None
+        return self.epochs_ctx.pubkey2index.get(bytes(validator))
+
+    def validator_indices(self, validators: Iterable[Validator]) -> PyList[Optional[ValidatorIndex]]:
+        return [self.validator_index(v) for v in validators]
+
+    def _shuffling(self, epoch: Epoch) -> ShufflingEpoch:
+        ctx = self.epochs_ctx
+        for shuffling in (ctx.current_shuffling, ctx.next_shuffling, ctx.previous_shuffling):
+            if shuffling.epoch == epoch:
+                return shuffling
+        raise ValueError(f"no shuffling for epoch {epoch}, "
+                         f"have epochs {ctx.previous_shuffling.epoch} to {ctx.next_shuffling.epoch}")
+
+    def attester_duties(self, validators: Sequence[Validator], epoch: Epoch) -> PyList[AttesterDuty]:
+        """
+        Attester duties in ``epoch`` (previous, current or next) of the given pubkeys or indices.
+        Unknown and inactive validators are left out.
+        """
+        table = attester_table(self._shuffling(epoch))
+        index2pubkey = self.epochs_ctx.index2pubkey
+        out = []
+        for validator_index in self.validator_indices(validators):
+            if validator_index is None:
+                continue
+            assignment = table.get(validator_index)
+            if assignment is not None:
+                out.append(AttesterDuty(index2pubkey[validator_index], validator_index, assignment))
+        return out
+
+    def _proposer_table(self) -> Dict[ValidatorIndex, PyList[Slot]]:
+        # The proposers list is replaced on rotation, which invalidates the table.
+        proposers = self.epochs_ctx.proposers
+        if proposers is not self._proposers_key:
+            start_slot = compute_start_slot_at_epoch(self.epochs_ctx.current_shuffling.epoch)
+            table: Dict[ValidatorIndex, PyList[Slot]] = {}
+            for slot_offset, validator_index in enumerate(proposers):
+                table.setdefault(validator_index, []).append(Slot(start_slot + slot_offset))
+            self._proposer_slots = table
+            self._proposers_key = proposers
+        return self._proposer_slots
+
+    def proposer_duties(self, validators: Optional[Sequence[Validator]] = None) -> PyList[ProposerDuty]:
+        """
+        Proposer duties of the current epoch, of the given validators, or of all slots if None.
+        Proposers of the next epoch depend on the state at the epoch start, they are not known yet.
+        """
+        index2pubkey = self.epochs_ctx.index2pubkey
+        if validators is None:
+            start_slot = compute_start_slot_at_epoch(self.epochs_ctx.current_shuffling.epoch)
+            return [ProposerDuty(index2pubkey[index], index, Slot(start_slot + i))
+                    for i, index in enumerate(self.epochs_ctx.proposers[:SLOTS_PER_EPOCH])]
+        table = self._proposer_table()
+        out = []
+        for validator_index in self.validator_indices(validators):
+            for slot in table.get(validator_index, ()):
+                out.append(ProposerDuty(index2pubkey[validator_index], validator_index, slot))
+        out.sort(key=lambda duty: duty.slot)
+        return out
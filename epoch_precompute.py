@@ -0,0 +1,258 @@
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import List as PyList, Optional, Tuple
+
+from fastspec import (
+    BeaconState, EpochsContext, EpochObserver, EpochProcess, AttestationDeltasDetail, SignedBeaconBlock,
+    Bytes32, Root, Slot, GENESIS_EPOCH,
+    compute_epoch_at_slot, compute_start_slot_at_epoch, hash_tree_root, process_slots, state_transition,
+)
+
+# Speculative epoch transition: shortly before an epoch boundary, the head state is copied and advanced
+# to the first slot of the next epoch in the background, which runs process_epoch off the import path.
+# If the next block then builds on the same head, the import starts from the advanced state,
+# and only has to process the block. Otherwise the speculation is dropped.
+#
+# The work runs in a thread: it holds the GIL while running, so it uses time the node would otherwise
+# spend waiting for the next block. The import path never waits for it, an unfinished speculation is cancelled.
+# A cancel takes effect at the next step of the epoch transition, so an abandoned speculation stops
+# competing for the GIL with the import that replaces it.
+#
+# The epoch transition of a speculation is recorded, and replayed to the EpochObserver of the import
+# that promotes it: observers only ever see the transitions of the imports they are passed to.
+
+DEFAULT_LEAD_SLOTS = 2  # start this many slots before the epoch boundary
+
+
+class SpeculationCancelled(Exception):
+    pass
+
+
+# An epoch transition of a speculation: its EpochProcess, and its deltas detail if recorded
+RecordedEpoch = Tuple[EpochProcess, Optional[AttestationDeltasDetail]]
+
+
+class _SpeculationObserver(EpochObserver):
+    # Aborts the epoch transition of a speculation in between its steps once cancelled,
+    # and records it for the observer of the import that may promote it.
+
+    def __init__(self, cancelled: threading.Event, record_deltas: bool):
+        self.cancelled = cancelled
+        self.record_deltas = record_deltas
+        self.epochs: PyList[RecordedEpoch] = []
+        self._detail: Optional[AttestationDeltasDetail] = None
+
+    def before_step(self, step: str) -> None:
+        if self.cancelled.is_set():
+            raise SpeculationCancelled(f"cancelled before {step}")
+
+    def attestation_deltas_detail(self, process: EpochProcess) -> Optional[AttestationDeltasDetail]:
+        if self.record_deltas:
+            self._detail = AttestationDeltasDetail(process.prev_epoch, len(process.statuses))
+        return self._detail
+
+    def after_epoch(self, process: EpochProcess, state: BeaconState) -> None:
+        self.epochs.append((process, self._detail))
+        self._detail = None
+
+
+def replay_epochs(epochs: PyList[RecordedEpoch], observer: EpochObserver, state: BeaconState) -> bool:
+    # Replays recorded epoch transitions to ``observer``. False if it wants deltas that were not recorded.
+    for process, detail in epochs:
+        wanted = observer.attestation_deltas_detail(process) if process.current_epoch != GENESIS_EPOCH else None
+        if wanted is not None:
+            if detail is None:
+                return False
+            for name in AttestationDeltasDetail.COLUMNS:
+                getattr(wanted, name)[:] = getattr(detail, name)
+        observer.after_epoch(process, state)
+    return True
+
+
+class Speculation(object):
+    base_slot: Slot
+    target_slot: Slot
+    head_root: Optional[Root]  # known head root at schedule time, if any
+    future: Future
+
+    def __init__(self, base_slot: Slot, target_slot: Slot, head_root: Optional[Root], record_deltas: bool = False):
+        self.base_slot = base_slot
+        self.target_slot = target_slot
+        self.head_root = head_root
+        self.record_deltas = record_deltas
+        self.cancelled = threading.Event()
+        self.future = None
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def run(self, epochs_ctx: EpochsContext,
+            state: BeaconState) -> Tuple[Root, BeaconState, EpochsContext, float, PyList[RecordedEpoch]]:
+        start = time.perf_counter()
+        observer = _SpeculationObserver(self.cancelled, self.record_deltas)
+        # One slot at a time, so a cancel takes effect at the next slot, or at the next step of process_epoch.
+        while state.slot < self.target_slot:
+            if self.cancelled.is_set():
+                raise SpeculationCancelled()
+            process_slots(epochs_ctx, state, Slot(state.slot + 1), observer)
+        if self.cancelled.is_set():
+            raise SpeculationCancelled()
+        # After process_slot the latest header has its state root filled in: this is the root of the head block.
+        head_root = hash_tree_root(state.latest_block_header)
+        # Cache the tree hash, so the state root check of the next block only re-hashes what the block changed.
+        hash_tree_root(state)
+        return head_root, state, epochs_ctx, time.perf_counter() - start, observer.epochs
+
+
+class PrecomputeStats(object):
+    scheduled: int
+    promoted: int
+    missed: int  # not finished when the block came in
+    dropped: int  # the block did not build on the expected head, or was not in the epoch
+    skipped: int  # not scheduled, a speculation would not finish before the epoch boundary
+    saved_time: float  # seconds of precomputed transition work used by imports
+
+    def __init__(self):
+        self.scheduled = 0
+        self.promoted = 0
+        self.missed = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.saved_time = 0.0
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+def head_block_root(state: BeaconState) -> Root:
+    # Root of the latest block applied to the state, also before the next process_slot filled in its state root.
+    header = state.latest_block_header.copy()
+    if header.state_root == Bytes32():
+        header.state_root = hash_tree_root(state)
+    return hash_tree_root(header)
+
+
+class EpochPrecompute(object):
+    """
+    Optional speculative epoch transition for a block import loop:
+
+        precompute = EpochPrecompute()
+        ...
+        state, epochs_ctx = precompute.import_block(epochs_ctx, state, signed_block, observer=observer)
+        precompute.maybe_schedule(epochs_ctx, state)
+
+    With record_deltas, speculations record the reward and penalty components, for import observers that
+    want them (e.g. a DeltasExport). Without, such an import runs the epoch transition itself.
+    """
+    lead_slots: int
+    record_deltas: bool
+    stats: PrecomputeStats
+
+    def __init__(self, lead_slots: int = DEFAULT_LEAD_SLOTS, executor: Optional[Executor] = None,
+                 record_deltas: bool = False):
+        self.lead_slots = lead_slots
+        self.record_deltas = record_deltas
+        self._own_executor = executor is None
+        self._executor = ThreadPoolExecutor(max_workers=1) if executor is None else executor
+        self._speculation: Optional[Speculation] = None
+        self._last_duration: Optional[float] = None  # of the last finished speculation
+        self.stats = PrecomputeStats()
+
+    def maybe_schedule(self, epochs_ctx: EpochsContext, state: BeaconState,
+                       head_root: Optional[Root] = None, time_left: Optional[float] = None) -> bool:
+        """
+        Schedule if the next epoch boundary is at most lead_slots away. If ``time_left`` (seconds until
+        the boundary slot) is given, a speculation is not started if the last one took longer than that:
+        it would most likely be cancelled half-way, after competing with the import for the GIL.
+        """
+        target_slot = compute_start_slot_at_epoch(compute_epoch_at_slot(state.slot) + 1)
+        if target_slot - state.slot > self.lead_slots:
+            return False
+        if time_left is not None and self._last_duration is not None and self._last_duration > time_left:
+            self.stats.skipped += 1
+            return False
+        return self.schedule(epochs_ctx, state, head_root)
+
+    def schedule(self, epochs_ctx: EpochsContext, state: BeaconState, head_root: Optional[Root] = None) -> bool:
+        """
+        Start advancing a copy of ``state`` to the next epoch start. Replaces (and cancels) any other speculation.
+        Returns False if the same speculation is already running.
+        """
+        target_slot = compute_start_slot_at_epoch(compute_epoch_at_slot(state.slot) + 1)
+        current = self._speculation
+        if (current is not None and head_root is not None and current.head_root == head_root
+                and current.target_slot == target_slot):
+            return False
+        self.cancel()
+        speculation = Speculation(Slot(state.slot), target_slot, head_root, self.record_deltas)
+        # Copied here: the caller keeps modifying its own state and context after this returns.
+        speculation.future = self._executor.submit(speculation.run, epochs_ctx.copy(), state.copy())
+        self._speculation = speculation
+        self.stats.scheduled += 1
+        return True
+
+    def cancel(self):
+        if self._speculation is not None:
+            self._speculation.cancel()
+            self._speculation = None
+
+    def take(self, signed_block: SignedBeaconBlock,
+             observer: Optional[EpochObserver] = None) -> Optional[Tuple[BeaconState, EpochsContext]]:
+        """
+        The advanced state and context for ``signed_block``, if the speculation is done and the block
+        builds on the speculated head, in or after the speculated epoch. Never waits; the speculation is consumed.
+        The epoch transition of a promoted speculation is replayed to ``observer``.
+        """
+        speculation = self._speculation
+        if speculation is None:
+            return None
+        self._speculation = None
+        block = signed_block.message
+        if not speculation.future.done():
+            speculation.cancel()
+            self.stats.missed += 1
+            return None
+        try:
+            head_root, state, epochs_ctx, duration, epochs = speculation.future.result()
+        except Exception:
+            # Cancelled, or the transition failed: the import path will run into the same error itself.
+            self.stats.dropped += 1
+            return None
+        self._last_duration = duration
+        if block.parent_root != head_root or block.slot < speculation.target_slot:
+            self.stats.dropped += 1
+            return None
+        if observer is not None and not replay_epochs(epochs, observer, state):
+            self.stats.dropped += 1
+            return None
+        self.stats.promoted += 1
+        self.stats.saved_time += duration
+        return state, epochs_ctx
+
+    def import_block(self, epochs_ctx: EpochsContext, state: BeaconState, signed_block: SignedBeaconBlock,
+                     validate_result: bool = True,
+                     observer: Optional[EpochObserver] = None) -> Tuple[BeaconState, EpochsContext]:
+        """
+        state_transition, from the speculated state if it can be used. Returns the post-state and context,
+        which are either the given ones (modified) or the promoted ones.
+        ``observer`` sees the epoch transitions of the import, also if they ran speculatively.
+        """
+        promoted = self.take(signed_block, observer)
+        if promoted is not None:
+            state, epochs_ctx = promoted
+        state_transition(epochs_ctx, state, signed_block, validate_result=validate_result, observer=observer)
+        return state, epochs_ctx
+
+    def close(self):
+        self.cancel()
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    def __enter__(self) -> "EpochPrecompute":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,9 +1,18 @@
 import trio
 import os
 import io
+import time
+from functools import partial
 from typing import Coroutine, Callable
-from eth2spec.phase0.spec import BeaconState
-from fastspec import SignedBeaconBlock, Container, Bytes32, uint64, Bytes4, List, GENESIS_FORK_VERSION
+from fastspec import SignedBeaconBlock
+from messages import Status, Goodbye, BlocksByRange, BlocksByRoot
+from block_store import BlockStore, request_roots
+from response_cache import ResponseCache
+from dispatcher import RequestDispatcher, Request, Handler, serve_all, request_peer
+from range_sync import RangeSync
+from snapshot import read_snapshot
+from chunk_pipeline import pipeline_chunks, PipelineStats
+from status_service import StatusService
 from pyrum import Rumor
 
 
@@ -12,39 +21,51 @@ from pyrum import Rumor
 # prepare_config("./some-dir", "config-name")
 
 
-class Status(Container):
-    version: Bytes4
-    finalized_root: Bytes32
-    finalized_epoch: uint64
-    head_root: Bytes32
-    head_slot: uint64
+def genesis_state_type():
+    # genesis.ssz (see make_genesis.py) is encoded with the BeaconState of eth2spec.phase0.spec, which has
+    # genesis_validators_root, unlike the fastspec one. That module defines its own copy of every container type,
+    # and loads BLS: it is only imported when a genesis file is actually read.
+    from eth2spec.phase0.spec import BeaconState
+    return BeaconState
 
 
-class Goodbye(uint64):
-    pass
+def load_state(filepath: str):
+    state_size = os.stat(filepath).st_size
+    with io.open(filepath, 'br') as f:
+        return genesis_state_type().deserialize(f, state_size)
 
 
-class BlocksByRange(Container):
-    head_block_root: Bytes32
-    start_slot: uint64
-    count: uint64
-    step: uint64
+# Blocks to serve, e.g. built with: python block_store.py import blocks <dir of block ssz files>
+BLOCK_STORE_DIR = 'blocks'
 
+_block_cache = None
 
-class BlocksByRoot(List[Bytes32, 1024]):
-    pass
 
+def shared_block_cache() -> ResponseCache:
+    # One store and chunk cache for all block handlers, so popular blocks are encoded once for every request type.
+    global _block_cache
+    if _block_cache is None:
+        _block_cache = ResponseCache(BlockStore(BLOCK_STORE_DIR))
+    return _block_cache
 
-def load_state(filepath: str) -> BeaconState:
-    state_size = os.stat(filepath).st_size
-    with io.open(filepath, 'br') as f:
-        return BeaconState.deserialize(f, state_size)
+
+GENESIS_STATE_FILE = 'genesis.ssz'
+
+_status_service = None
+
+
+def shared_status_service() -> StatusService:
+    # The genesis state is loaded and hashed once, the Status encodings are cached until the head changes.
+    global _status_service
+    if _status_service is None:
+        _status_service = StatusService.from_state_file(GENESIS_STATE_FILE, state_type=genesis_state_type())
+    return _status_service
 
 
 async def basic_status_example(rumor: Rumor, nursery: trio.Nursery):
 
     # Load some genesis state of the client (or use make_genesis.py)
-    state = load_state('genesis.ssz')
+    status = shared_status_service()
 
     # Morty is us
     morty = rumor.actor('morty')
@@ -61,18 +82,8 @@ async def basic_status_example(rumor: Rumor, nursery: trio.Nursery):
 
     print("Testing a Status RPC request")
 
-    genesis_root = state.hash_tree_root()
-
     # Sync status
-    morty_status = Status(
-        version=GENESIS_FORK_VERSION,
-        finalized_root=genesis_root,
-        finalized_epoch=0,
-        head_root=genesis_root,
-        head_epoch=0,
-    )
-
-    req = morty_status.encode_bytes().hex()
+    req = status.hex
     print(f"morty: sending rick a status request: {req}")
 
     # Note: public testnet node is not updated, only receiving an empty response if snappy is enabled.
@@ -102,8 +113,7 @@ async def basic_status_example(rumor: Rumor, nursery: trio.Nursery):
             # await morty.rpc.status.resp.server_error(req['req_id'], f"hello! Morty failed, look for a new morty!")
 
             # Respond with valid chunk (and done=True to exit immediately after)
-            resp = morty_status.encode_bytes().hex()
-            await morty.rpc.status.resp.chunk.raw(req['req_id'], resp, done=True)
+            await morty.rpc.status.resp.chunk.raw(req['req_id'], status.hex, done=True)
 
             # Or send arbitrary data
             # resp = bytes.fromhex('1337')
@@ -119,6 +129,77 @@ async def basic_status_example(rumor: Rumor, nursery: trio.Nursery):
     # await call.started()  # wait for the stream handler to come online, there will be a "started=true" entry.
 
 
+def blocks_by_range_handler(morty, cache: ResponseCache, log: Callable[..., None] = print) -> Handler:
+    store = cache.store
+
+    async def handle(req: Request):
+        log(f"morty: Got request: {req}")
+
+        parsed_req = BlocksByRange.decode_bytes(bytes.fromhex(req['chunk']['data']))
+        log('parsed request: ', parsed_req)
+
+        if parsed_req.step < 1:
+            await morty.rpc.blocks_by_range.resp.invalid_request(req['req_id'], "step must be at least 1")
+            return
+
+        # Index lookups only: the blocks are sent as stored, without decoding or re-encoding them.
+        entries = store.range(parsed_req.start_slot, parsed_req.count, parsed_req.step)
+        # Note: with no blocks in the range there is no chunk to mark done, Rumor closes the stream on timeout.
+        for i, entry in enumerate(entries):
+            resp = cache.rumor_payload(entry)
+            log(f"responding chunk {i} slot {entry.slot} root {entry.root.hex()} ({entry.length} bytes)")
+            await morty.rpc.blocks_by_range.resp.chunk.raw(req['req_id'], resp, done=(i + 1 == len(entries)))
+
+        log(f"done responding, cache: {cache.stats()}")
+
+    return handle
+
+
+def blocks_by_root_handler(morty, cache: ResponseCache, log: Callable[..., None] = print) -> Handler:
+    store = cache.store
+
+    async def handle(req: Request):
+        log(f"morty: Got request: {req}")
+
+        try:
+            roots = request_roots(bytes.fromhex(req['chunk']['data']))
+        except ValueError as e:
+            await morty.rpc.blocks_by_root.resp.invalid_request(req['req_id'], str(e))
+            return
+        log(f"parsed request: {len(roots)} roots")
+
+        # One bulk lookup, in request order. Unknown roots are skipped, as per the spec.
+        entries = store.lookup_roots(roots)
+        for i, entry in enumerate(entries):
+            resp = cache.rumor_payload(entry)
+            log(f"responding chunk {i} root {entry.root.hex()} ({entry.length} bytes)")
+            await morty.rpc.blocks_by_root.resp.chunk.raw(req['req_id'], resp, done=(i + 1 == len(entries)))
+
+        log(f"done responding, cache: {cache.stats()}")
+
+    return handle
+
+
+def status_handler(morty, status: StatusService, log: Callable[..., None] = print) -> Handler:
+    async def handle(req: Request):
+        log(f"morty: Got status request: {req}")
+        await morty.rpc.status.resp.chunk.raw(req['req_id'], status.hex, done=True)
+
+    return handle
+
+
+def goodbye_handler(morty, log: Callable[..., None] = print) -> Handler:
+    async def handle(req: Request):
+        # Goodbye has no response, the peer closes the connection after sending it.
+        try:
+            reason = Goodbye.decode_bytes(bytes.fromhex(req['chunk']['data']))
+        except Exception as e:
+            reason = f"undecodable ({e})"
+        log(f"morty: peer {request_peer(req)} says goodbye, reason: {reason}")
+
+    return handle
+
+
 async def server_blocks_by_range_example(rumor: Rumor, nursery: trio.Nursery):
 
     # Morty is us
@@ -134,30 +215,16 @@ async def server_blocks_by_range_example(rumor: Rumor, nursery: trio.Nursery):
 
     print(f"connected to Rick {rick_peer_id}")
 
-    call = morty.rpc.blocks_by_range.listen(raw=True, compression='snappy')
+    cache = shared_block_cache()
+    print(f"serving {len(cache.store)} blocks, slots {cache.store.slot_bounds()}")
 
     print("listening for requests")
 
-    async for req in call.req():
-        print(f"morty: Got request: {req}")
-
-        parsed_req = BlocksByRange.decode_bytes(bytes.fromhex(req['chunk']['data']))
-        print('parsed request: ', parsed_req)
-
-        start = parsed_req.start_slot
-        end = start + parsed_req.count * parsed_req.step
-
-        for i, slot in zip(range(parsed_req.count), range(start, end, parsed_req.step)):
-            # Try any message:
-            # resp = f"not a block, but can you decode this chunk though? chunk nr {i} here".encode()
-            # Or construct a block (can make it more consensus-valid, but snappy compression testing can be simple):
-            resp = SignedBeaconBlock(message=BeaconBlock(slot=slot)).encode_bytes().hex()
-            print(f"responding chunk {i} slot {slot} chunk: {resp}")
-            await morty.rpc.blocks_by_range.resp.chunk.raw(req['req_id'], resp, done=(i + 1 == parsed_req.count))
-
-        print("done responding")
+    # Requests are handled concurrently, a slow peer only holds up its own requests.
+    dispatcher = RequestDispatcher(nursery)
+    await dispatcher.serve(morty, 'blocks_by_range', blocks_by_range_handler(morty, cache))
 
-    print("morty: stopped listening for requests")
+    print(f"morty: stopped listening for requests, {dispatcher.stats.to_dict()}")
 
 
 async def server_blocks_by_root_example(rumor: Rumor, nursery: trio.Nursery):
@@ -175,24 +242,37 @@ async def server_blocks_by_root_example(rumor: Rumor, nursery: trio.Nursery):
 
     print(f"connected to Rick {rick_peer_id}")
 
-    call = morty.rpc.blocks_by_root.listen(raw=True, compression='snappy')
+    cache = shared_block_cache()
 
     print("listening for requests")
 
-    async for req in call.req():
-        print(f"morty: Got request: {req}")
+    dispatcher = RequestDispatcher(nursery)
+    await dispatcher.serve(morty, 'blocks_by_root', blocks_by_root_handler(morty, cache))
+
+    print(f"morty: stopped listening for requests, {dispatcher.stats.to_dict()}")
 
-        parsed_req = BlocksByRoot.decode_bytes(bytes.fromhex(req['chunk']['data']))
-        print('parsed request: ', parsed_req)
 
-        for i, root in enumerate(parsed_req):
-            resp = SignedBeaconBlock(message=BeaconBlock(slot=slot)).encode_bytes().hex()
-            print(f"responding chunk {i} root {root}, chunk: {resp}")
-            await morty.rpc.blocks_by_range.resp.chunk.raw(req['req_id'], resp, done=(i + 1 == len(parsed_req)))
+async def server_all_example(rumor: Rumor, nursery: trio.Nursery):
+
+    # Morty is us, serving status, blocks_by_range, blocks_by_root and goodbye at the same time
+    morty = rumor.actor('morty')
+    await morty.host.start()
+    await morty.host.listen(tcp=9000)
+    print("started morty")
 
-        print("done responding")
+    status = shared_status_service()
+    cache = shared_block_cache()
 
-    print("morty: stopped listening for requests")
+    print("listening for requests")
+
+    stats = await serve_all(morty, {
+        'status': status_handler(morty, status),
+        'blocks_by_range': blocks_by_range_handler(morty, cache),
+        'blocks_by_root': blocks_by_root_handler(morty, cache),
+        'goodbye': goodbye_handler(morty),
+    })
+
+    print(f"morty: stopped listening for requests, {stats.to_dict()}")
 
 async def send_all_requests(rumor: Rumor, nursery: trio.Nursery):
     # Enr of node we are connecting to
@@ -214,18 +294,11 @@ async def send_all_requests(rumor: Rumor, nursery: trio.Nursery):
 
     print(f"connected to Rick {rick_peer_id}")
 
-    state = load_state("genesis.ssz")
-    genesis_root = state.hash_tree_root()
+    status = shared_status_service()
+    genesis_root = status.genesis_root
 
     # Status
-    morty_status_request = Status(
-        version=GENESIS_FORK_VERSION,
-        finalized_root=genesis_root,
-        finalized_epoch=0,
-        head_root=genesis_root,
-        head_epoch=0,
-    )
-    req = morty_status_request.encode_bytes().hex()
+    req = status.hex
     print(f"morty: sending rick a status request: {req}")
 
     resp = await morty.rpc.status.req.raw(rick_peer_id, req, raw=True, compression='snappy')
@@ -249,17 +322,20 @@ async def send_all_requests(rumor: Rumor, nursery: trio.Nursery):
 
     resps = morty.rpc.blocks_by_range.req.raw(rick_peer_id, req, raw=True, compression = 'snappy')
 
-    async def process_response():
-        async for resp in resps.chunk():
-            print(f"morty: received range response from rick: {resp}")
-            try:
-                r = SignedBeaconBlock.decode_bytes(
-                    bytes.fromhex(resp["data"])
-                )
-                print(r)
-            except Exception as e:
-                print(f"could not decode range response: {e}")
-    await process_response()
+    # Reading the stream and decoding run in separate stages, a slow consumer applies backpressure on the stream.
+    stats = PipelineStats()
+    send, recv = trio.open_memory_channel(16)
+    async with trio.open_nursery() as pipeline_nursery:
+        pipeline_nursery.start_soon(partial(pipeline_chunks, resps.chunk(), send, stats=stats))
+        async with recv:
+            async for decoded in recv:
+                if decoded.error is not None:
+                    print(f"could not decode range response chunk {decoded.index}: {decoded.error}")
+                    continue
+                block = decoded.value.message
+                print(f"morty: received range response chunk {decoded.index} from rick: "
+                      f"slot {block.slot}, {decoded.size} bytes")
+    print(f"range response: {stats.to_dict()}")
 
     # Root
     morty_root_request = BlocksByRoot([genesis_root])
@@ -288,6 +364,38 @@ async def send_all_requests(rumor: Rumor, nursery: trio.Nursery):
     print("Done")
 
 
+SYNC_ANCHOR_SNAPSHOT = 'anchor.snapshot'
+
+
+async def range_sync_example(rumor: Rumor, nursery: trio.Nursery):
+    # Nodes to sync from, every connected peer gets its share of the batches
+    peer_enrs = [
+        "enr:-Ku4QM-p4szB_L1Ca32OpGh0tL2kZA2I26hXNtcbMcolFZz6Kfumn33-n8cE3qyGCsFRQPCa0DszEy9tBJnp0sb9YkEBh2F0dG5ldHOIAAAAAAAAAACEZXRoMpAAAAAAAAAAAAAAAAAAAAAAgmlkgnY0gmlwhH8AAAGJc2VjcDI1NmsxoQMHzWU3mH2sphZXxi24HHpBo7VHM2YnjjA8ofU9f7XhYYN0Y3CCIyk",
+    ]
+    # Morty is us
+    morty = rumor.actor("morty")
+    await morty.host.start()
+    await morty.host.listen(tcp=9000)
+    print("started morty")
+
+    peers = []
+    for enr in peer_enrs:
+        try:
+            peers.append(await morty.peer.connect(enr, "bootnode").peer_id())
+        except Exception as e:
+            print(f"could not connect to {enr}: {e}")
+    print(f"connected to {len(peers)} peers: {peers}")
+
+    # Sync onto a fastspec state, e.g. a snapshot written by replay.py or bench.py (see snapshot.py)
+    state, epochs_ctx = read_snapshot(SYNC_ANCHOR_SNAPSHOT)
+
+    sync = RangeSync(morty, peers)
+    start = time.perf_counter()
+    applied = await sync.sync(epochs_ctx, state, start_slot=state.slot + 1, count=1024)
+    elapsed = time.perf_counter() - start
+    print(f"synced {applied} blocks in {elapsed:.2f}s ({sync.stats.requests} requests, "
+          f"{sync.stats.failures} failed, per peer: {sync.stats.per_peer_blocks}), head slot {state.slot}")
+
 
 async def run_rumor_function(fn: Callable[[Rumor, trio.Nursery], Coroutine]):
     async with trio.open_nursery() as nursery:
@@ -303,4 +411,7 @@ async def run_rumor_function(fn: Callable[[Rumor, trio.Nursery], Coroutine]):
 # trio.run(run_rumor_function, basic_status_example)
 # trio.run(run_rumor_function, server_blocks_by_range_example)
 # trio.run(run_rumor_function, server_blocks_by_root_example)
-trio.run(run_rumor_function, send_all_requests)
+# trio.run(run_rumor_function, server_all_example)
+# trio.run(run_rumor_function, range_sync_example)
+if __name__ == '__main__':
+    trio.run(run_rumor_function, send_all_requests)
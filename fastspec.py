@@ -1,9 +1,36 @@
-from eth2spec.config.config_util import apply_constants_config
 from typing import Iterator, List as PyList, Sequence, Tuple, Dict, Optional
+import importlib
+import sys
 
-from eth2spec.utils import bls
+
+class _LazyBLS(object):
+    # Stands in for eth2spec.utils.bls until it is first used: importing it loads py_ecc, which takes
+    # most of the import time of this module, and e.g. block decoding workers never need it.
+
+    def __init__(self, module_name: str):
+        object.__setattr__(self, '_module_name', module_name)
+        object.__setattr__(self, '_module', None)
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            module = importlib.import_module(self._module_name)
+            object.__setattr__(self, '_module', module)
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        # e.g. bls.bls_active = False must reach the real module.
+        setattr(self._load(), name, value)
+
+
+bls = _LazyBLS('eth2spec.utils.bls')
 
 from hashlib import sha256
+from array import array
+import weakref
 
 from eth2spec.utils.ssz.ssz_impl import hash_tree_root
 from eth2spec.utils.ssz.ssz_typing import (
@@ -121,7 +148,11 @@ EPOCHS_PER_RANDOM_SUBNET_SUBSCRIPTION = 2**8
 SECONDS_PER_ETH1_BLOCK = 14
 
 
-apply_constants_config(globals())
+# A config can only have been prepared (prepare_config) if config_util is imported already.
+# Otherwise there is nothing to apply, and its YAML parser does not have to be imported.
+_config_util = sys.modules.get('eth2spec.config.config_util')
+if _config_util is not None:
+    _config_util.apply_constants_config(globals())
 
 
 class Fork(Container):
@@ -543,6 +574,22 @@ class ShufflingEpoch(object):
         unshuffle_list(shuffling, seed)
         self.shuffling = shuffling
 
+        self._slice_committees()
+
+    # Restore a shuffling that was computed before (e.g. loaded from a snapshot), without re-shuffling.
+    @classmethod
+    def from_shuffling(cls, epoch: Epoch,
+                       active_indices: Sequence[ValidatorIndex],
+                       shuffling: Sequence[ValidatorIndex]) -> "ShufflingEpoch":
+        assert len(active_indices) == len(shuffling)
+        out = cls.__new__(cls)
+        out.epoch = epoch
+        out.active_indices = active_indices
+        out.shuffling = shuffling
+        out._slice_committees()
+        return out
+
+    def _slice_committees(self):
         active_validator_count = len(self.active_indices)
         committees_per_slot = compute_committee_count(active_validator_count)
 
@@ -559,6 +606,68 @@ class ShufflingEpoch(object):
                            for slot in range(SLOTS_PER_EPOCH)]
 
 
+class ShufflingRegistry(object):
+    """
+    Process-wide dedup of shufflings. Forks that share the seed and active validator set of an epoch
+    get the same ShufflingEpoch object, instead of every EpochsContext computing and holding its own copy.
+
+    Entries are weak references: a shuffling is evicted when the last EpochsContext using it rotates it out
+    (or is dropped), so the registry never holds more shufflings than the tracked branches do.
+    """
+
+    def __init__(self):
+        self._shufflings: "weakref.WeakValueDictionary[Tuple[Epoch, bytes, bytes], ShufflingEpoch]" = \
+            weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._shufflings)
+
+    @staticmethod
+    def _key(epoch: Epoch, seed: Bytes32, active_indices: Sequence[ValidatorIndex]) -> Tuple[Epoch, bytes, bytes]:
+        # The seed and the active set fully determine the shuffling. The digest is only used within this process.
+        return Epoch(epoch), bytes(seed), sha256(array('Q', active_indices).tobytes()).digest()
+
+    def get_shuffling(self, state: BeaconState,
+                      indices_bounded: Sequence[Tuple[ValidatorIndex, Epoch, Epoch]],
+                      epoch: Epoch) -> ShufflingEpoch:
+        seed = get_seed(state, epoch, DOMAIN_BEACON_ATTESTER)
+        active_indices = [index for (index, activation_epoch, exit_epoch) in indices_bounded
+                          if activation_epoch <= epoch < exit_epoch]
+        key = self._key(epoch, seed, active_indices)
+        shuffling_epoch = self._shufflings.get(key)
+        if shuffling_epoch is not None:
+            self.hits += 1
+            return shuffling_epoch
+        self.misses += 1
+        shuffling = list(active_indices)  # copy
+        unshuffle_list(shuffling, seed)
+        shuffling_epoch = ShufflingEpoch.from_shuffling(epoch, active_indices, shuffling)
+        self._shufflings[key] = shuffling_epoch
+        return shuffling_epoch
+
+    def register(self, state: BeaconState, shuffling_epoch: ShufflingEpoch) -> ShufflingEpoch:
+        """
+        Register a shuffling that was not computed here (e.g. restored from a snapshot of ``state``).
+        Returns the registered shuffling with the same key if there is one, else ``shuffling_epoch``.
+        """
+        seed = get_seed(state, shuffling_epoch.epoch, DOMAIN_BEACON_ATTESTER)
+        key = self._key(shuffling_epoch.epoch, seed, shuffling_epoch.active_indices)
+        existing = self._shufflings.get(key)
+        if existing is not None:
+            self.hits += 1
+            return existing
+        self._shufflings[key] = shuffling_epoch
+        return shuffling_epoch
+
+    def clear(self):
+        self._shufflings.clear()
+
+
+shuffling_registry = ShufflingRegistry()
+
+
 def compute_proposer_index(state: BeaconState, indices: Sequence[ValidatorIndex], seed: Bytes32) -> ValidatorIndex:
     """
     Return from ``indices`` a random index sampled by effective balance.
@@ -600,12 +709,12 @@ class EpochsContext(object):
         indices_bounded = [(ValidatorIndex(i), v.activation_epoch, v.exit_epoch)
                            for i, v in enumerate(state.validators.readonly_iter())]
 
-        self.current_shuffling = ShufflingEpoch(state, indices_bounded, current_epoch)
+        self.current_shuffling = shuffling_registry.get_shuffling(state, indices_bounded, current_epoch)
         if previous_epoch == current_epoch:  # In case of genesis
             self.previous_shuffling = self.current_shuffling
         else:
-            self.previous_shuffling = ShufflingEpoch(state, indices_bounded, previous_epoch)
-        self.next_shuffling = ShufflingEpoch(state, indices_bounded, next_epoch)
+            self.previous_shuffling = shuffling_registry.get_shuffling(state, indices_bounded, previous_epoch)
+        self.next_shuffling = shuffling_registry.get_shuffling(state, indices_bounded, next_epoch)
         self._reset_proposers(state)
 
     def _reset_proposers(self, state: BeaconState):
@@ -648,7 +757,7 @@ class EpochsContext(object):
         next_epoch = Epoch(self.current_shuffling.epoch + 1)
         indices_bounded = [(ValidatorIndex(i), v.activation_epoch, v.exit_epoch)
                            for i, v in enumerate(state.validators.readonly_iter())]
-        self.next_shuffling = ShufflingEpoch(state, indices_bounded, next_epoch)
+        self.next_shuffling = shuffling_registry.get_shuffling(state, indices_bounded, next_epoch)
         self._reset_proposers(state)
 
     def _get_slot_comms(self, slot: Slot) -> SlotCommittees:
@@ -892,6 +1001,24 @@ def prepare_epoch_process_state(epochs_ctx: EpochsContext, state: BeaconState) -
 
     out.total_active_stake = Gwei(total_active_stake)
     out.total_active_unslashed_stake = Gwei(total_active_unslashed_stake)
+    out.active_validators = active_count
+
+    exit_queue_end_churn = uint64(0)
+    for status in out.statuses:
+        if status.validator.exit_epoch == exit_queue_end:
+            exit_queue_end_churn += 1
+
+    finish_epoch_process_state(epochs_ctx, state, out, exit_queue_end, exit_queue_end_churn)
+    return out
+
+
+# Completes the per-validator part of prepare_epoch_process_state (statuses, stake totals, candidate lists),
+# with the churn, activation queue order and attestation participation.
+# Shared by alternative implementations of the per-validator part (see parallel_epoch.py).
+def finish_epoch_process_state(epochs_ctx: EpochsContext, state: BeaconState, out: EpochProcess,
+                               exit_queue_end: Epoch, exit_queue_end_churn: int) -> None:
+    current_epoch = out.current_epoch
+    prev_epoch = out.prev_epoch
 
     if out.total_active_stake < EFFECTIVE_BALANCE_INCREMENT:
         out.total_active_stake = EFFECTIVE_BALANCE_INCREMENT
@@ -900,12 +1027,7 @@ def prepare_epoch_process_state(epochs_ctx: EpochsContext, state: BeaconState) -
     out.indices_to_maybe_activate = sorted(out.indices_to_maybe_activate,
                                            key=lambda i: (out.statuses[i].validator.activation_eligibility_epoch, i))
 
-    exit_queue_end_churn = uint64(0)
-    for status in out.statuses:
-        if status.validator.exit_epoch == exit_queue_end:
-            exit_queue_end_churn += 1
-    
-    churn_limit = get_churn_limit(active_count)
+    churn_limit = get_churn_limit(out.active_validators)
     if exit_queue_end_churn >= churn_limit:
         exit_queue_end += 1
         exit_queue_end_churn = 0
@@ -977,7 +1099,6 @@ def prepare_epoch_process_state(epochs_ctx: EpochsContext, state: BeaconState) -
     status_process_epoch(out.statuses, state.current_epoch_attestations.readonly_iter(),
                          out.curr_epoch_stake, current_epoch,
                          FLAG_CURR_SOURCE_ATTESTER, FLAG_CURR_TARGET_ATTESTER, FLAG_CURR_HEAD_ATTESTER)
-    return out
 
 
 def get_randao_mix(state: BeaconState, epoch: Epoch) -> Bytes32:
@@ -1058,7 +1179,37 @@ def process_justification_and_finalization(epochs_ctx: EpochsContext, process: E
         state.finalized_checkpoint = old_current_justified_checkpoint
 
 
-def get_attestation_deltas(epochs_ctx: EpochsContext, process: EpochProcess, state: BeaconState) -> Tuple[Sequence[Gwei], Sequence[Gwei]]:
+class AttestationDeltasDetail(object):
+    """
+    Optional output of get_attestation_deltas: every reward and penalty component per validator,
+    as one uint64 array per component (index = validator index). See deltas_export.py.
+    """
+
+    COLUMNS = (
+        'source_reward', 'source_penalty',
+        'target_reward', 'target_penalty',
+        'head_reward', 'head_penalty',
+        'inclusion_reward',  # inclusion speed bonus of the attester
+        'proposer_reward',  # rewards for including attestations, as proposer
+        'inactivity_penalty',  # base rewards and leak penalty while not finalizing
+    )
+
+    epoch: Epoch  # the epoch the attestations are for
+    validator_count: int
+
+    def __init__(self, epoch: Epoch, validator_count: int):
+        self.epoch = epoch
+        self.validator_count = validator_count
+        zeros = bytes(8 * validator_count)
+        for name in self.COLUMNS:
+            setattr(self, name, array('Q', zeros))
+
+    def columns(self) -> Dict[str, array]:
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+
+def get_attestation_deltas(epochs_ctx: EpochsContext, process: EpochProcess, state: BeaconState,
+                           detail: Optional[AttestationDeltasDetail] = None) -> Tuple[Sequence[Gwei], Sequence[Gwei]]:
     validator_count = len(process.statuses)
     rewards = [0 for _ in range(validator_count)]
     penalties = [0 for _ in range(validator_count)]
@@ -1084,6 +1235,9 @@ def get_attestation_deltas(epochs_ctx: EpochsContext, process: EpochProcess, sta
     balance_sq_root = integer_squareroot(total_balance)
     finality_delay = process.prev_epoch - state.finalized_checkpoint.epoch
 
+    # The components are only recorded if asked for, in the same pass.
+    record = detail is not None
+
     for i, status in enumerate(process.statuses):
         if status.flags & FLAG_ELIGIBLE_ATTESTER != 0:
 
@@ -1093,47 +1247,69 @@ def get_attestation_deltas(epochs_ctx: EpochsContext, process: EpochProcess, sta
             # Expected FFG source
             if has_markers(status.flags, FLAG_PREV_SOURCE_ATTESTER | FLAG_UNSLASHED):
                 # Justification-participation reward
-                rewards[i] += base_reward * prev_epoch_source_stake // total_balance
+                source_reward = base_reward * prev_epoch_source_stake // total_balance
+                rewards[i] += source_reward
 
                 # Inclusion speed bonus
                 proposer_reward = base_reward // PROPOSER_REWARD_QUOTIENT
                 rewards[status.proposer_index] += proposer_reward
                 max_attester_reward = base_reward - proposer_reward
-                rewards[i] += max_attester_reward // status.inclusion_delay
+                inclusion_reward = max_attester_reward // status.inclusion_delay
+                rewards[i] += inclusion_reward
+                if record:
+                    detail.source_reward[i] = source_reward
+                    detail.inclusion_reward[i] = inclusion_reward
+                    detail.proposer_reward[status.proposer_index] += proposer_reward
             else:
                 # Justification-non-participation R-penalty
                 penalties[i] += base_reward
+                if record:
+                    detail.source_penalty[i] = base_reward
 
             # Expected FFG target
             if has_markers(status.flags, FLAG_PREV_TARGET_ATTESTER | FLAG_UNSLASHED):
                 # Boundary-attestation reward
-                rewards[i] += base_reward * prev_epoch_target_stake // total_balance
+                target_reward = base_reward * prev_epoch_target_stake // total_balance
+                rewards[i] += target_reward
+                if record:
+                    detail.target_reward[i] = target_reward
             else:
                 # Boundary-attestation-non-participation R-penalty
                 penalties[i] += base_reward
+                if record:
+                    detail.target_penalty[i] = base_reward
 
             # Expected head
             if has_markers(status.flags, FLAG_PREV_HEAD_ATTESTER | FLAG_UNSLASHED):
                 # Canonical-participation reward
-                rewards[i] += base_reward * prev_epoch_head_stake // total_balance
+                head_reward = base_reward * prev_epoch_head_stake // total_balance
+                rewards[i] += head_reward
+                if record:
+                    detail.head_reward[i] = head_reward
             else:
                 # Non-canonical-participation R-penalty
                 penalties[i] += base_reward
+                if record:
+                    detail.head_penalty[i] = base_reward
 
             # Take away max rewards if we're not finalizing
             if finality_delay > MIN_EPOCHS_TO_INACTIVITY_PENALTY:
-                penalties[i] += base_reward * BASE_REWARDS_PER_EPOCH
+                inactivity_penalty = base_reward * BASE_REWARDS_PER_EPOCH
                 if not has_markers(status.flags, FLAG_PREV_HEAD_ATTESTER | FLAG_UNSLASHED):
-                    penalties[i] += eff_balance * finality_delay // INACTIVITY_PENALTY_QUOTIENT
+                    inactivity_penalty += eff_balance * finality_delay // INACTIVITY_PENALTY_QUOTIENT
+                penalties[i] += inactivity_penalty
+                if record:
+                    detail.inactivity_penalty[i] = inactivity_penalty
 
     return list(map(Gwei, rewards)), list(map(Gwei, penalties))
 
 
-def process_rewards_and_penalties(epochs_ctx: EpochsContext, process: EpochProcess, state: BeaconState) -> None:
+def process_rewards_and_penalties(epochs_ctx: EpochsContext, process: EpochProcess, state: BeaconState,
+                                  detail: Optional[AttestationDeltasDetail] = None) -> None:
     if process.current_epoch == GENESIS_EPOCH:
         return
 
-    rewards, penalties = get_attestation_deltas(epochs_ctx, process, state)
+    rewards, penalties = get_attestation_deltas(epochs_ctx, process, state, detail)
     new_balances = list(map(int, state.balances.readonly_iter()))
 
     for i, reward in enumerate(rewards):
@@ -1242,13 +1418,15 @@ def process_block_header(epochs_ctx: EpochsContext, state: BeaconState, block: B
     assert not proposer.slashed
 
 
-def process_randao(epochs_ctx: EpochsContext, state: BeaconState, body: BeaconBlockBody) -> None:
+def process_randao(epochs_ctx: EpochsContext, state: BeaconState, body: BeaconBlockBody,
+                   verify_signatures: bool = True) -> None:
     epoch = epochs_ctx.current_shuffling.epoch
     # Verify RANDAO reveal
-    proposer_index = epochs_ctx.get_beacon_proposer(state.slot)
-    proposer_pubkey = epochs_ctx.index2pubkey[proposer_index]
-    signing_root = compute_signing_root(epoch, get_domain(state, DOMAIN_RANDAO))
-    assert bls.Verify(proposer_pubkey, signing_root, body.randao_reveal)
+    if verify_signatures:
+        proposer_index = epochs_ctx.get_beacon_proposer(state.slot)
+        proposer_pubkey = epochs_ctx.index2pubkey[proposer_index]
+        signing_root = compute_signing_root(epoch, get_domain(state, DOMAIN_RANDAO))
+        assert bls.Verify(proposer_pubkey, signing_root, body.randao_reveal)
     # Mix in RANDAO reveal
     mix = xor(get_randao_mix(state, epoch), hash(body.randao_reveal))
     state.randao_mixes[epoch % EPOCHS_PER_HISTORICAL_VECTOR] = mix
@@ -1263,20 +1441,23 @@ def process_eth1_data(epochs_ctx: EpochsContext, state: BeaconState, body: Beaco
         state.eth1_data = new_eth1_data
 
 
-def process_operations(epochs_ctx: EpochsContext, state: BeaconState, body: BeaconBlockBody) -> None:
+def process_operations(epochs_ctx: EpochsContext, state: BeaconState, body: BeaconBlockBody,
+                       verify_signatures: bool = True) -> None:
     # Verify that outstanding deposits are processed up to the maximum number of deposits
     assert len(body.deposits) == min(MAX_DEPOSITS, state.eth1_data.deposit_count - state.eth1_deposit_index)
 
-    for operations, function in (
-            (body.proposer_slashings, process_proposer_slashing),
-            (body.attester_slashings, process_attester_slashing),
-            (body.attestations, process_attestation),
-            (body.deposits, process_deposit),
-            (body.voluntary_exits, process_voluntary_exit),
+    # Deposit signatures are always checked: an invalid one does not fail the block, it skips the deposit.
+    verify = dict(verify_signatures=verify_signatures)
+    for operations, function, kwargs in (
+            (body.proposer_slashings, process_proposer_slashing, verify),
+            (body.attester_slashings, process_attester_slashing, verify),
+            (body.attestations, process_attestation, verify),
+            (body.deposits, process_deposit, {}),
+            (body.voluntary_exits, process_voluntary_exit, verify),
             # @process_shard_receipt_proofs
     ):
         for operation in operations.readonly_iter():
-            function(epochs_ctx, state, operation)
+            function(epochs_ctx, state, operation, **kwargs)
 
 
 def is_slashable_validator(validator: Validator, epoch: Epoch) -> bool:
@@ -1345,7 +1526,8 @@ def slash_validator(epochs_ctx: EpochsContext, state: BeaconState,
     increase_balance(state, whistleblower_index, whistleblower_reward - proposer_reward)
 
 
-def process_proposer_slashing(epochs_ctx: EpochsContext, state: BeaconState, proposer_slashing: ProposerSlashing) -> None:
+def process_proposer_slashing(epochs_ctx: EpochsContext, state: BeaconState, proposer_slashing: ProposerSlashing,
+                              verify_signatures: bool = True) -> None:
     # Verify header slots match
     assert proposer_slashing.signed_header_1.message.slot == proposer_slashing.signed_header_2.message.slot
     # Verify the headers are different
@@ -1355,6 +1537,8 @@ def process_proposer_slashing(epochs_ctx: EpochsContext, state: BeaconState, pro
     assert is_slashable_validator(proposer, epochs_ctx.current_shuffling.epoch)
     # Verify signatures
     for signed_header in (proposer_slashing.signed_header_1, proposer_slashing.signed_header_2):
+        if not verify_signatures:
+            break
         domain = get_domain(state, DOMAIN_BEACON_PROPOSER, compute_epoch_at_slot(signed_header.message.slot))
         signing_root = compute_signing_root(signed_header.message, domain)
         assert bls.Verify(proposer.pubkey, signing_root, signed_header.signature)
@@ -1362,12 +1546,13 @@ def process_proposer_slashing(epochs_ctx: EpochsContext, state: BeaconState, pro
     slash_validator(epochs_ctx, state, proposer_slashing.proposer_index)
 
 
-def process_attester_slashing(epochs_ctx: EpochsContext, state: BeaconState, attester_slashing: AttesterSlashing) -> None:
+def process_attester_slashing(epochs_ctx: EpochsContext, state: BeaconState, attester_slashing: AttesterSlashing,
+                              verify_signatures: bool = True) -> None:
     attestation_1 = attester_slashing.attestation_1
     attestation_2 = attester_slashing.attestation_2
     assert is_slashable_attestation_data(attestation_1.data, attestation_2.data)
-    assert is_valid_indexed_attestation(epochs_ctx, state, attestation_1)
-    assert is_valid_indexed_attestation(epochs_ctx, state, attestation_2)
+    assert is_valid_indexed_attestation(epochs_ctx, state, attestation_1, verify_signatures)
+    assert is_valid_indexed_attestation(epochs_ctx, state, attestation_2, verify_signatures)
 
     slashed_any = False
     att_set_1 = set(attestation_1.attesting_indices.readonly_iter())
@@ -1380,7 +1565,8 @@ def process_attester_slashing(epochs_ctx: EpochsContext, state: BeaconState, att
     assert slashed_any
 
 
-def is_valid_indexed_attestation(epochs_ctx: EpochsContext, state: BeaconState, indexed_attestation: IndexedAttestation) -> bool:
+def is_valid_indexed_attestation(epochs_ctx: EpochsContext, state: BeaconState, indexed_attestation: IndexedAttestation,
+                                 verify_signature: bool = True) -> bool:
     """
     Check if ``indexed_attestation`` has valid indices and signature.
     """
@@ -1393,13 +1579,16 @@ def is_valid_indexed_attestation(epochs_ctx: EpochsContext, state: BeaconState,
     if not indices == sorted(set(indices)):
         return False
     # Verify aggregate signature
+    if not verify_signature:
+        return True
     pubkeys = [epochs_ctx.index2pubkey[i] for i in indices]
     domain = get_domain(state, DOMAIN_BEACON_ATTESTER, indexed_attestation.data.target.epoch)  # TODO maybe optimize get_domain?
     signing_root = compute_signing_root(indexed_attestation.data, domain)
     return bls.FastAggregateVerify(pubkeys, signing_root, indexed_attestation.signature)
 
 
-def process_attestation(epochs_ctx: EpochsContext, state: BeaconState, attestation: Attestation) -> None:
+def process_attestation(epochs_ctx: EpochsContext, state: BeaconState, attestation: Attestation,
+                        verify_signatures: bool = True) -> None:
     slot = state.slot
     data = attestation.data
     assert data.index < epochs_ctx.get_committee_count_at_slot(data.slot)
@@ -1437,7 +1626,7 @@ def process_attestation(epochs_ctx: EpochsContext, state: BeaconState, attestati
         )
 
     # Verify signature
-    assert is_valid_indexed_attestation(epochs_ctx, state, get_indexed_attestation(attestation))
+    assert is_valid_indexed_attestation(epochs_ctx, state, get_indexed_attestation(attestation), verify_signatures)
 
 
 def is_valid_merkle_branch(leaf: Bytes32, branch: Sequence[Bytes32], depth: uint64, index: uint64, root: Root) -> bool:
@@ -1499,7 +1688,8 @@ def process_deposit(epochs_ctx: EpochsContext, state: BeaconState, deposit: Depo
     epochs_ctx.sync_pubkeys(state)
 
 
-def process_voluntary_exit(epochs_ctx: EpochsContext, state: BeaconState, signed_voluntary_exit: SignedVoluntaryExit) -> None:
+def process_voluntary_exit(epochs_ctx: EpochsContext, state: BeaconState, signed_voluntary_exit: SignedVoluntaryExit,
+                           verify_signatures: bool = True) -> None:
     voluntary_exit = signed_voluntary_exit.message
     validator = state.validators[voluntary_exit.validator_index]
     current_epoch = epochs_ctx.current_shuffling.epoch
@@ -1512,9 +1702,10 @@ def process_voluntary_exit(epochs_ctx: EpochsContext, state: BeaconState, signed
     # Verify the validator has been active long enough
     assert current_epoch >= validator.activation_epoch + PERSISTENT_COMMITTEE_PERIOD
     # Verify signature
-    domain = get_domain(state, DOMAIN_VOLUNTARY_EXIT, voluntary_exit.epoch)
-    signing_root = compute_signing_root(voluntary_exit, domain)
-    assert bls.Verify(validator.pubkey, signing_root, signed_voluntary_exit.signature)
+    if verify_signatures:
+        domain = get_domain(state, DOMAIN_VOLUNTARY_EXIT, voluntary_exit.epoch)
+        signing_root = compute_signing_root(voluntary_exit, domain)
+        assert bls.Verify(validator.pubkey, signing_root, signed_voluntary_exit.signature)
     # Initiate exit
     # TODO could be optimized, but happens too rarely
     initiate_validator_exit(epochs_ctx, state, voluntary_exit.validator_index)
@@ -1532,33 +1723,73 @@ def process_slot(epochs_ctx: EpochsContext, state: BeaconState) -> None:
     state.block_roots[state.slot % SLOTS_PER_HISTORICAL_ROOT] = previous_block_root
 
 
-def process_slots(epochs_ctx: EpochsContext, state: BeaconState, slot: Slot) -> None:
+class EpochObserver(object):
+    """
+    Observes the epoch transitions of one process_slots / state_transition call, it is passed in by the caller
+    that owns the transition. The methods do nothing here, subclasses override what they need.
+    An exception raised by a method aborts the transition, the state is then left half-way.
+    """
+
+    def before_step(self, step: str) -> None:
+        # Called before every step of process_epoch, and before the rotation of the EpochsContext after it.
+        pass
+
+    def attestation_deltas_detail(self, process: EpochProcess) -> Optional[AttestationDeltasDetail]:
+        # A detail to record the reward and penalty components in, if wanted. Not called in the genesis epoch.
+        return None
+
+    def after_epoch(self, process: EpochProcess, state: BeaconState) -> None:
+        # Called after process_epoch. The state may be advanced further by the time this is called
+        # (see epoch_precompute.py), only its history (e.g. block roots) is meant to be read.
+        pass
+
+
+_NO_OBSERVER = EpochObserver()
+
+
+def process_slots(epochs_ctx: EpochsContext, state: BeaconState, slot: Slot,
+                  observer: Optional[EpochObserver] = None) -> None:
     assert state.slot <= slot
     while state.slot < slot:
         process_slot(epochs_ctx, state)
         # Process epoch on the start slot of the next epoch
         if (state.slot + 1) % SLOTS_PER_EPOCH == 0:
-            process_epoch(epochs_ctx, state)
+            process_epoch(epochs_ctx, state, observer)
             state.slot += 1
+            if observer is not None:
+                observer.before_step('rotate_epochs')
             epochs_ctx.rotate_epochs(state)
         else:
             state.slot += 1
 
 
-def process_epoch(epochs_ctx: EpochsContext, state: BeaconState) -> None:
+def process_epoch(epochs_ctx: EpochsContext, state: BeaconState, observer: Optional[EpochObserver] = None) -> None:
+    if observer is None:
+        observer = _NO_OBSERVER
+    observer.before_step('prepare_epoch_process_state')
     process = prepare_epoch_process_state(epochs_ctx, state)
+    observer.before_step('process_justification_and_finalization')
     process_justification_and_finalization(epochs_ctx, process, state)
-    process_rewards_and_penalties(epochs_ctx, process, state)
+    observer.before_step('process_rewards_and_penalties')
+    detail = observer.attestation_deltas_detail(process) if process.current_epoch != GENESIS_EPOCH else None
+    process_rewards_and_penalties(epochs_ctx, process, state, detail)
+    observer.before_step('process_registry_updates')
     process_registry_updates(epochs_ctx, process, state)
+    observer.before_step('process_slashings')
     process_slashings(epochs_ctx, process, state)
+    observer.before_step('process_final_updates')
     process_final_updates(epochs_ctx, process, state)
+    observer.after_epoch(process, state)
 
 
-def process_block(epochs_ctx: EpochsContext, state: BeaconState, block: BeaconBlock) -> None:
+def process_block(epochs_ctx: EpochsContext, state: BeaconState, block: BeaconBlock,
+                  verify_signatures: bool = True) -> None:
+    # verify_signatures=False skips the randao reveal and operation signatures, for blocks built from
+    # operations that were verified before. Deposit proofs of possession are still checked.
     process_block_header(epochs_ctx, state, block)
-    process_randao(epochs_ctx, state, block.body)
+    process_randao(epochs_ctx, state, block.body, verify_signatures)
     process_eth1_data(epochs_ctx, state, block.body)
-    process_operations(epochs_ctx, state, block.body)
+    process_operations(epochs_ctx, state, block.body, verify_signatures)
 
 
 def verify_block_signature(epochs_ctx: EpochsContext, state: BeaconState, signed_block: SignedBeaconBlock) -> bool:
@@ -1569,10 +1800,11 @@ def verify_block_signature(epochs_ctx: EpochsContext, state: BeaconState, signed
 
 
 def state_transition(epochs_ctx: EpochsContext, state: BeaconState,
-                     signed_block: SignedBeaconBlock, validate_result: bool = True) -> BeaconState:
+                     signed_block: SignedBeaconBlock, validate_result: bool = True,
+                     observer: Optional[EpochObserver] = None) -> BeaconState:
     block = signed_block.message
     # Process slots (including those with no blocks) since block
-    process_slots(epochs_ctx, state, block.slot)
+    process_slots(epochs_ctx, state, block.slot, observer)
     # Verify signature
     if validate_result:
         assert verify_block_signature(epochs_ctx, state, signed_block), "invalid block signature"
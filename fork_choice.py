@@ -0,0 +1,366 @@
+from typing import Dict, List as PyList, Optional, Sequence, Tuple
+
+from fastspec import (
+    BeaconState, BeaconBlock, EpochsContext, EpochObserver, EpochProcess, FlatValidator, Attestation, Checkpoint,
+    Epoch, Gwei, Root, Slot, ValidatorIndex, FLAG_UNSLASHED,
+    compute_epoch_at_slot, get_block_root,
+)
+
+# LMD-GHOST fork choice on a proto-array (as in Lighthouse / Prysm):
+#
+# Blocks are appended to a flat array, and every block comes after its parent. Each node caches its weight,
+# its best child and its best descendant. Votes are not applied one by one: get_head turns the changed votes
+# and balances into a delta per node, and a single backwards pass over the array adds every delta to its node,
+# passes it on to the parent, and updates the best child/descendant links on the way.
+# Finding the head is then a lookup of the best descendant of the justified block.
+#
+# Nodes before the finalized block are pruned once there are enough of them, which keeps the array bounded.
+#
+# Votes are weighted with the balances of the justified checkpoint state. These are recorded by CheckpointBalances,
+# an EpochObserver the import path passes to state_transition, and taken over when the justified checkpoint advances.
+
+DEFAULT_PRUNE_THRESHOLD = 256
+
+
+class ForkChoiceError(Exception):
+    pass
+
+
+class ProtoNode(object):
+
+    __slots__ = 'slot', 'root', 'parent', 'justified_epoch', 'finalized_epoch', 'weight', 'best_child', \
+        'best_descendant'
+
+    slot: Slot
+    root: Root
+    parent: Optional[int]
+    justified_epoch: Epoch
+    finalized_epoch: Epoch
+    weight: int
+    best_child: Optional[int]
+    best_descendant: Optional[int]
+
+    def __init__(self, slot: Slot, root: Root, parent: Optional[int], justified_epoch: Epoch, finalized_epoch: Epoch):
+        self.slot = slot
+        self.root = root
+        self.parent = parent
+        self.justified_epoch = justified_epoch
+        self.finalized_epoch = finalized_epoch
+        self.weight = 0
+        self.best_child = None
+        self.best_descendant = None
+
+
+class ProtoArray(object):
+    justified_epoch: Epoch
+    finalized_epoch: Epoch
+    prune_threshold: int
+    nodes: PyList[ProtoNode]
+    indices: Dict[Root, int]
+
+    def __init__(self, justified_epoch: Epoch, finalized_epoch: Epoch, prune_threshold: int = DEFAULT_PRUNE_THRESHOLD):
+        self.justified_epoch = justified_epoch
+        self.finalized_epoch = finalized_epoch
+        self.prune_threshold = prune_threshold
+        self.nodes = []
+        self.indices = {}
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __contains__(self, root: Root) -> bool:
+        return root in self.indices
+
+    def on_block(self, slot: Slot, root: Root, parent_root: Optional[Root],
+                 justified_epoch: Epoch, finalized_epoch: Epoch):
+        if root in self.indices:
+            return
+        index = len(self.nodes)
+        parent = self.indices.get(parent_root) if parent_root is not None else None
+        self.indices[root] = index
+        self.nodes.append(ProtoNode(slot, root, parent, justified_epoch, finalized_epoch))
+        if parent is not None:
+            self._maybe_update_best_child_and_descendant(parent, index)
+
+    def apply_score_changes(self, deltas: PyList[int], justified_epoch: Epoch, finalized_epoch: Epoch):
+        """
+        Apply a weight delta per node (``deltas`` is modified), and update the best child/descendant links.
+        One pass, from the leaves back to the root: children always come after their parent.
+        """
+        nodes = self.nodes
+        if len(deltas) != len(nodes):
+            raise ForkChoiceError(f"got {len(deltas)} deltas for {len(nodes)} nodes")
+        self.justified_epoch = justified_epoch
+        self.finalized_epoch = finalized_epoch
+
+        for index in range(len(nodes) - 1, -1, -1):
+            node = nodes[index]
+            delta = deltas[index]
+            if delta != 0:
+                node.weight += delta
+                if node.weight < 0:
+                    raise ForkChoiceError(f"negative weight of node {node.root.hex()}")
+            if node.parent is not None:
+                deltas[node.parent] += delta
+                self._maybe_update_best_child_and_descendant(node.parent, index)
+
+    def find_head(self, justified_root: Root) -> Root:
+        justified_index = self.indices.get(justified_root)
+        if justified_index is None:
+            raise ForkChoiceError(f"justified root {justified_root.hex()} is not known")
+        justified_node = self.nodes[justified_index]
+        best_index = justified_node.best_descendant if justified_node.best_descendant is not None else justified_index
+        best_node = self.nodes[best_index]
+        if not self._viable_for_head(best_node):
+            raise ForkChoiceError(f"best node {best_node.root.hex()} is not viable for head, "
+                                  f"justified epoch {self.justified_epoch}, finalized epoch {self.finalized_epoch}")
+        return best_node.root
+
+    def maybe_prune(self, finalized_root: Root) -> int:
+        """
+        Drop all nodes before the finalized node, once there are at least ``prune_threshold`` of them.
+        Nodes that do not descend from the finalized node are dropped with them, or are unreachable
+        from it anyway. Returns the number of dropped nodes.
+        """
+        finalized_index = self.indices.get(finalized_root)
+        if finalized_index is None:
+            raise ForkChoiceError(f"finalized root {finalized_root.hex()} is not known")
+        if finalized_index < self.prune_threshold:
+            return 0
+
+        for node in self.nodes[:finalized_index]:
+            del self.indices[node.root]
+        self.nodes = self.nodes[finalized_index:]
+        for root, index in self.indices.items():
+            self.indices[root] = index - finalized_index
+
+        def shift(index: Optional[int]) -> Optional[int]:
+            if index is None or index < finalized_index:
+                return None
+            return index - finalized_index
+
+        for node in self.nodes:
+            node.parent = shift(node.parent)
+            node.best_child = shift(node.best_child)
+            node.best_descendant = shift(node.best_descendant)
+        return finalized_index
+
+    def _viable_for_head(self, node: ProtoNode) -> bool:
+        # A zero epoch means there was no justification/finality yet, anything goes.
+        return ((node.justified_epoch == self.justified_epoch or self.justified_epoch == 0)
+                and (node.finalized_epoch == self.finalized_epoch or self.finalized_epoch == 0))
+
+    def _leads_to_viable_head(self, node: ProtoNode) -> bool:
+        if node.best_descendant is not None and self._viable_for_head(self.nodes[node.best_descendant]):
+            return True
+        return self._viable_for_head(node)
+
+    def _maybe_update_best_child_and_descendant(self, parent_index: int, child_index: int):
+        nodes = self.nodes
+        parent = nodes[parent_index]
+        child = nodes[child_index]
+        child_leads_to_viable_head = self._leads_to_viable_head(child)
+        child_best_descendant = child.best_descendant if child.best_descendant is not None else child_index
+
+        if parent.best_child == child_index:
+            if not child_leads_to_viable_head:
+                # The child is not viable anymore, the next best child is found when the other children pass by.
+                parent.best_child = None
+                parent.best_descendant = None
+            else:
+                parent.best_descendant = child_best_descendant
+            return
+
+        if parent.best_child is None:
+            if child_leads_to_viable_head:
+                parent.best_child = child_index
+                parent.best_descendant = child_best_descendant
+            return
+
+        best_child = nodes[parent.best_child]
+        best_child_leads_to_viable_head = self._leads_to_viable_head(best_child)
+        if child_leads_to_viable_head and not best_child_leads_to_viable_head:
+            replace = True
+        elif not child_leads_to_viable_head:
+            replace = False
+        elif child.weight != best_child.weight:
+            replace = child.weight > best_child.weight
+        else:
+            # Tie-break by the lexicographically highest root, like the spec.
+            replace = child.root > best_child.root
+        if replace:
+            parent.best_child = child_index
+            parent.best_descendant = child_best_descendant
+
+
+def effective_balances(process: EpochProcess) -> PyList[Gwei]:
+    # Weight of every validator: the effective balance of active, unslashed validators.
+    return [s.validator.effective_balance if (s.active and s.flags & FLAG_UNSLASHED) else Gwei(0)
+            for s in process.statuses]
+
+
+def state_balances(state: BeaconState) -> PyList[Gwei]:
+    # Like effective_balances, for the current epoch of a state. Slow on big states, e.g. for the anchor only.
+    epoch = compute_epoch_at_slot(state.slot)
+    out = []
+    for tree_v in state.validators.readonly_iter():
+        v = FlatValidator(tree_v)
+        out.append(v.effective_balance if (v.activation_epoch <= epoch < v.exit_epoch and not v.slashed) else Gwei(0))
+    return out
+
+
+class CheckpointBalances(EpochObserver):
+    """
+    Records the balances of the checkpoint states (the states at the epoch starts) of imported blocks,
+    by (epoch, checkpoint root). Pass it to state_transition when importing a block.
+
+    The balances of epoch E are taken at the end of E, from the EpochProcess: effective balances and the active
+    set do not change within the epoch, so they are those of the checkpoint state of E.
+    An epoch transition can only justify the current or the previous epoch, older balances are dropped.
+    """
+
+    def __init__(self):
+        self._balances: Dict[Tuple[Epoch, bytes], PyList[Gwei]] = {}
+
+    def after_epoch(self, process: EpochProcess, state: BeaconState) -> None:
+        epoch = process.current_epoch
+        self._balances[(epoch, bytes(get_block_root(state, epoch)))] = effective_balances(process)
+        for key in [key for key in self._balances if key[0] + 1 < epoch]:
+            del self._balances[key]
+
+    def get(self, checkpoint: Checkpoint) -> Optional[PyList[Gwei]]:
+        return self._balances.get((checkpoint.epoch, bytes(checkpoint.root)))
+
+
+class ForkChoice(object):
+    """
+    Fork choice store around a ProtoArray:
+
+        fc = ForkChoice.from_anchor(anchor_state, anchor_block_root)
+        state_transition(epochs_ctx, state, signed_block, observer=fc.checkpoint_balances)
+        fc.on_block(signed_block.message, block_root, state)  # updates the checkpoints, and balances if justified
+        fc.on_attestation(epochs_ctx, attestation)
+        head = fc.get_head()
+
+    Votes are kept per validator: the latest target epoch, and the block root voted for in it.
+    The root a vote was last counted for is remembered, so get_head only has to move weight for changed votes.
+
+    If the balances of a new justified checkpoint were not recorded (its epoch transition was not observed),
+    the balances of the previous justified checkpoint stay in use.
+    """
+    justified_checkpoint: Checkpoint
+    finalized_checkpoint: Checkpoint
+    proto_array: ProtoArray
+    balances: PyList[int]  # of the justified checkpoint state
+    checkpoint_balances: CheckpointBalances
+
+    def __init__(self, anchor_root: Root, anchor_slot: Slot, justified_checkpoint: Checkpoint,
+                 finalized_checkpoint: Checkpoint, balances: Sequence[int] = (),
+                 prune_threshold: int = DEFAULT_PRUNE_THRESHOLD):
+        self.justified_checkpoint = justified_checkpoint
+        self.finalized_checkpoint = finalized_checkpoint
+        self.proto_array = ProtoArray(justified_checkpoint.epoch, finalized_checkpoint.epoch, prune_threshold)
+        self.proto_array.on_block(anchor_slot, anchor_root, None,
+                                  justified_checkpoint.epoch, finalized_checkpoint.epoch)
+        self.anchor_root = anchor_root
+        self.balances = list(balances)
+        self.checkpoint_balances = CheckpointBalances()
+        # Balances the current node weights were computed with
+        self._applied_balances: PyList[int] = []
+        # Per validator: root the vote is counted for, latest vote root, and the target epoch of the latest vote
+        self._current_roots: PyList[Optional[Root]] = []
+        self._next_roots: PyList[Optional[Root]] = []
+        self._next_epochs: PyList[int] = []
+
+    @classmethod
+    def from_anchor(cls, anchor_state: BeaconState, anchor_root: Root,
+                    prune_threshold: int = DEFAULT_PRUNE_THRESHOLD) -> "ForkChoice":
+        # At the anchor, the checkpoints may refer to blocks before it: the anchor stands in for them.
+        justified = Checkpoint(epoch=anchor_state.current_justified_checkpoint.epoch, root=anchor_root)
+        finalized = Checkpoint(epoch=anchor_state.finalized_checkpoint.epoch, root=anchor_root)
+        return cls(anchor_root, anchor_state.slot, justified, finalized, state_balances(anchor_state),
+                   prune_threshold=prune_threshold)
+
+    def on_block(self, block: BeaconBlock, block_root: Root, post_state: BeaconState):
+        if block.parent_root not in self.proto_array:
+            raise ForkChoiceError(f"parent {block.parent_root.hex()} of block {block_root.hex()} is not known")
+        justified = post_state.current_justified_checkpoint
+        finalized = post_state.finalized_checkpoint
+        self.proto_array.on_block(block.slot, block_root, block.parent_root, justified.epoch, finalized.epoch)
+        self.update_checkpoints(justified, finalized)
+
+    def update_checkpoints(self, justified: Checkpoint, finalized: Checkpoint):
+        if justified.epoch > self.justified_checkpoint.epoch and justified.root in self.proto_array:
+            self.justified_checkpoint = justified.copy()
+            balances = self.checkpoint_balances.get(justified)
+            if balances is not None:
+                self.balances = balances
+        if finalized.epoch > self.finalized_checkpoint.epoch and finalized.root in self.proto_array:
+            self.finalized_checkpoint = finalized.copy()
+
+    def _grow_votes(self, validator_count: int):
+        missing = validator_count - len(self._next_epochs)
+        if missing > 0:
+            self._current_roots.extend([None] * missing)
+            self._next_roots.extend([None] * missing)
+            self._next_epochs.extend([0] * missing)
+
+    def process_votes(self, validator_indices: Sequence[ValidatorIndex], block_root: Root, target_epoch: Epoch):
+        # Latest message per validator: only a vote of a later target epoch replaces the previous vote.
+        if validator_indices:
+            self._grow_votes(max(validator_indices) + 1)
+        next_roots = self._next_roots
+        next_epochs = self._next_epochs
+        for i in validator_indices:
+            if target_epoch > next_epochs[i] or next_roots[i] is None:
+                next_roots[i] = block_root
+                next_epochs[i] = target_epoch
+
+    def on_attestation(self, epochs_ctx: EpochsContext, attestation: Attestation):
+        # The attestation is assumed to be valid, e.g. included in a block, or checked by gossip validation.
+        data = attestation.data
+        committee = epochs_ctx.get_beacon_committee(data.slot, data.index)
+        bits = attestation.aggregation_bits
+        self.process_votes([index for i, index in enumerate(committee) if bits[i]],
+                           data.beacon_block_root, data.target.epoch)
+
+    def _compute_deltas(self) -> PyList[int]:
+        indices = self.proto_array.indices
+        deltas = [0] * len(self.proto_array)
+        old_balances = self._applied_balances
+        new_balances = self.balances
+        current_roots = self._current_roots
+        next_roots = self._next_roots
+        for i in range(len(next_roots)):
+            current_root = current_roots[i]
+            next_root = next_roots[i]
+            old_balance = old_balances[i] if i < len(old_balances) else 0
+            new_balance = new_balances[i] if i < len(new_balances) else 0
+            if current_root == next_root and old_balance == new_balance:
+                continue
+            # Votes for unknown (or pruned) blocks carry no weight.
+            if current_root is not None:
+                current_index = indices.get(current_root)
+                if current_index is not None:
+                    deltas[current_index] -= old_balance
+            applied_root = None
+            if next_root is not None:
+                next_index = indices.get(next_root)
+                if next_index is not None:
+                    deltas[next_index] += new_balance
+                    applied_root = next_root
+            # Only a vote that was counted is remembered as counted: a vote for a block that is not imported yet
+            # is counted (and then taken off again when the vote changes) once the block is known.
+            current_roots[i] = applied_root
+        self._applied_balances = list(new_balances)
+        return deltas
+
+    def get_head(self) -> Root:
+        deltas = self._compute_deltas()
+        self.proto_array.apply_score_changes(deltas, self.justified_checkpoint.epoch, self.finalized_checkpoint.epoch)
+        self.prune()
+        return self.proto_array.find_head(self.justified_checkpoint.root)
+
+    def prune(self) -> int:
+        return self.proto_array.maybe_prune(self.finalized_checkpoint.root)
+
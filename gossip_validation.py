@@ -0,0 +1,197 @@
+from typing import Callable, Dict, List as PyList, Optional, Sequence, Set, Tuple
+
+from fastspec import (
+    EpochsContext, Attestation, Fork, BLSPubkey, Domain, Epoch, Root, SigningRoot, Slot, ValidatorIndex,
+    DOMAIN_BEACON_ATTESTER,
+    bls, compute_domain, compute_epoch_at_slot, hash_tree_root,
+)
+from attestation_pool import bits_to_int, popcount
+
+# Gossip validation of unaggregated attestations (the beacon_attestation_{subnet_id} topics),
+# with only the EpochsContext: committees come from its shufflings, pubkeys from its pubkey cache,
+# and the signing domain from the fork. The BeaconState is not needed, and nothing outside the seen-cache
+# of the validator is modified.
+#
+# Signatures are checked per batch: attestations that sign the same data are verified with one
+# aggregate check. Only if that fails, they are checked one by one, to find the invalid ones.
+
+ATTESTATION_PROPAGATION_SLOT_RANGE = 32
+
+ACCEPT = 'accept'
+IGNORE = 'ignore'  # not invalid, just not useful (too old, too early, duplicate): do not propagate, no penalty
+REJECT = 'reject'  # invalid: do not propagate, penalize the sender
+
+GossipResult = Tuple[str, Optional[str]]  # (ACCEPT/IGNORE/REJECT, reason)
+
+
+class _Candidate(object):
+    # An attestation that passed the checks that do not need the signature
+
+    __slots__ = 'position', 'attestation', 'validator_index', 'target_epoch', 'data_root'
+
+    def __init__(self, position: int, attestation: Attestation, validator_index: ValidatorIndex,
+                 target_epoch: Epoch, data_root: Root):
+        self.position = position
+        self.attestation = attestation
+        self.validator_index = validator_index
+        self.target_epoch = target_epoch
+        self.data_root = data_root
+
+
+class ValidatorStats(object):
+    accepted: int
+    ignored: int
+    rejected: int
+    signature_checks: int  # BLS verifications, an aggregate check counts once
+
+    def __init__(self):
+        self.accepted = 0
+        self.ignored = 0
+        self.rejected = 0
+        self.signature_checks = 0
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class GossipAttestationValidator(object):
+    """
+    Validates batches of gossip attestations against the committees of ``epochs_ctx``:
+
+        validator = GossipAttestationValidator(epochs_ctx, state.fork)
+        results = validator.validate_batch(attestations, current_slot)
+
+    ``epochs_ctx`` is only read, it may be rotated by the block import in between batches.
+    The seen-cache only keeps the previous and current epoch of the latest batch, older entries are pruned.
+    ``is_known_block`` optionally checks that the voted block root is known, e.g. ``root in fork_choice.proto_array``.
+    """
+    epochs_ctx: EpochsContext
+    fork: Fork
+    seen: Dict[Epoch, Set[ValidatorIndex]]  # validators with an accepted attestation, by target epoch
+    stats: ValidatorStats
+
+    def __init__(self, epochs_ctx: EpochsContext, fork: Fork,
+                 is_known_block: Optional[Callable[[Root], bool]] = None):
+        self.epochs_ctx = epochs_ctx
+        self.fork = fork.copy()
+        self.is_known_block = is_known_block
+        self.seen = {}
+        self.stats = ValidatorStats()
+
+    def _domain(self, epoch: Epoch) -> Domain:
+        fork_version = self.fork.previous_version if epoch < self.fork.epoch else self.fork.current_version
+        return compute_domain(DOMAIN_BEACON_ATTESTER, fork_version)
+
+    def prune_seen(self, current_epoch: Epoch):
+        # Only attestations of the current and previous epoch are in the propagation range.
+        for epoch in [epoch for epoch in self.seen if epoch + 1 < current_epoch]:
+            del self.seen[epoch]
+
+    def _precheck(self, attestation: Attestation, current_slot: Slot) -> Tuple[Optional[GossipResult],
+                                                                               Optional[ValidatorIndex]]:
+        data = attestation.data
+        slot = data.slot
+        if not (slot <= current_slot <= slot + ATTESTATION_PROPAGATION_SLOT_RANGE):
+            return (IGNORE, f"slot {slot} outside the propagation range of slot {current_slot}"), None
+        target_epoch = data.target.epoch
+        if target_epoch != compute_epoch_at_slot(slot):
+            return (REJECT, f"target epoch {target_epoch} does not match slot {slot}"), None
+
+        ctx = self.epochs_ctx
+        if target_epoch not in (ctx.previous_shuffling.epoch, ctx.current_shuffling.epoch,
+                                ctx.next_shuffling.epoch):
+            # Too far off from what we know, the epochs context is behind or ahead.
+            return (IGNORE, f"no shuffling for epoch {target_epoch}"), None
+        if data.index >= ctx.get_committee_count_at_slot(slot):
+            return (REJECT, f"committee index {data.index} out of range"), None
+        committee = ctx.get_beacon_committee(slot, data.index)
+
+        bits, length = bits_to_int(attestation.aggregation_bits)
+        if length != len(committee):
+            return (REJECT, f"aggregation bits of length {length}, committee of {len(committee)}"), None
+        if popcount(bits) != 1:
+            return (REJECT, "not exactly one aggregation bit set"), None
+        validator_index = committee[bits.bit_length() - 1]
+
+        if validator_index in self.seen.get(target_epoch, ()):
+            return (IGNORE, f"already seen an attestation of {validator_index} for epoch {target_epoch}"), None
+        if self.is_known_block is not None and not self.is_known_block(data.beacon_block_root):
+            return (IGNORE, f"unknown block {data.beacon_block_root.hex()}"), None
+        return None, validator_index
+
+    def _verify_group(self, pubkeys: Sequence[BLSPubkey], signing_root: Root,
+                      candidates: Sequence[_Candidate]) -> PyList[bool]:
+        if len(candidates) > 1:
+            self.stats.signature_checks += 1
+            signature = bls.Aggregate([c.attestation.signature for c in candidates])
+            if bls.FastAggregateVerify(pubkeys, signing_root, signature):
+                return [True] * len(candidates)
+        out = []
+        for pubkey, c in zip(pubkeys, candidates):
+            self.stats.signature_checks += 1
+            out.append(bool(bls.Verify(pubkey, signing_root, c.attestation.signature)))
+        return out
+
+    def _verify_round(self, candidates: Sequence[_Candidate], results: PyList[Optional[GossipResult]]):
+        # Signing data root -> candidates, each group is verified with one aggregate check.
+        groups: Dict[Root, PyList[_Candidate]] = {}
+        for c in candidates:
+            groups.setdefault(c.data_root, []).append(c)
+        index2pubkey = self.epochs_ctx.index2pubkey
+        for data_root, group in groups.items():
+            target_epoch = group[0].target_epoch
+            signing_root = SigningRoot(object_root=data_root, domain=self._domain(target_epoch)).hash_tree_root()
+            pubkeys = [index2pubkey[c.validator_index] for c in group]
+            for c, valid in zip(group, self._verify_group(pubkeys, signing_root, group)):
+                if valid:
+                    self.seen.setdefault(target_epoch, set()).add(c.validator_index)
+                    results[c.position] = (ACCEPT, None)
+                else:
+                    results[c.position] = (REJECT, "invalid signature")
+
+    def validate_batch(self, attestations: Sequence[Attestation], current_slot: Slot) -> PyList[GossipResult]:
+        """Validate ``attestations``, received up to ``current_slot``. Returns a result per attestation, in order."""
+        self.prune_seen(compute_epoch_at_slot(current_slot))
+        results: PyList[Optional[GossipResult]] = [None] * len(attestations)
+        candidates: PyList[_Candidate] = []
+        for position, attestation in enumerate(attestations):
+            try:
+                result, validator_index = self._precheck(attestation, current_slot)
+            except Exception as e:
+                result, validator_index = (REJECT, f"malformed attestation: {e!r}"), None
+            if result is not None:
+                results[position] = result
+                continue
+            candidates.append(_Candidate(position, attestation, validator_index, attestation.data.target.epoch,
+                                         hash_tree_root(attestation.data)))
+
+        # Copies of the same validator and epoch within the batch: only the first one is verified per round.
+        # A later copy is only verified if no earlier one turned out valid, an invalid copy must not
+        # shadow a valid one.
+        while candidates:
+            round_keys: Set[Tuple[Epoch, ValidatorIndex]] = set()
+            verify: PyList[_Candidate] = []
+            deferred: PyList[_Candidate] = []
+            for c in candidates:
+                key = (c.target_epoch, c.validator_index)
+                if c.validator_index in self.seen.get(c.target_epoch, ()):
+                    results[c.position] = (IGNORE, f"duplicate attestation of {c.validator_index} in batch")
+                elif key in round_keys:
+                    deferred.append(c)
+                else:
+                    round_keys.add(key)
+                    verify.append(c)
+            self._verify_round(verify, results)
+            candidates = deferred
+
+        for result, _ in results:
+            if result == ACCEPT:
+                self.stats.accepted += 1
+            elif result == IGNORE:
+                self.stats.ignored += 1
+            else:
+                self.stats.rejected += 1
+        return results
+
+    def validate(self, attestation: Attestation, current_slot: Slot) -> GossipResult:
+        return self.validate_batch([attestation], current_slot)[0]
@@ -0,0 +1,265 @@
+import io
+import json
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List as PyList, Optional
+
+import fastspec
+
+# Functions of fastspec that are timed. Fastspec looks these up as module globals on every call,
+# so swapping the globals is enough to intercept them, and restoring them makes the disabled case free.
+TRANSITION_PHASES = (
+    'state_transition',
+    'process_slots',
+    'process_slot',
+    'hash_tree_root',
+)
+
+EPOCH_PHASES = (
+    'process_epoch',
+    'prepare_epoch_process_state',
+    'finish_epoch_process_state',
+    'process_justification_and_finalization',
+    'process_rewards_and_penalties',
+    'get_attestation_deltas',
+    'process_registry_updates',
+    'process_slashings',
+    'process_final_updates',
+)
+
+BLOCK_PHASES = (
+    'process_block',
+    'verify_block_signature',
+    'process_block_header',
+    'process_randao',
+    'process_eth1_data',
+    'process_operations',
+)
+
+OPERATION_PHASES = (
+    'process_proposer_slashing',
+    'process_attester_slashing',
+    'process_attestation',
+    'process_deposit',
+    'process_voluntary_exit',
+)
+
+DEFAULT_PHASES = TRANSITION_PHASES + EPOCH_PHASES + BLOCK_PHASES + OPERATION_PHASES
+
+# BLS functions of eth2spec.utils.bls that are timed, when called through fastspec.
+BLS_FUNCTIONS = ('Verify', 'AggregateVerify', 'FastAggregateVerify', 'Aggregate', 'Sign')
+
+# Durations are bucketed by powers of two, in microseconds.
+HISTOGRAM_BUCKETS = 32
+
+
+class PhaseStats(object):
+
+    __slots__ = 'calls', 'total', 'min', 'max', 'alloc', 'histogram'
+
+    calls: int
+    total: float  # seconds
+    min: float
+    max: float
+    alloc: int  # net allocated bytes, only tracked when allocation tracking is enabled
+    histogram: PyList[int]
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.alloc = 0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, duration: float, alloc: int):
+        self.calls += 1
+        self.total += duration
+        if duration < self.min:
+            self.min = duration
+        if duration > self.max:
+            self.max = duration
+        self.alloc += alloc
+        bucket = min(int(duration * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.histogram[bucket] += 1
+
+    def to_dict(self) -> dict:
+        # Histogram keys are the exclusive upper bound of the bucket, in microseconds.
+        return {
+            'calls': self.calls,
+            'total_s': self.total,
+            'mean_s': self.total / self.calls if self.calls else 0.0,
+            'min_s': self.min if self.calls else 0.0,
+            'max_s': self.max,
+            'alloc_bytes': self.alloc,
+            'histogram_us': {str(1 << i): n for i, n in enumerate(self.histogram) if n},
+        }
+
+
+class _TimedBLS(object):
+    # Stands in for the bls module in fastspec, forwards everything, times the BLS_FUNCTIONS.
+
+    def __init__(self, inst: "Instrumentation", bls_module):
+        object.__setattr__(self, '_bls', bls_module)
+        object.__setattr__(self, '_timed', {
+            name: inst._wrap('bls.' + name, getattr(bls_module, name))
+            for name in BLS_FUNCTIONS if hasattr(bls_module, name)
+        })
+
+    def __getattr__(self, name):
+        timed = self._timed.get(name)
+        if timed is not None:
+            return timed
+        return getattr(self._bls, name)
+
+    def __setattr__(self, name, value):
+        # e.g. bls.bls_active = False must still reach the real module.
+        setattr(self._bls, name, value)
+
+
+class Instrumentation(object):
+    """
+    Opt-in timing of the phases of fastspec. Nothing is wrapped unless the instrumentation is active:
+
+        with Instrumentation() as inst:
+            state_transition(epochs_ctx, state, signed_block)
+        print(inst.format_report())
+
+    Stats are keyed by call path, e.g. ``state_transition/process_slots/process_slot/hash_tree_root``,
+    so the same function is accounted separately per caller. Call paths are tracked per thread, so fastspec
+    running on other threads (range sync, epoch precompute, pipeline decoders) adds to the same stats
+    under its own paths. Allocation tracking is process-wide, and also counts the other threads.
+    """
+    phases: PyList[str]
+    track_allocations: bool
+    stats: Dict[str, PhaseStats]
+
+    def __init__(self, phases=DEFAULT_PHASES, bls: bool = True, track_allocations: bool = False):
+        self.phases = list(phases)
+        self.bls = bls
+        self.track_allocations = track_allocations
+        self.stats = {}
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._originals = {}
+        self._installed = {}
+        self._started_tracemalloc = False
+
+    def _wrap(self, name: str, fn: Callable) -> Callable:
+        local = self._local
+        stats = self.stats
+        stats_lock = self._stats_lock
+        perf_counter = time.perf_counter
+        track_allocations = self.track_allocations
+        get_traced_memory = tracemalloc.get_traced_memory
+
+        def timed(*args, **kwargs):
+            stack = getattr(local, 'stack', None)
+            if stack is None:
+                stack = local.stack = []
+            stack.append(name)
+            path = '/'.join(stack)
+            alloc_start = get_traced_memory()[0] if track_allocations else 0
+            start = perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                duration = perf_counter() - start
+                alloc = get_traced_memory()[0] - alloc_start if track_allocations else 0
+                stack.pop()
+                with stats_lock:
+                    phase_stats = stats.get(path)
+                    if phase_stats is None:
+                        phase_stats = stats[path] = PhaseStats()
+                    phase_stats.add(duration, alloc)
+
+        timed.__name__ = getattr(fn, '__name__', name)
+        timed.__wrapped__ = fn
+        return timed
+
+    def enable(self):
+        assert not self._originals, "instrumentation is already enabled"
+        if self.track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        module_globals = vars(fastspec)
+        for name in self.phases:
+            fn = module_globals[name]
+            self._originals[name] = fn
+            module_globals[name] = self._installed[name] = self._wrap(name, fn)
+        if self.bls:
+            self._originals['bls'] = fastspec.bls
+            fastspec.bls = self._installed['bls'] = _TimedBLS(self, fastspec.bls)
+
+    def disable(self, strict: bool = True):
+        """
+        Restore the fastspec globals. Restoring a global that was swapped again since (e.g. by a
+        ParallelEpochPreparer) would drop that swap: with ``strict`` that raises, otherwise such globals
+        are left as they are.
+        """
+        module_globals = vars(fastspec)
+        replaced = [name for name, fn in self._installed.items() if module_globals[name] is not fn]
+        if strict and replaced:
+            raise AssertionError(f"fastspec.{', '.join(replaced)} replaced after enabling instrumentation, "
+                                 f"undo that first (swaps must be undone in reverse order)")
+        for name, fn in self._originals.items():
+            if name not in replaced:
+                module_globals[name] = fn
+        self._originals = {}
+        self._installed = {}
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def __enter__(self) -> "Instrumentation":
+        self.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Never hide an exception that is already propagating.
+        self.disable(strict=exc_type is None)
+
+    def reset(self):
+        # Cleared in place: active wrappers hold on to this dict.
+        with self._stats_lock:
+            self.stats.clear()
+
+    def report(self) -> Dict[str, dict]:
+        return {path: st.to_dict() for path, st in sorted(self.stats.items())}
+
+    def write_json(self, path: str):
+        with io.open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def format_report(self, min_total: float = 0.0) -> str:
+        lines = [f"{'phase':<90} {'calls':>8} {'total ms':>11} {'mean ms':>10} {'max ms':>10} {'alloc KiB':>10}"]
+        for path, st in sorted(self.stats.items()):
+            if st.total < min_total:
+                continue
+            depth = path.count('/')
+            label = '  ' * depth + path.rsplit('/', 1)[-1]
+            lines.append(f"{label:<90} {st.calls:>8} {st.total * 1e3:>11.3f} {st.total / st.calls * 1e3:>10.3f} "
+                         f"{st.max * 1e3:>10.3f} {st.alloc / 1024:>10.1f}")
+        return '\n'.join(lines)
+
+
+# Current instrumentation, if any, for callers that do not want to thread it through.
+_active: Optional[Instrumentation] = None
+
+
+def enable(**kwargs) -> Instrumentation:
+    global _active
+    if _active is None:
+        _active = Instrumentation(**kwargs)
+        _active.enable()
+    return _active
+
+
+def disable() -> Optional[Instrumentation]:
+    global _active
+    inst = _active
+    if inst is not None:
+        inst.disable()
+        _active = None
+    return inst
@@ -0,0 +1,235 @@
+import argparse
+import json
+import random
+import sys
+import time
+from functools import partial
+from typing import Dict, List as PyList, Sequence
+
+import trio
+from pyrum import Rumor
+
+from dispatcher import serve_all
+from experiment import (
+    run_rumor_function, shared_block_cache, shared_status_service,
+    status_handler, blocks_by_range_handler, blocks_by_root_handler, goodbye_handler,
+)
+from messages import BlocksByRange, BlocksByRoot
+
+# Req/resp load generator: two local Rumor actors over loopback, "rick" serves (status, blocks_by_range,
+# blocks_by_root from the block store), "morty" fires a concurrent request mix at it. Nothing leaves the machine.
+#
+#   python loadgen.py --duration 30 --concurrency 32 --mix status=1,range=1,root=1 --compression snappy
+#   python loadgen.py --compression none
+
+REQUEST_KINDS = ('status', 'range', 'root')
+
+RICK_PORT = 9100
+MORTY_PORT = 9101
+
+
+def _quiet(*args, **kwargs):
+    pass
+
+
+def _percentile(sorted_values: Sequence[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+class KindStats(object):
+    requests: int
+    errors: int
+    chunks: int
+    bytes: int  # received payload bytes (uncompressed ssz)
+    latencies: PyList[float]
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.chunks = 0
+        self.bytes = 0
+        self.latencies = []
+
+    def to_dict(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'chunks': self.chunks,
+            'bytes': self.bytes,
+            'req_per_s': self.requests / elapsed if elapsed else 0.0,
+            'bytes_per_s': self.bytes / elapsed if elapsed else 0.0,
+            'latency_ms': {f"p{p}": _percentile(latencies, p) * 1e3 for p in (50, 90, 99)},
+        }
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise ValueError(f"unknown request kind {kind!r}, expected one of {REQUEST_KINDS}")
+        weights[kind] = float(weight) if weight else 1.0
+    return weights
+
+
+class LoadGenerator(object):
+    morty: object
+    rick_peer_id: str
+    compression: str  # Rumor compression flag: 'snappy' or 'none'
+    stats: Dict[str, KindStats]
+
+    def __init__(self, morty, rick_peer_id: str, compression: str, range_count: int, root_count: int,
+                 seed: int = 0):
+        self.morty = morty
+        self.rick_peer_id = rick_peer_id
+        self.compression = compression
+        self.range_count = range_count
+        self.root_count = root_count
+        self.rng = random.Random(seed)
+        self.stats = {kind: KindStats() for kind in REQUEST_KINDS}
+
+        store = shared_block_cache().store
+        first, last = store.slot_bounds()
+        self.first_slot = first or 0
+        self.last_slot = last or 0
+        self.roots = list(store.by_root)
+        self.status_hex = shared_status_service().hex
+
+    async def _status(self, st: KindStats):
+        resp = await self.morty.rpc.status.req.raw(self.rick_peer_id, self.status_hex, raw=True,
+                                                   compression=self.compression)
+        st.chunks += 1
+        st.bytes += len(resp['chunk']['data']) // 2
+
+    async def _stream(self, st: KindStats, rpc, req_hex: str):
+        call = rpc.req.raw(self.rick_peer_id, req_hex, raw=True, compression=self.compression)
+        async for chunk in call.chunk():
+            if chunk.get('result_code', 0) != 0:
+                raise Exception(f"error response {chunk.get('result_code')}")
+            st.chunks += 1
+            st.bytes += len(chunk['data']) // 2
+        await call
+
+    async def _range(self, st: KindStats):
+        start = self.rng.randint(self.first_slot, max(self.first_slot, self.last_slot - self.range_count + 1))
+        req = BlocksByRange(head_block_root=b'\x00' * 32, start_slot=start, count=self.range_count, step=1)
+        await self._stream(st, self.morty.rpc.blocks_by_range, req.encode_bytes().hex())
+
+    async def _root(self, st: KindStats):
+        roots = self.rng.sample(self.roots, min(self.root_count, len(self.roots)))
+        await self._stream(st, self.morty.rpc.blocks_by_root, BlocksByRoot(*roots).encode_bytes().hex())
+
+    async def worker(self, weights: Dict[str, float], deadline: float):
+        kinds = list(weights)
+        kind_weights = list(weights.values())
+        requests = {'status': self._status, 'range': self._range, 'root': self._root}
+        while trio.current_time() < deadline:
+            kind = self.rng.choices(kinds, weights=kind_weights)[0]
+            st = self.stats[kind]
+            start = time.perf_counter()
+            try:
+                await requests[kind](st)
+            except Exception as e:
+                st.errors += 1
+                if st.errors <= 3:
+                    print(f"loadgen: {kind} request failed: {e!r}")
+                continue
+            st.latencies.append(time.perf_counter() - start)
+            st.requests += 1
+
+    async def run(self, weights: Dict[str, float], concurrency: int, duration: float) -> float:
+        if ('range' in weights or 'root' in weights) and not self.roots:
+            raise Exception("the block store is empty, import blocks first (see block_store.py)")
+        start = time.perf_counter()
+        deadline = trio.current_time() + duration
+        async with trio.open_nursery() as nursery:
+            for _ in range(concurrency):
+                nursery.start_soon(self.worker, weights, deadline)
+        return time.perf_counter() - start
+
+
+def report(stats: Dict[str, KindStats], elapsed: float, args) -> dict:
+    total = KindStats()
+    for st in stats.values():
+        total.requests += st.requests
+        total.errors += st.errors
+        total.chunks += st.chunks
+        total.bytes += st.bytes
+        total.latencies.extend(st.latencies)
+    return {
+        'compression': args.compression,
+        'concurrency': args.concurrency,
+        'duration_s': elapsed,
+        'kinds': {kind: st.to_dict(elapsed) for kind, st in stats.items() if st.requests or st.errors},
+        'total': total.to_dict(elapsed),
+    }
+
+
+def format_report(result: dict) -> str:
+    lines = [f"compression={result['compression']} concurrency={result['concurrency']} "
+             f"duration={result['duration_s']:.1f}s",
+             f"{'kind':<8} {'requests':>9} {'errors':>7} {'req/s':>9} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8}"]
+    for kind, r in list(result['kinds'].items()) + [('total', result['total'])]:
+        lines.append(f"{kind:<8} {r['requests']:>9} {r['errors']:>7} {r['req_per_s']:>9.1f} "
+                     f"{r['bytes_per_s'] / 1e6:>8.2f} {r['latency_ms']['p50']:>8.2f} {r['latency_ms']['p99']:>8.2f}")
+    return '\n'.join(lines)
+
+
+async def load_test(args, rumor: Rumor, nursery: trio.Nursery):
+    compression = args.compression
+
+    # Rick: the local stand-in for a remote node, serving from the block store
+    rick = rumor.actor('rick')
+    await rick.host.start()
+    await rick.host.listen(ip='127.0.0.1', tcp=RICK_PORT)
+    status = shared_status_service()
+    cache = shared_block_cache()
+    # All load comes from one peer: no per-peer rate limit, only the concurrency bound.
+    nursery.start_soon(partial(serve_all, rick, {
+        'status': status_handler(rick, status, log=_quiet),
+        'blocks_by_range': blocks_by_range_handler(rick, cache, log=_quiet),
+        'blocks_by_root': blocks_by_root_handler(rick, cache, log=_quiet),
+        'goodbye': goodbye_handler(rick, log=_quiet),
+    }, compression=compression, peer_concurrency=args.concurrency, peer_pending=args.concurrency * 2,
+        peer_rate=float('inf'), peer_burst=args.concurrency * 2))
+
+    # Morty: the load generator
+    morty = rumor.actor('morty')
+    await morty.host.start()
+    await morty.host.listen(ip='127.0.0.1', tcp=MORTY_PORT)
+    rick_peer_id = (await rick.host.view())['peer_id']
+    await morty.peer.connect(f"/ip4/127.0.0.1/tcp/{RICK_PORT}/p2p/{rick_peer_id}")
+    print(f"morty connected to local rick {rick_peer_id}")
+
+    gen = LoadGenerator(morty, rick_peer_id, compression, args.range_count, args.root_count, seed=args.seed)
+    elapsed = await gen.run(parse_mix(args.mix), args.concurrency, args.duration)
+    result = report(gen.stats, elapsed, args)
+    result['cache'] = cache.stats()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    print(format_report(result))
+    nursery.cancel_scope.cancel()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Measure req/resp throughput between two local Rumor actors.")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of load")
+    parser.add_argument('--concurrency', type=int, default=16, help="requests in flight")
+    parser.add_argument('--mix', default='status=1,range=1,root=1', help="request kind weights")
+    parser.add_argument('--compression', default='snappy', choices=('snappy', 'none'))
+    parser.add_argument('--range-count', type=int, default=64, help="blocks per blocks_by_range request")
+    parser.add_argument('--root-count', type=int, default=16, help="roots per blocks_by_root request")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the results as JSON to this file")
+    args = parser.parse_args(args)
+    trio.run(run_rumor_function, partial(load_test, args))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
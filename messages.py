@@ -0,0 +1,26 @@
+from fastspec import Container, Bytes4, Bytes32, uint64, List
+
+# Eth2 req/resp message types
+
+
+class Status(Container):
+    version: Bytes4
+    finalized_root: Bytes32
+    finalized_epoch: uint64
+    head_root: Bytes32
+    head_slot: uint64
+
+
+class Goodbye(uint64):
+    pass
+
+
+class BlocksByRange(Container):
+    head_block_root: Bytes32
+    start_slot: uint64
+    count: uint64
+    step: uint64
+
+
+class BlocksByRoot(List[Bytes32, 1024]):
+    pass
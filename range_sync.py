@@ -0,0 +1,257 @@
+from collections import deque
+from typing import Any, Deque, Dict, List as PyList, Optional, Sequence, Set
+
+import trio
+
+from fastspec import BeaconState, EpochsContext, SignedBeaconBlock, Slot, state_transition
+from messages import BlocksByRange
+
+# Range sync over several peers: the slot range is split into batches, every connected peer works on
+# one batch at a time, and the batches are re-assembled in slot order into one stream of blocks.
+#
+# Failed batches (errors, timeouts, invalid responses) go back to the front of the queue, for another peer
+# to try. A peer that keeps failing is dropped. Batches are only requested a window ahead of the oldest
+# batch that is not yet streamed, which bounds the memory used for out-of-order batches.
+
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_MAX_ATTEMPTS = 5  # per batch, over all peers
+DEFAULT_MAX_PEER_FAILURES = 3  # consecutive failures before a peer is dropped
+DEFAULT_REQUEST_TIMEOUT = 30.0  # seconds, per batch request
+DEFAULT_WINDOW = 16  # batches that may be requested or buffered ahead of the stream
+
+
+class SyncError(Exception):
+    pass
+
+
+class BatchError(Exception):
+    pass
+
+
+class Batch(object):
+
+    __slots__ = 'index', 'start_slot', 'count', 'attempts', 'failed_peers', 'blocks'
+
+    index: int
+    start_slot: Slot
+    count: int
+    attempts: int
+    failed_peers: Set[str]
+    blocks: Optional[PyList[SignedBeaconBlock]]
+
+    def __init__(self, index: int, start_slot: Slot, count: int):
+        self.index = index
+        self.start_slot = start_slot
+        self.count = count
+        self.attempts = 0
+        self.failed_peers = set()
+        self.blocks = None
+
+    def __repr__(self):
+        return f"Batch({self.index}, slots {self.start_slot}..{self.start_slot + self.count - 1})"
+
+
+class SyncStats(object):
+    requests: int
+    failures: int
+    blocks: int
+    bytes: int
+    per_peer_blocks: Dict[str, int]
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.blocks = 0
+        self.bytes = 0
+        self.per_peer_blocks = {}
+
+
+class _Progress(object):
+    next_index: int  # index of the next batch to stream
+    active_peers: int
+    error: Optional[str]
+
+    def __init__(self, active_peers: int):
+        self.next_index = 0
+        self.active_peers = active_peers
+        self.error = None
+        self._changed = trio.Event()
+
+    def fail(self, msg: str):
+        if self.error is None:
+            self.error = msg
+
+    def notify(self):
+        self._changed.set()
+        self._changed = trio.Event()
+
+    async def wait(self):
+        await self._changed.wait()
+
+
+class RangeSync(object):
+    """
+    Fetches a slot range from ``peers`` of a Rumor actor, and streams the blocks in slot order:
+
+        send, recv = trio.open_memory_channel(64)
+        nursery.start_soon(RangeSync(morty, peers).stream, start_slot, count, send)
+        async for block in recv:
+            ...
+    """
+    actor: Any
+    peers: PyList[str]
+    batch_size: int
+    max_attempts: int
+    max_peer_failures: int
+    request_timeout: float
+    window: int
+    stats: SyncStats
+
+    def __init__(self, actor: Any, peers: Sequence[str], batch_size: int = DEFAULT_BATCH_SIZE,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS, max_peer_failures: int = DEFAULT_MAX_PEER_FAILURES,
+                 request_timeout: float = DEFAULT_REQUEST_TIMEOUT, window: int = DEFAULT_WINDOW,
+                 compression: Optional[str] = 'snappy'):
+        assert batch_size > 0 and window > 0
+        self.actor = actor
+        self.peers = list(peers)
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.max_peer_failures = max_peer_failures
+        self.request_timeout = request_timeout
+        self.window = window
+        self.compression = compression
+        self.stats = SyncStats()
+
+    async def request_batch(self, peer_id: str, batch: Batch) -> PyList[SignedBeaconBlock]:
+        req = BlocksByRange(head_block_root=b'\x00' * 32, start_slot=batch.start_slot, count=batch.count, step=1)
+        resps = self.actor.rpc.blocks_by_range.req.raw(peer_id, req.encode_bytes().hex(), raw=True,
+                                                       compression=self.compression)
+        blocks = []
+        end_slot = batch.start_slot + batch.count
+        prev_slot = -1
+        async for resp in resps.chunk():
+            result_code = resp.get('result_code', 0)
+            if result_code != 0:
+                raise BatchError(f"error response {result_code}: {resp.get('msg', resp.get('data'))}")
+            data = bytes.fromhex(resp['data'])
+            block = SignedBeaconBlock.decode_bytes(data)
+            slot = block.message.slot
+            if not (batch.start_slot <= slot < end_slot) or slot <= prev_slot:
+                raise BatchError(f"block of slot {slot} out of order or outside of {batch}")
+            if blocks and block.message.parent_root != blocks[-1].message.hash_tree_root():
+                raise BatchError(f"block of slot {slot} does not build on the previous block of the batch")
+            prev_slot = slot
+            blocks.append(block)
+            self.stats.bytes += len(data)
+        # Awaiting the call only waits for it to finish, a failed request is not raised: check for errors.
+        await resps
+        if resps.err.is_set():
+            raise BatchError(f"request failed: {resps.data.get('err', resps.data.get('msg'))}")
+        return blocks
+
+    async def stream(self, start_slot: Slot, count: int, send: trio.MemorySendChannel):
+        """
+        Fetch ``count`` slots from ``start_slot``, and send the blocks to ``send`` in slot order.
+        Closes ``send`` when done. Raises SyncError when a batch cannot be fetched from any peer.
+        """
+        batches = [Batch(i, Slot(start_slot + offset), min(self.batch_size, count - offset))
+                   for i, offset in enumerate(range(0, count, self.batch_size))]
+        pending: Deque[Batch] = deque(batches)
+        ready: Dict[int, Batch] = {}
+        # Sync state shared by the peer workers and the emitter. They all run on the trio thread,
+        # so no locking is needed, only a wake-up when something changed.
+        progress = _Progress(len(self.peers))
+
+        def pick(peer_id: str) -> Optional[Batch]:
+            limit = progress.next_index + self.window
+            for batch in pending:
+                if batch.index >= limit:
+                    break
+                # Prefer peers that did not fail on the batch yet, unless there is no other peer left.
+                if peer_id not in batch.failed_peers or len(batch.failed_peers) >= progress.active_peers:
+                    pending.remove(batch)
+                    return batch
+            return None
+
+        async def peer_worker(peer_id: str):
+            failures = 0
+            try:
+                while True:
+                    while True:
+                        if progress.error is not None or progress.next_index >= len(batches):
+                            return
+                        batch = pick(peer_id)
+                        if batch is not None:
+                            break
+                        await progress.wait()
+
+                    batch.attempts += 1
+                    self.stats.requests += 1
+                    try:
+                        with trio.fail_after(self.request_timeout):
+                            blocks = await self.request_batch(peer_id, batch)
+                    except Exception as e:
+                        self.stats.failures += 1
+                        failures += 1
+                        print(f"sync: {batch} failed on peer {peer_id} (attempt {batch.attempts}): {e!r}")
+                        batch.failed_peers.add(peer_id)
+                        if batch.attempts >= self.max_attempts:
+                            progress.fail(f"{batch} failed {batch.attempts} times, last error: {e!r}")
+                        else:
+                            pending.appendleft(batch)
+                        progress.notify()
+                        if failures >= self.max_peer_failures:
+                            print(f"sync: dropping peer {peer_id} after {failures} consecutive failures")
+                            return
+                        continue
+
+                    failures = 0
+                    self.stats.per_peer_blocks[peer_id] = self.stats.per_peer_blocks.get(peer_id, 0) + len(blocks)
+                    batch.blocks = blocks
+                    ready[batch.index] = batch
+                    progress.notify()
+            finally:
+                progress.active_peers -= 1
+                if progress.active_peers == 0 and progress.next_index < len(batches):
+                    progress.fail("no peers left to sync from")
+                progress.notify()
+
+        async def emitter():
+            async with send:
+                while progress.next_index < len(batches):
+                    while progress.next_index not in ready:
+                        if progress.error is not None:
+                            raise SyncError(progress.error)
+                        await progress.wait()
+                    batch = ready.pop(progress.next_index)
+                    for block in batch.blocks:
+                        # Blocks here until the consumer catches up.
+                        await send.send(block)
+                    self.stats.blocks += len(batch.blocks)
+                    batch.blocks = None
+                    progress.next_index += 1
+                    progress.notify()
+
+        if not self.peers:
+            await send.aclose()
+            raise SyncError("no peers to sync from")
+        async with trio.open_nursery() as nursery:
+            for peer_id in self.peers:
+                nursery.start_soon(peer_worker, peer_id)
+            nursery.start_soon(emitter)
+
+    async def sync(self, epochs_ctx: EpochsContext, state: BeaconState, start_slot: Slot, count: int,
+                   buffer_size: int = 64, validate_result: bool = True) -> int:
+        """
+        Fetch the range and apply the blocks to ``state`` as they come in. The transition runs in a worker thread,
+        so the peer requests continue meanwhile. Returns the number of applied blocks.
+        """
+        applied = 0
+        send, recv = trio.open_memory_channel(buffer_size)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(self.stream, start_slot, count, send)
+            async with recv:
+                async for block in recv:
+                    await trio.to_thread.run_sync(state_transition, epochs_ctx, state, block, validate_result)
+                    applied += 1
+        return applied
@@ -0,0 +1,210 @@
+import argparse
+import io
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+from remerkleable.tree import Node, PairNode, RootNode
+
+from fastspec import (
+    BeaconState, EpochsContext, EpochObserver, SignedBeaconBlock, Epoch,
+    compute_epoch_at_slot, hash_tree_root, state_transition,
+)
+from snapshot import read_snapshot, write_snapshot
+
+# A block to replay: either the SSZ bytes of a SignedBeaconBlock, or the path of a file containing them.
+BlockSource = Union[bytes, str]
+
+
+def _decode_block(source: BlockSource) -> Node:
+    # Runs in a worker process.
+    if isinstance(source, str):
+        with io.open(source, 'rb') as f:
+            source = f.read()
+    signed_block = SignedBeaconBlock.decode_bytes(source)
+    # Pre-hash the block: the cached roots travel back with the (pickled) tree,
+    # so the block header and signature checks in the main process find them ready.
+    hash_tree_root(signed_block.message)
+    # Only the backing tree is sent back: the nodes pickle fine, the generated view types do not.
+    backing = signed_block.get_backing()
+    _plain_roots(backing)
+    return backing
+
+
+def _plain_roots(backing: Node):
+    # Decoded leaves may keep their root as a (non-picklable) SSZ view type, reduce them to plain bytes.
+    stack = [backing]
+    while stack:
+        node = stack.pop()
+        if type(node) is PairNode:
+            stack.append(node.left)
+            stack.append(node.right)
+        elif type(node) is RootNode and type(node.root) is not bytes:
+            node._root = bytes(node.root)
+
+
+def iter_block_files(directory: str) -> Iterator[str]:
+    """
+    Return the paths of the block files in ``directory``, ordered by name.
+    Name files such that they sort by slot, e.g. ``block_000001234.ssz``.
+    """
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.ssz'):
+            yield os.path.join(directory, name)
+
+
+class ReplayStats(object):
+    blocks: int
+    start_slot: int
+    last_slot: int
+    start_time: float
+    decode_wait: float  # time the main thread spent waiting on decoded blocks
+    transition_time: float
+
+    def __init__(self, start_slot: int):
+        self.blocks = 0
+        self.start_slot = start_slot
+        self.last_slot = start_slot
+        self.start_time = time.perf_counter()
+        self.decode_wait = 0.0
+        self.transition_time = 0.0
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def summary(self) -> str:
+        elapsed = self.elapsed()
+        slots = self.last_slot - self.start_slot
+        return (f"{self.blocks} blocks, {slots} slots in {elapsed:.2f}s: "
+                f"{self.blocks / elapsed if elapsed else 0:.1f} blocks/s, {slots / elapsed if elapsed else 0:.1f} slots/s, "
+                f"transition {self.transition_time:.2f}s, waiting on decode {self.decode_wait:.2f}s")
+
+
+def replay_blocks(epochs_ctx: EpochsContext, state: BeaconState,
+                  blocks: Iterable[BlockSource],
+                  executor: Optional[Executor] = None,
+                  queue_size: int = 64,
+                  validate_result: bool = True,
+                  report_interval: float = 10.0,
+                  report: Optional[Callable[[ReplayStats], None]] = None,
+                  checkpoint_epochs: int = 0,
+                  checkpoint_dir: str = '.',
+                  observer: Optional[EpochObserver] = None) -> ReplayStats:
+    """
+    Apply ``blocks`` (in order) to ``state`` with ``state_transition``, mutating ``state`` and ``epochs_ctx``.
+    Blocks are decoded and hashed by ``executor`` (by default a process pool),
+    at most ``queue_size`` blocks ahead of the block that is being applied.
+    Every ``checkpoint_epochs`` epochs (if non-zero) a snapshot is written to ``checkpoint_dir``.
+    ``observer`` is passed to every state_transition, e.g. a DeltasExport.
+    """
+    assert queue_size > 0
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor()
+    if report is None:
+        def report(st: ReplayStats):
+            print(st.summary())
+
+    stats = ReplayStats(int(state.slot))
+    last_report = stats.start_time
+    last_checkpoint_epoch = compute_epoch_at_slot(state.slot)
+
+    sources = iter(blocks)
+    pending = deque()
+    try:
+        def fill():
+            while len(pending) < queue_size:
+                try:
+                    source = next(sources)
+                except StopIteration:
+                    return
+                pending.append(executor.submit(_decode_block, source))
+
+        fill()
+        while pending:
+            future = pending.popleft()
+            wait_start = time.perf_counter()
+            signed_block = SignedBeaconBlock.view_from_backing(future.result())
+            transition_start = time.perf_counter()
+            stats.decode_wait += transition_start - wait_start
+
+            # Top up the queue first, so workers decode ahead while this block is applied.
+            fill()
+
+            state_transition(epochs_ctx, state, signed_block, validate_result=validate_result, observer=observer)
+            now = time.perf_counter()
+            stats.transition_time += now - transition_start
+            stats.blocks += 1
+            stats.last_slot = int(state.slot)
+
+            if checkpoint_epochs > 0:
+                epoch = compute_epoch_at_slot(state.slot)
+                if epoch >= last_checkpoint_epoch + checkpoint_epochs:
+                    write_checkpoint(checkpoint_dir, state, epochs_ctx)
+                    last_checkpoint_epoch = epoch
+
+            if now - last_report >= report_interval:
+                report(stats)
+                last_report = now
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False)
+    return stats
+
+
+def checkpoint_path(checkpoint_dir: str, epoch: Epoch) -> str:
+    return os.path.join(checkpoint_dir, f"checkpoint_{epoch:09d}.snap")
+
+
+def write_checkpoint(checkpoint_dir: str, state: BeaconState, epochs_ctx: EpochsContext) -> str:
+    path = checkpoint_path(checkpoint_dir, compute_epoch_at_slot(state.slot))
+    # Write to a temporary file first, a crash while writing must not leave a broken checkpoint behind.
+    tmp_path = path + '.tmp'
+    write_snapshot(tmp_path, state, epochs_ctx)
+    os.replace(tmp_path, path)
+    return path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Replay a directory of SignedBeaconBlock SSZ files onto a state.")
+    parser.add_argument('snapshot', help="snapshot (see snapshot.py) of the pre-state")
+    parser.add_argument('blocks_dir', help="directory of block files, sorted by name")
+    parser.add_argument('--workers', type=int, default=None, help="decode worker processes (default: cpu count)")
+    parser.add_argument('--queue-size', type=int, default=64, help="max. blocks decoded ahead")
+    parser.add_argument('--no-validate', action='store_true',
+                        help="skip block signature and state root checks (validate_result=False)")
+    parser.add_argument('--report-interval', type=float, default=10.0, help="seconds between progress reports")
+    parser.add_argument('--checkpoint-epochs', type=int, default=0, help="write a snapshot every N epochs")
+    parser.add_argument('--checkpoint-dir', default='.', help="directory for checkpoint snapshots")
+    parser.add_argument('--deltas-dir', default=None,
+                        help="write the reward and penalty components of every epoch here (see deltas_export.py)")
+    args = parser.parse_args(args)
+
+    observer = None
+    if args.deltas_dir is not None:
+        from deltas_export import DeltasExport
+        observer = DeltasExport(args.deltas_dir)
+
+    state, epochs_ctx = read_snapshot(args.snapshot)
+    print(f"loaded state at slot {state.slot}")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        stats = replay_blocks(epochs_ctx, state, iter_block_files(args.blocks_dir),
+                              executor=executor,
+                              queue_size=args.queue_size,
+                              validate_result=not args.no_validate,
+                              report_interval=args.report_interval,
+                              checkpoint_epochs=args.checkpoint_epochs,
+                              checkpoint_dir=args.checkpoint_dir,
+                              observer=observer)
+    print(f"done: {stats.summary()}")
+    print(f"post-state root: {state.hash_tree_root().hex()}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,234 @@
+from typing import Iterator, Optional, Tuple, Union
+
+import snappy
+
+# Wire format of eth2 req/resp messages with the ssz_snappy encoding:
+#
+#   request:        <uvarint: ssz length> | <snappy frames of the ssz bytes>
+#   response chunk: <result: 1 byte> | <uvarint: ssz length> | <snappy frames of the ssz bytes>
+#
+# The snappy frame format (https://github.com/google/snappy/blob/master/framing_format.txt) has no end marker:
+# a reader decodes frames until it has the uncompressed length announced by the uvarint prefix.
+# Everything here reads from memoryviews, so a received buffer is parsed without intermediate copies.
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+RESULT_SUCCESS = 0
+RESULT_INVALID_REQUEST = 1
+RESULT_SERVER_ERROR = 2
+
+FRAME_COMPRESSED = 0x00
+FRAME_UNCOMPRESSED = 0x01
+FRAME_PADDING = 0xfe
+FRAME_STREAM_IDENTIFIER = 0xff
+
+STREAM_IDENTIFIER = b'\xff\x06\x00\x00sNaPpY'
+
+# Max. uncompressed bytes per data frame, as per the framing format.
+MAX_FRAME_DATA = 65536
+
+# Max. length of an encoded uint64 uvarint
+MAX_UVARINT_LENGTH = 10
+
+# Upper bound of any eth2 req/resp payload, ssz length prefixes above this are rejected before decoding.
+MAX_CHUNK_SIZE = 2**20
+
+
+class CodecError(Exception):
+    pass
+
+
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+try:
+    import crc32c as _crc32c_module
+    # Older releases of the crc32c package only provide the function as crc32.
+    _crc32c = getattr(_crc32c_module, 'crc32c', None) or _crc32c_module.crc32
+    CRC32C_NATIVE = True
+except ImportError:
+    CRC32C_NATIVE = False
+    _CRC32C_TABLE = _make_crc32c_table()
+
+    # Pure-python fallback, install the crc32c package for a native implementation.
+    def _crc32c(data: Buffer) -> int:
+        table = _CRC32C_TABLE
+        crc = 0xffffffff
+        for b in bytes(data):
+            crc = table[(crc ^ b) & 0xff] ^ (crc >> 8)
+        return crc ^ 0xffffffff
+
+
+def masked_crc32c(data: Buffer) -> int:
+    crc = _crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
+
+
+def encode_uvarint(n: int) -> bytes:
+    assert n >= 0
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_uvarint(buf: Buffer, offset: int = 0) -> Tuple[int, int]:
+    """
+    Return the uvarint at ``offset`` in ``buf``, and the offset right after it.
+    """
+    result = 0
+    shift = 0
+    for i in range(offset, min(offset + MAX_UVARINT_LENGTH, len(buf))):
+        b = buf[i]
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, i + 1
+        shift += 7
+    if len(buf) - offset < MAX_UVARINT_LENGTH:
+        raise CodecError("unexpected end of input in uvarint")
+    raise CodecError("uvarint overflows uint64")
+
+
+def compress_frames(data: Buffer, stream_identifier: bool = True) -> bytes:
+    """
+    Return ``data`` in the snappy frame format. Frames that do not compress well are stored uncompressed.
+    """
+    view = memoryview(data)
+    out = [STREAM_IDENTIFIER] if stream_identifier else []
+    for start in range(0, len(view), MAX_FRAME_DATA):
+        frame_data = view[start:start + MAX_FRAME_DATA]
+        crc = masked_crc32c(frame_data).to_bytes(4, 'little')
+        compressed = snappy.compress(frame_data)
+        # Same threshold as the reference implementation: keep compressed only if it saves at least 1/8th.
+        if len(compressed) < len(frame_data) - len(frame_data) // 8:
+            frame_type, body = FRAME_COMPRESSED, compressed
+        else:
+            frame_type, body = FRAME_UNCOMPRESSED, frame_data
+        out.append(bytes((frame_type,)) + (len(body) + 4).to_bytes(3, 'little') + crc)
+        out.append(body)
+    return b''.join(out)
+
+
+def decompress_frames(buf: Buffer, offset: int = 0, length: Optional[int] = None,
+                      verify_checksums: bool = True) -> Tuple[bytes, int]:
+    """
+    Decode snappy frames from ``buf`` at ``offset``, until ``length`` uncompressed bytes are read
+    (or the end of the buffer if ``length`` is None). Return the data, and the offset after the last frame read.
+    """
+    view = memoryview(buf)
+    out = bytearray()
+    seen_identifier = False
+    while offset < len(view):
+        if length is not None and len(out) >= length:
+            # The stream identifier is still part of this payload, also when the payload is empty.
+            if seen_identifier or view[offset] != FRAME_STREAM_IDENTIFIER:
+                break
+        if offset + 4 > len(view):
+            raise CodecError("unexpected end of input in frame header")
+        frame_type = view[offset]
+        frame_len = int.from_bytes(view[offset + 1:offset + 4], 'little')
+        body_start = offset + 4
+        body_end = body_start + frame_len
+        if body_end > len(view):
+            raise CodecError(f"frame of {frame_len} bytes exceeds input")
+        offset = body_end
+
+        if frame_type == FRAME_STREAM_IDENTIFIER:
+            if view[body_start:body_end] != STREAM_IDENTIFIER[4:]:
+                raise CodecError("invalid stream identifier")
+            seen_identifier = True
+            continue
+        if frame_type in (FRAME_COMPRESSED, FRAME_UNCOMPRESSED):
+            if frame_len < 4:
+                raise CodecError("data frame too short for checksum")
+            crc = int.from_bytes(view[body_start:body_start + 4], 'little')
+            body = view[body_start + 4:body_end]
+            if frame_type == FRAME_COMPRESSED:
+                try:
+                    data = snappy.uncompress(body)
+                except Exception as e:
+                    raise CodecError(f"invalid compressed frame: {e}")
+            else:
+                data = body
+            if len(data) > MAX_FRAME_DATA:
+                raise CodecError(f"frame data of {len(data)} bytes exceeds frame limit")
+            if verify_checksums and masked_crc32c(data) != crc:
+                raise CodecError("frame checksum mismatch")
+            out += data
+            continue
+        if frame_type == FRAME_PADDING or 0x80 <= frame_type <= 0xfd:
+            continue  # skippable
+        raise CodecError(f"unskippable reserved frame type {frame_type:#x}")
+
+    if length is not None and len(out) != length:
+        raise CodecError(f"expected {length} bytes, decoded {len(out)}")
+    return bytes(out), offset
+
+
+def _encode_payload(ssz_bytes: Buffer, compression: bool) -> bytes:
+    prefix = encode_uvarint(len(ssz_bytes))
+    if compression:
+        return prefix + compress_frames(ssz_bytes)
+    return prefix + bytes(ssz_bytes)
+
+
+def _decode_payload(view: memoryview, offset: int, compression: bool, max_length: int) -> Tuple[bytes, int]:
+    length, offset = decode_uvarint(view, offset)
+    if length > max_length:
+        raise CodecError(f"payload length {length} exceeds max {max_length}")
+    if compression:
+        return decompress_frames(view, offset, length)
+    end = offset + length
+    if end > len(view):
+        raise CodecError("unexpected end of input in payload")
+    return bytes(view[offset:end]), end
+
+
+def encode_request(ssz_bytes: Buffer, compression: bool = True) -> bytes:
+    return _encode_payload(ssz_bytes, compression)
+
+
+def decode_request(buf: Buffer, compression: bool = True, max_length: int = MAX_CHUNK_SIZE) -> bytes:
+    view = memoryview(buf)
+    payload, offset = _decode_payload(view, 0, compression, max_length)
+    if offset != len(view):
+        raise CodecError(f"{len(view) - offset} trailing bytes after request")
+    return payload
+
+
+def encode_response_chunk(result: int, ssz_bytes: Buffer, compression: bool = True) -> bytes:
+    """
+    Return the wire bytes of a response chunk. For error results, ``ssz_bytes`` is the encoded error message.
+    """
+    return bytes((result,)) + _encode_payload(ssz_bytes, compression)
+
+
+def decode_response_chunk(buf: Buffer, offset: int = 0, compression: bool = True,
+                          max_length: int = MAX_CHUNK_SIZE) -> Tuple[int, bytes, int]:
+    """
+    Decode the response chunk at ``offset``. Return the result code, the ssz bytes, and the offset of the next chunk.
+    """
+    view = memoryview(buf)
+    if offset >= len(view):
+        raise CodecError("unexpected end of input, expected result byte")
+    result = view[offset]
+    payload, offset = _decode_payload(view, offset + 1, compression, max_length)
+    return result, payload, offset
+
+
+def iter_response_chunks(buf: Buffer, compression: bool = True,
+                         max_length: int = MAX_CHUNK_SIZE) -> Iterator[Tuple[int, bytes]]:
+    view = memoryview(buf)
+    offset = 0
+    while offset < len(view):
+        result, payload, offset = decode_response_chunk(view, offset, compression, max_length)
+        yield result, payload
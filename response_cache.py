@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Union
+
+from block_store import BlockStore, BlockEntry
+from fastspec import Root
+
+# Byte-bounded LRU of block response payloads, keyed by block root. A block never changes for a given root,
+# so entries are never stale: they only leave the cache when it is full.
+#
+# Entries are the hex payloads Rumor takes in resp.chunk.raw. Rumor snappy-compresses every chunk itself,
+# and takes no pre-framed chunks, so the cache saves the block reads and hex encoding, not the compression.
+
+# Default bound of the cached bytes, enough for the blocks of a few recent 1024-slot ranges.
+DEFAULT_MAX_BYTES = 64 << 20
+
+
+class ResponseCache(object):
+    """
+    Shared by the blocks_by_range and blocks_by_root handlers:
+
+        cache = ResponseCache(store)
+        await resp.chunk.raw(req_id, cache.rumor_payload(entry), done=...)
+    """
+    store: BlockStore
+    max_bytes: int
+    size: int  # bytes currently cached
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, store: BlockStore, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._chunks: "OrderedDict[Root, str]" = OrderedDict()
+
+    def _get(self, key: Root, build: Callable[[], str]) -> str:
+        chunks = self._chunks
+        chunk = chunks.get(key)
+        if chunk is not None:
+            chunks.move_to_end(key)
+            self.hits += 1
+            return chunk
+        self.misses += 1
+        chunk = build()
+        size = len(chunk)
+        if size > self.max_bytes:
+            return chunk  # would evict everything else, serve it uncached
+        chunks[key] = chunk
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = chunks.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+        return chunk
+
+    def rumor_payload(self, entry: BlockEntry) -> str:
+        def build() -> str:
+            with self.store.block_bytes(entry) as block_bytes:
+                return block_bytes.hex()
+        return self._get(entry.root, build)
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def __contains__(self, root: Root) -> bool:
+        return root in self._chunks
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            'entries': len(self._chunks),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+        }
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        self._chunks.clear()
+        self.size = 0
@@ -0,0 +1,209 @@
+import argparse
+import json
+import random
+import sys
+import time
+from typing import Callable, Dict, List as PyList, Sequence, Tuple
+
+import snappy
+
+from fastspec import (
+    SignedBeaconBlock, BeaconBlock, BeaconBlockBody, Attestation, AttestationData, Checkpoint, Deposit, DepositData,
+    ProposerSlashing, SignedBeaconBlockHeader, BeaconBlockHeader, AttesterSlashing, IndexedAttestation,
+    SignedVoluntaryExit, VoluntaryExit, Eth1Data, Bitlist, Vector, Bytes32, GENESIS_FORK_VERSION,
+    MAX_VALIDATORS_PER_COMMITTEE, MAX_ATTESTATIONS, MAX_DEPOSITS, MAX_PROPOSER_SLASHINGS, MAX_ATTESTER_SLASHINGS,
+    MAX_VOLUNTARY_EXITS, MAX_EFFECTIVE_BALANCE, DEPOSIT_CONTRACT_TREE_DEPTH, TARGET_COMMITTEE_SIZE,
+)
+from messages import Status, BlocksByRange, BlocksByRoot
+from reqresp_codec import compress_frames, decompress_frames, CRC32C_NATIVE
+
+# Compression modes: snappy frame format (what eth2 ssz_snappy uses), raw snappy block format, and no compression.
+MODES = ('framed', 'block', 'none')
+
+
+def _rand_bytes(rng: random.Random, n: int) -> bytes:
+    return rng.getrandbits(n * 8).to_bytes(n, 'little')
+
+
+def make_full_block(rng: random.Random, slot: int = 12345, participation: float = 0.9,
+                    deposits: int = MAX_DEPOSITS, proposer_slashings: int = 0, attester_slashings: int = 0,
+                    voluntary_exits: int = 0) -> SignedBeaconBlock:
+    """
+    Return a block with ``MAX_ATTESTATIONS`` attestations of ``TARGET_COMMITTEE_SIZE`` committees,
+    ``participation`` of every committee voting. Signatures, roots and pubkeys are random bytes,
+    like real ones they are incompressible.
+    """
+    epoch = slot // 32
+    target = Checkpoint(epoch=epoch, root=_rand_bytes(rng, 32))
+    source = Checkpoint(epoch=epoch - 1, root=_rand_bytes(rng, 32))
+    # Attestations of a few recent slots vote for the same head and target, as in practice.
+    heads = [_rand_bytes(rng, 32) for _ in range(4)]
+
+    def attestation_data(i: int) -> AttestationData:
+        return AttestationData(slot=slot - 1 - i % 4, index=i // 4, beacon_block_root=heads[i % 4],
+                               source=source, target=target)
+
+    attestations = [
+        Attestation(
+            aggregation_bits=Bitlist[MAX_VALIDATORS_PER_COMMITTEE](
+                *(rng.random() < participation for _ in range(TARGET_COMMITTEE_SIZE))),
+            data=attestation_data(i),
+            signature=_rand_bytes(rng, 96),
+        )
+        for i in range(MAX_ATTESTATIONS)
+    ]
+
+    deposit_list = [
+        Deposit(
+            proof=Vector[Bytes32, DEPOSIT_CONTRACT_TREE_DEPTH + 1](
+                *(_rand_bytes(rng, 32) for _ in range(DEPOSIT_CONTRACT_TREE_DEPTH + 1))),
+            data=DepositData(pubkey=_rand_bytes(rng, 48), withdrawal_credentials=b'\x00' + _rand_bytes(rng, 31),
+                             amount=MAX_EFFECTIVE_BALANCE, signature=_rand_bytes(rng, 96)),
+        )
+        for _ in range(deposits)
+    ]
+
+    def signed_header() -> SignedBeaconBlockHeader:
+        return SignedBeaconBlockHeader(
+            message=BeaconBlockHeader(slot=slot - 10, parent_root=_rand_bytes(rng, 32),
+                                      state_root=_rand_bytes(rng, 32), body_root=_rand_bytes(rng, 32)),
+            signature=_rand_bytes(rng, 96))
+
+    def indexed_attestation(i: int) -> IndexedAttestation:
+        return IndexedAttestation(attesting_indices=sorted(rng.sample(range(100000), TARGET_COMMITTEE_SIZE)),
+                                  data=attestation_data(i), signature=_rand_bytes(rng, 96))
+
+    block = BeaconBlock(
+        slot=slot,
+        parent_root=_rand_bytes(rng, 32),
+        state_root=_rand_bytes(rng, 32),
+        body=BeaconBlockBody(
+            randao_reveal=_rand_bytes(rng, 96),
+            eth1_data=Eth1Data(deposit_root=_rand_bytes(rng, 32), deposit_count=100000,
+                               block_hash=_rand_bytes(rng, 32)),
+            graffiti=b'snappy experiment'.ljust(32, b'\x00'),
+            proposer_slashings=[ProposerSlashing(proposer_index=rng.randrange(100000),
+                                                 signed_header_1=signed_header(), signed_header_2=signed_header())
+                                for _ in range(proposer_slashings)],
+            attester_slashings=[AttesterSlashing(attestation_1=indexed_attestation(i),
+                                                 attestation_2=indexed_attestation(i))
+                                for i in range(attester_slashings)],
+            attestations=attestations,
+            deposits=deposit_list,
+            voluntary_exits=[SignedVoluntaryExit(message=VoluntaryExit(epoch=epoch,
+                                                                       validator_index=rng.randrange(100000)),
+                                                 signature=_rand_bytes(rng, 96))
+                             for _ in range(voluntary_exits)],
+        ),
+    )
+    return SignedBeaconBlock(message=block, signature=_rand_bytes(rng, 96))
+
+
+def make_payloads(seed: int = 0) -> Dict[str, bytes]:
+    rng = random.Random(seed)
+    return {
+        'status': Status(version=GENESIS_FORK_VERSION, finalized_root=_rand_bytes(rng, 32), finalized_epoch=1000,
+                         head_root=_rand_bytes(rng, 32), head_slot=32032).encode_bytes(),
+        'blocks_by_range': BlocksByRange(head_block_root=_rand_bytes(rng, 32), start_slot=32000, count=64,
+                                         step=1).encode_bytes(),
+        'blocks_by_root_64': BlocksByRoot(*(_rand_bytes(rng, 32) for _ in range(64))).encode_bytes(),
+        'blocks_by_root_1024': BlocksByRoot(*(_rand_bytes(rng, 32) for _ in range(1024))).encode_bytes(),
+        'block_empty': SignedBeaconBlock(message=BeaconBlock(slot=12345)).encode_bytes(),
+        'block_attestations': make_full_block(rng, deposits=0).encode_bytes(),
+        'block_full': make_full_block(rng, proposer_slashings=MAX_PROPOSER_SLASHINGS,
+                                      attester_slashings=MAX_ATTESTER_SLASHINGS,
+                                      voluntary_exits=MAX_VOLUNTARY_EXITS).encode_bytes(),
+    }
+
+
+def _codec(mode: str) -> Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]:
+    if mode == 'framed':
+        return compress_frames, lambda data: decompress_frames(data)[0]
+    if mode == 'block':
+        return snappy.compress, snappy.uncompress
+    if mode == 'none':
+        return bytes, bytes
+    raise ValueError(f"unknown mode: {mode}")
+
+
+def _percentile(sorted_values: Sequence[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+def _time_op(fn: Callable[[bytes], bytes], data: bytes, iterations: int) -> PyList[float]:
+    perf_counter = time.perf_counter
+    durations = []
+    for _ in range(iterations):
+        start = perf_counter()
+        fn(data)
+        durations.append(perf_counter() - start)
+    durations.sort()
+    return durations
+
+
+def bench_payload(name: str, payload: bytes, mode: str, iterations: int) -> dict:
+    compress, decompress = _codec(mode)
+    encoded = compress(payload)
+    assert decompress(encoded) == payload, f"{mode} round-trip failed for {name}"
+
+    compress_times = _time_op(compress, payload, iterations)
+    decompress_times = _time_op(decompress, encoded, iterations)
+    compress_total = sum(compress_times)
+    decompress_total = sum(decompress_times)
+    return {
+        'payload': name,
+        'mode': mode,
+        'size': len(payload),
+        'encoded_size': len(encoded),
+        'ratio': len(encoded) / len(payload) if payload else 1.0,
+        'compress_mb_s': len(payload) * iterations / compress_total / 1e6 if compress_total else 0.0,
+        'decompress_mb_s': len(payload) * iterations / decompress_total / 1e6 if decompress_total else 0.0,
+        'compress_us': {f"p{p}": _percentile(compress_times, p) * 1e6 for p in (50, 90, 99)},
+        'decompress_us': {f"p{p}": _percentile(decompress_times, p) * 1e6 for p in (50, 90, 99)},
+    }
+
+
+def format_table(results: Sequence[dict]) -> str:
+    lines = [f"{'payload':<20} {'mode':<7} {'size':>8} {'encoded':>8} {'ratio':>6} {'comp MB/s':>10} "
+             f"{'decomp MB/s':>11} {'comp p50/p99 us':>17} {'decomp p50/p99 us':>19}"]
+    for r in results:
+        c, d = r['compress_us'], r['decompress_us']
+        lines.append(f"{r['payload']:<20} {r['mode']:<7} {r['size']:>8} {r['encoded_size']:>8} {r['ratio']:>6.3f} "
+                     f"{r['compress_mb_s']:>10.1f} {r['decompress_mb_s']:>11.1f} "
+                     f"{c['p50']:>8.1f}/{c['p99']:<8.1f} {d['p50']:>9.1f}/{d['p99']:<9.1f}")
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Measure snappy compression of eth2 req/resp SSZ payloads.")
+    parser.add_argument('--iterations', type=int, default=1000, help="timed runs per payload, mode and direction")
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=MODES)
+    parser.add_argument('--payloads', nargs='*', help="names of the payloads to measure (default: all)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="output JSON instead of a table")
+    args = parser.parse_args(args)
+
+    payloads = make_payloads(args.seed)
+    results = []
+    for name, payload in payloads.items():
+        if args.payloads and name not in args.payloads:
+            continue
+        for mode in args.modes:
+            results.append(bench_payload(name, payload, mode, args.iterations))
+
+    if args.json:
+        json.dump({'iterations': args.iterations, 'timestamp': int(time.time()), 'crc32c_native': CRC32C_NATIVE,
+                   'results': results}, sys.stdout, indent=2)
+        print()
+    else:
+        if not CRC32C_NATIVE:
+            print("warning: crc32c package not installed, framed results are dominated by the python checksum",
+                  file=sys.stderr)
+        print(format_table(results))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
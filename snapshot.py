@@ -0,0 +1,321 @@
+import io
+import mmap
+import struct
+import sys
+import zlib
+from array import array
+from typing import List as PyList, Sequence, Tuple
+
+from remerkleable.tree import Node, PairNode
+
+from fastspec import (
+    BeaconState, EpochsContext, ShufflingEpoch, BLSPubkey, Epoch, Root, ValidatorIndex,
+    SLOTS_PER_EPOCH, shuffling_registry,
+)
+
+# Snapshot of a (BeaconState, EpochsContext) pair, so a restart does not have to re-run
+# EpochsContext.load_state (pubkey maps, 3 shufflings, proposers) and re-hash the full state.
+#
+# Layout (all integers little-endian):
+#
+#   header:   magic (8) | version u32 | section count u32 | header crc32 u32 | reserved u32
+#   sections: count * (kind u32 | flags u32 | offset u64 | length u64 | crc32 u32 | reserved u32)
+#   data:     every section starts at a SNAPSHOT_ALIGN boundary, so integer arrays can be
+#             cast directly from a mmap of the file, without copying or unaligned reads.
+#
+# The header crc covers the section table, each section carries the crc32 of its own data.
+
+SNAPSHOT_MAGIC = b'FSSNAP\x00\x00'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGN = 64
+
+SECTION_META = 1  # state slot, state root, flags
+SECTION_STATE = 2  # SSZ encoded BeaconState
+SECTION_TREE_ROOTS = 3  # cached subtree roots of the state, see _collect_tree_roots
+SECTION_PUBKEYS = 4  # index2pubkey, 48 bytes per validator
+SECTION_PREV_SHUFFLING = 5
+SECTION_CURR_SHUFFLING = 6
+SECTION_NEXT_SHUFFLING = 7
+SECTION_PROPOSERS = 8  # SLOTS_PER_EPOCH uint64 proposer indices
+
+META_FLAG_SHARED_PREV_SHUFFLING = 1 << 0  # previous shuffling is the current shuffling (genesis)
+
+# Subtree roots deeper than this (counted from the state root) are not stored, they are cheap to re-hash.
+# The default covers the top of the validator registry and the roots of the individual validator containers,
+# which is where the bulk of the hashing work of a fresh state goes.
+DEFAULT_TREE_ROOTS_DEPTH = 46
+
+_HEADER = struct.Struct('<8sIIII')
+_SECTION = struct.Struct('<IIQQII')
+_META = struct.Struct('<QQ32s')
+_SHUFFLING_HEADER = struct.Struct('<QQ')
+_PUBKEY_SIZE = 48
+
+_NATIVE_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _align(n: int) -> int:
+    return (n + SNAPSHOT_ALIGN - 1) // SNAPSHOT_ALIGN * SNAPSHOT_ALIGN
+
+
+def _uint64_array_bytes(values: Sequence[int]) -> bytes:
+    arr = array('Q', values)
+    if not _NATIVE_LITTLE_ENDIAN:
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _uint64_list(view: memoryview) -> PyList[int]:
+    if _NATIVE_LITTLE_ENDIAN:
+        with view.cast('Q') as ints:
+            return ints.tolist()
+    arr = array('Q', view.tobytes())
+    arr.byteswap()
+    return arr.tolist()
+
+
+def _collect_tree_roots(backing: Node, max_depth: int) -> Tuple[bytes, bytes]:
+    # Pre-order walk over the pair nodes of the tree, emitting a descend-flag per visited pair node,
+    # and the (cached) root of every node that is descended into.
+    # Shared zero-subtrees are root-nodes, and never show up here.
+    # Note: exact type checks, isinstance against the Node protocol is too slow for a full tree walk.
+    flags = bytearray()
+    roots = io.BytesIO()
+    stack = [(backing, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if type(node) is not PairNode:
+            continue
+        if depth >= max_depth:
+            flags.append(0)
+            continue
+        flags.append(1)
+        roots.write(node.merkle_root())
+        # right is pushed first, to visit left first
+        stack.append((node.right, depth + 1))
+        stack.append((node.left, depth + 1))
+    return bytes(flags), roots.getvalue()
+
+
+def _seed_tree_roots(backing: Node, flags: bytes, roots: bytes) -> int:
+    # Replays the walk of _collect_tree_roots over a freshly deserialized tree, and fills in the root caches
+    # of the pair nodes. Returns the number of seeded nodes.
+    # The tree shape follows from the SSZ type and the list lengths, so it matches the one of the writer.
+    # If it does not (a walk that runs out of flags or roots, or leaves some over), the roots are not
+    # for this tree, and the state cannot be used.
+    flag_i = 0
+    root_i = 0
+    root_count = len(roots) // 32
+    stack = [backing]
+    while stack:
+        node = stack.pop()
+        if type(node) is not PairNode:
+            continue
+        if flag_i >= len(flags):
+            raise SnapshotError("snapshot tree roots do not match the state tree: out of flags")
+        flag = flags[flag_i]
+        flag_i += 1
+        if flag == 0:
+            continue
+        if root_i >= root_count:
+            raise SnapshotError("snapshot tree roots do not match the state tree: out of roots")
+        node._root = roots[root_i * 32:(root_i + 1) * 32]
+        root_i += 1
+        stack.append(node.right)
+        stack.append(node.left)
+    if flag_i != len(flags) or root_i * 32 != len(roots):
+        raise SnapshotError("snapshot tree roots do not match the state tree: unused flags or roots")
+    return root_i
+
+
+def _encode_shuffling(shuffling: ShufflingEpoch) -> bytes:
+    count = len(shuffling.active_indices)
+    return (_SHUFFLING_HEADER.pack(shuffling.epoch, count)
+            + _uint64_array_bytes(shuffling.active_indices)
+            + _uint64_array_bytes(shuffling.shuffling))
+
+
+def _decode_shuffling(view: memoryview) -> ShufflingEpoch:
+    epoch, count = _SHUFFLING_HEADER.unpack_from(view, 0)
+    start = _SHUFFLING_HEADER.size
+    mid = start + count * 8
+    end = mid + count * 8
+    if end != len(view):
+        raise SnapshotError(f"shuffling section has invalid length {len(view)}, expected {end}")
+    return ShufflingEpoch.from_shuffling(Epoch(epoch), _uint64_list(view[start:mid]), _uint64_list(view[mid:end]))
+
+
+def write_snapshot(path: str, state: BeaconState, epochs_ctx: EpochsContext,
+                   tree_roots_depth: int = DEFAULT_TREE_ROOTS_DEPTH) -> None:
+    # Hashing the state here is usually free: the roots are cached from the last process_slot.
+    state_root = state.hash_tree_root()
+
+    meta_flags = 0
+    if epochs_ctx.previous_shuffling is epochs_ctx.current_shuffling:
+        meta_flags |= META_FLAG_SHARED_PREV_SHUFFLING
+
+    tree_flags, tree_roots = _collect_tree_roots(state.get_backing(), tree_roots_depth)
+
+    sections = [
+        (SECTION_META, _META.pack(state.slot, meta_flags, state_root)),
+        (SECTION_STATE, state.encode_bytes()),
+        (SECTION_TREE_ROOTS, struct.pack('<Q', len(tree_flags)) + tree_flags + tree_roots),
+        (SECTION_PUBKEYS, b''.join(epochs_ctx.index2pubkey)),
+        (SECTION_CURR_SHUFFLING, _encode_shuffling(epochs_ctx.current_shuffling)),
+        (SECTION_NEXT_SHUFFLING, _encode_shuffling(epochs_ctx.next_shuffling)),
+        (SECTION_PROPOSERS, _uint64_array_bytes(epochs_ctx.proposers)),
+    ]
+    if not meta_flags & META_FLAG_SHARED_PREV_SHUFFLING:
+        sections.append((SECTION_PREV_SHUFFLING, _encode_shuffling(epochs_ctx.previous_shuffling)))
+
+    table = io.BytesIO()
+    offset = _align(_HEADER.size + _SECTION.size * len(sections))
+    offsets = []
+    for kind, data in sections:
+        table.write(_SECTION.pack(kind, 0, offset, len(data), zlib.crc32(data), 0))
+        offsets.append(offset)
+        offset = _align(offset + len(data))
+    table_bytes = table.getvalue()
+
+    with io.open(path, 'wb') as f:
+        f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(sections), zlib.crc32(table_bytes), 0))
+        f.write(table_bytes)
+        for (kind, data), section_offset in zip(sections, offsets):
+            f.write(b'\x00' * (section_offset - f.tell()))
+            f.write(data)
+
+
+class Snapshot(object):
+    slot: int
+    state_root: Root
+    flags: int
+
+    # Opens the snapshot with a read-only mmap; sections are only copied out when they are decoded.
+    def __init__(self, path: str, verify_checksums: bool = True):
+        self._file = io.open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        self._view = memoryview(self._mmap)
+        self._sections = {}
+        try:
+            self._read_header(verify_checksums)
+        except Exception:
+            self.close()
+            raise
+
+    def _read_header(self, verify_checksums: bool):
+        if len(self._view) < _HEADER.size:
+            raise SnapshotError("snapshot too small")
+        magic, version, count, table_crc, _ = _HEADER.unpack_from(self._view, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise SnapshotError(f"not a snapshot file, bad magic: {magic!r}")
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(f"unsupported snapshot version {version}, expected {SNAPSHOT_VERSION}")
+        table_end = _HEADER.size + count * _SECTION.size
+        with self._view[_HEADER.size:table_end] as table:
+            if len(table) != count * _SECTION.size or zlib.crc32(table) != table_crc:
+                raise SnapshotError("snapshot section table is corrupted")
+            entries = [_SECTION.unpack_from(table, i * _SECTION.size) for i in range(count)]
+        for kind, _, offset, length, crc, _ in entries:
+            if offset + length > len(self._view):
+                raise SnapshotError(f"snapshot section {kind} is truncated")
+            if verify_checksums:
+                with self._view[offset:offset + length] as data:
+                    if zlib.crc32(data) != crc:
+                        raise SnapshotError(f"snapshot section {kind} checksum mismatch")
+            self._sections[kind] = (offset, length)
+
+        with self._section(SECTION_META) as meta:
+            slot, self.flags, state_root = _META.unpack(meta)
+        self.slot = slot
+        self.state_root = Root(state_root)
+
+    # Returns a view into the mmap; callers must not hold on to it after the snapshot is closed.
+    def _section(self, kind: int) -> memoryview:
+        if kind not in self._sections:
+            raise SnapshotError(f"snapshot is missing section {kind}")
+        offset, length = self._sections[kind]
+        return self._view[offset:offset + length]
+
+    def load_state(self, verify_root: bool = False) -> BeaconState:
+        """
+        Decode the state, with the stored subtree roots seeded into its tree.
+        With verify_root, the roots are not seeded but re-hashed from the state data instead (slow),
+        and checked against the stored state root.
+        """
+        with self._section(SECTION_STATE) as state_bytes:
+            state = BeaconState.decode_bytes(bytes(state_bytes))
+        if verify_root:
+            if state.hash_tree_root() != self.state_root:
+                raise SnapshotError("snapshot state does not match the stored state root")
+            return state
+        with self._section(SECTION_TREE_ROOTS) as tree_section:
+            (flags_len,) = struct.unpack_from('<Q', tree_section, 0)
+            flags = tree_section[8:8 + flags_len].tobytes()
+            roots = tree_section[8 + flags_len:].tobytes()
+        _seed_tree_roots(state.get_backing(), flags, roots)
+        return state
+
+    def _load_shuffling(self, kind: int, state: BeaconState) -> ShufflingEpoch:
+        with self._section(kind) as view:
+            shuffling = _decode_shuffling(view)
+        # The seed is not stored, it is recomputed from the (restored) state to get the registry key.
+        return shuffling_registry.register(state, shuffling)
+
+    def load_epochs_ctx(self, state: BeaconState) -> EpochsContext:
+        """
+        Load the context of the snapshot of ``state``. The shufflings are registered in the shuffling registry,
+        so they are shared with the contexts of other branches, and the ones loaded from the same snapshot again.
+        """
+        epochs_ctx = EpochsContext()
+
+        with self._section(SECTION_PUBKEYS) as pubkeys:
+            if len(pubkeys) % _PUBKEY_SIZE != 0:
+                raise SnapshotError(f"invalid pubkeys section length {len(pubkeys)}")
+            index2pubkey = [BLSPubkey(pubkeys[i:i + _PUBKEY_SIZE].tobytes())
+                            for i in range(0, len(pubkeys), _PUBKEY_SIZE)]
+        epochs_ctx.index2pubkey = index2pubkey
+        epochs_ctx.pubkey2index = {pubkey: ValidatorIndex(i) for i, pubkey in enumerate(index2pubkey)}
+
+        epochs_ctx.current_shuffling = self._load_shuffling(SECTION_CURR_SHUFFLING, state)
+        epochs_ctx.next_shuffling = self._load_shuffling(SECTION_NEXT_SHUFFLING, state)
+        if self.flags & META_FLAG_SHARED_PREV_SHUFFLING:
+            epochs_ctx.previous_shuffling = epochs_ctx.current_shuffling
+        else:
+            epochs_ctx.previous_shuffling = self._load_shuffling(SECTION_PREV_SHUFFLING, state)
+
+        with self._section(SECTION_PROPOSERS) as view:
+            proposers = _uint64_list(view)
+        if len(proposers) != SLOTS_PER_EPOCH:
+            raise SnapshotError(f"expected {SLOTS_PER_EPOCH} proposers, got {len(proposers)}")
+        epochs_ctx.proposers = proposers
+        return epochs_ctx
+
+    def close(self):
+        self._sections = {}
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "Snapshot":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_snapshot(path: str, verify_checksums: bool = True,
+                  verify_root: bool = False) -> Tuple[BeaconState, EpochsContext]:
+    with Snapshot(path, verify_checksums=verify_checksums) as snap:
+        state = snap.load_state(verify_root=verify_root)
+        epochs_ctx = snap.load_epochs_ctx(state)
+    if len(epochs_ctx.index2pubkey) != len(state.validators):
+        raise SnapshotError("snapshot pubkey cache does not match the state validator count")
+    return state, epochs_ctx
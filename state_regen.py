@@ -0,0 +1,290 @@
+import argparse
+import os
+import re
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List as PyList, Optional, Tuple
+
+from fastspec import (
+    BeaconState, EpochsContext, Epoch, Root, Slot, SLOTS_PER_EPOCH,
+    compute_epoch_at_slot, compute_start_slot_at_epoch, process_slots, state_transition,
+)
+from block_store import BlockStore, BlockEntry
+from epoch_precompute import head_block_root
+from replay import checkpoint_path, write_checkpoint
+from snapshot import Snapshot, read_snapshot, write_snapshot
+
+# Historical states from sparse snapshots: a full state snapshot every N epochs, the blocks in between
+# come from the block store. A state at some slot is regenerated from the nearest earlier snapshot
+# (or recently regenerated state), by replaying the blocks up to the slot.
+# A larger interval costs less disk, but more replay per request: up to N epochs of blocks.
+#
+# Snapshots are the checkpoint files of replay.py, so a replay with --checkpoint-epochs fills the directory too.
+#
+# The blocks to replay are those of the chain of a head block, found by following the parent roots back
+# from the head: after a re-org the store holds the blocks of both branches, and its slot index has
+# whichever block was written last for a slot.
+
+DEFAULT_SNAPSHOT_EPOCHS = 32
+DEFAULT_CACHE_SIZE = 4
+
+_CHECKPOINT_NAME = re.compile(r'^checkpoint_(\d+)\.snap$')
+
+
+class StateRegenError(Exception):
+    pass
+
+
+class RegenStats(object):
+    requests: int
+    cache_hits: int
+    snapshot_loads: int
+    replayed_blocks: int
+    replay_time: float
+
+    def __init__(self):
+        self.requests = 0
+        self.cache_hits = 0
+        self.snapshot_loads = 0
+        self.replayed_blocks = 0
+        self.replay_time = 0.0
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+class StateRegen(object):
+    """
+    Regenerates states of the chain in a block store:
+
+        regen = StateRegen(store, 'snapshots', snapshot_epochs=32)
+        regen.maybe_snapshot(epochs_ctx, state)  # while importing blocks, stores every 32nd epoch
+        state, epochs_ctx = regen.get_state(slot, head_root)
+
+    Snapshots are expected to be of the canonical chain: a snapshot that is not an ancestor of the requested
+    head fails the request.
+    """
+    store: BlockStore
+    snapshot_dir: str
+    snapshot_epochs: int
+    cache_size: int
+    snapshots: Dict[Slot, str]  # snapshot state slot -> path
+    stats: RegenStats
+
+    def __init__(self, store: BlockStore, snapshot_dir: str, snapshot_epochs: int = DEFAULT_SNAPSHOT_EPOCHS,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        assert snapshot_epochs > 0
+        self.store = store
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_epochs = snapshot_epochs
+        self.cache_size = cache_size
+        self.snapshots = {}
+        # Recently regenerated states, by slot and the root of the latest block in the state
+        self._cache: "OrderedDict[Tuple[Slot, bytes], Tuple[BeaconState, EpochsContext]]" = OrderedDict()
+        self.stats = RegenStats()
+        os.makedirs(snapshot_dir, exist_ok=True)
+        self._scan_snapshots()
+
+    def _scan_snapshots(self):
+        for name in os.listdir(self.snapshot_dir):
+            if _CHECKPOINT_NAME.match(name):
+                path = os.path.join(self.snapshot_dir, name)
+                # Only the header is read here, the checksums are verified when the snapshot is loaded.
+                with Snapshot(path, verify_checksums=False) as snap:
+                    self.snapshots[Slot(snap.slot)] = path
+
+    def maybe_snapshot(self, epochs_ctx: EpochsContext, state: BeaconState) -> Optional[str]:
+        """Snapshot ``state`` if its epoch is on the snapshot interval and not snapshotted yet."""
+        epoch = compute_epoch_at_slot(state.slot)
+        if epoch % self.snapshot_epochs != 0:
+            return None
+        if os.path.exists(checkpoint_path(self.snapshot_dir, epoch)):
+            return None
+        return self.add_snapshot(epochs_ctx, state)
+
+    def add_snapshot(self, epochs_ctx: EpochsContext, state: BeaconState) -> str:
+        path = write_checkpoint(self.snapshot_dir, state, epochs_ctx)
+        # One snapshot per epoch: a later state of the same epoch replaces the file.
+        self.snapshots = {slot: p for slot, p in self.snapshots.items() if p != path}
+        self.snapshots[Slot(state.slot)] = path
+        return path
+
+    def _snapshot_base(self, slot: Slot) -> Tuple[Optional[Slot], Optional[str]]:
+        # Nearest snapshot at or before slot: (slot, path), or (None, None).
+        best_slot, best_path = None, None
+        for snap_slot, path in self.snapshots.items():
+            if snap_slot <= slot and (best_slot is None or snap_slot > best_slot):
+                best_slot, best_path = snap_slot, path
+        return best_slot, best_path
+
+    def _cached_base(self, root: bytes, min_slot: Slot, max_slot: Slot) -> Optional[Tuple[Slot, bytes]]:
+        # Latest cached state on block ``root``, from min_slot up to and including max_slot.
+        best = None
+        for key in self._cache:
+            cached_slot, cached_root = key
+            if cached_root == root and min_slot <= cached_slot <= max_slot and (best is None or cached_slot > best[0]):
+                best = key
+        return best
+
+    def default_head(self) -> bytes:
+        # The block of the highest stored slot: after a re-org, the block written last for it.
+        _, last = self.store.slot_bounds()
+        if last is None:
+            raise StateRegenError("no blocks stored")
+        return bytes(self.store.get_slot(last).root)
+
+    def ancestors(self, root: bytes) -> Iterator[Tuple[bytes, Optional[BlockEntry]]]:
+        """
+        (root, entry) of block ``root`` and its ancestors, newest first, by parent root.
+        Ends with the first block that is not stored, with entry None.
+        """
+        store = self.store
+        while True:
+            entry = store.get_root(root)
+            yield root, entry
+            if entry is None:
+                return
+            root = store.parent_root(entry)
+
+    def chain(self, head_root: bytes, base_root: bytes) -> PyList[BlockEntry]:
+        """The stored blocks after block ``base_root`` up to and including block ``head_root``, in slot order."""
+        chain = []
+        for root, entry in self.ancestors(head_root):
+            if root == base_root:
+                chain.reverse()
+                return chain
+            if entry is None:
+                raise StateRegenError(f"block {base_root.hex()} is not an ancestor of {head_root.hex()}")
+            chain.append(entry)
+
+    def get_state(self, slot: Slot, head_root: Optional[Root] = None) -> Tuple[BeaconState, EpochsContext]:
+        """
+        Return the state at ``slot`` of the chain of ``head_root`` (default: see default_head): after the last block
+        of that chain at or before the slot, advanced through the empty slots after it.
+        The returned state and context are copies, the caller may modify them.
+        """
+        slot = Slot(slot)
+        self.stats.requests += 1
+        head_root = self.default_head() if head_root is None else bytes(head_root)
+        if head_root not in self.store:
+            raise StateRegenError(f"head block {head_root.hex()} is not stored")
+
+        snap_slot, path = self._snapshot_base(slot)
+        # Blocks to replay, newest first, down to a cached state or the snapshot on the chain.
+        chain: PyList[BlockEntry] = []
+        block_root = None  # of the block the requested state is on
+        base = None
+        for root, entry in self.ancestors(head_root):
+            if entry is not None and entry.slot > slot:
+                continue
+            if block_root is None:
+                block_root = root
+            # A cached state on this block, before the next block of the chain, and not before the snapshot
+            min_slot = max(entry.slot if entry is not None else 0, snap_slot if snap_slot is not None else 0)
+            base = self._cached_base(root, Slot(min_slot), Slot(chain[-1].slot - 1) if chain else slot)
+            if base is not None:
+                break
+            if entry is None or (snap_slot is not None and entry.slot <= snap_slot):
+                break
+            chain.append(entry)
+
+        if base is not None:
+            if base[0] == slot and not chain:
+                self.stats.cache_hits += 1
+                self._cache.move_to_end(base)
+                state, epochs_ctx = self._cache[base]
+                return state.copy(), epochs_ctx.copy()
+            state, epochs_ctx = self._cache[base]
+            state, epochs_ctx = state.copy(), epochs_ctx.copy()
+        else:
+            if path is None:
+                raise StateRegenError(f"no snapshot at or before slot {slot}")
+            state, epochs_ctx = read_snapshot(path)
+            self.stats.snapshot_loads += 1
+            if bytes(head_block_root(state)) != root:
+                raise StateRegenError(f"snapshot at slot {snap_slot} is not on the chain of {head_root.hex()}")
+
+        start = time.perf_counter()
+        for entry in reversed(chain):
+            # The blocks come from our own store, they were validated on import.
+            state_transition(epochs_ctx, state, self.store.read_block(entry), validate_result=False)
+            self.stats.replayed_blocks += 1
+        if state.slot < slot:
+            process_slots(epochs_ctx, state, slot)
+        self.stats.replay_time += time.perf_counter() - start
+
+        self._cache[(slot, block_root)] = (state, epochs_ctx)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return state.copy(), epochs_ctx.copy()
+
+    def get_state_at_epoch(self, epoch: Epoch, head_root: Optional[Root] = None) -> Tuple[BeaconState, EpochsContext]:
+        return self.get_state(compute_start_slot_at_epoch(epoch), head_root)
+
+
+def build_snapshots(regen: StateRegen, epochs_ctx: EpochsContext, state: BeaconState,
+                    head_root: Optional[Root] = None) -> int:
+    """
+    Replay the stored blocks of the chain of ``head_root`` (default: see StateRegen.default_head) after ``state``,
+    and snapshot it on the interval epochs. Modifies ``state``.
+    Empty slots at the start of an interval epoch are processed, so the snapshot is at the epoch start.
+    Returns the number of written snapshots.
+    """
+    if head_root is None:
+        if len(regen.store) == 0:
+            return 0
+        head_root = regen.default_head()
+    written = 0
+    interval_slots = regen.snapshot_epochs * SLOTS_PER_EPOCH
+    for entry in regen.chain(bytes(head_root), bytes(head_block_root(state))):
+        signed_block = regen.store.read_block(entry)
+        block_slot = signed_block.message.slot
+        # Interval epoch starts between the current state and the block
+        next_snapshot_slot = ((state.slot // interval_slots) + 1) * interval_slots
+        while next_snapshot_slot < block_slot:
+            process_slots(epochs_ctx, state, Slot(next_snapshot_slot))
+            if regen.maybe_snapshot(epochs_ctx, state) is not None:
+                written += 1
+            next_snapshot_slot += interval_slots
+        state_transition(epochs_ctx, state, signed_block, validate_result=False)
+        if regen.maybe_snapshot(epochs_ctx, state) is not None:
+            written += 1
+    return written
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Regenerate historical states from sparse snapshots.")
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p_build = sub.add_parser('build', help="replay the block store from a snapshot, snapshotting every N epochs")
+    p_build.add_argument('anchor', help="snapshot (see snapshot.py) of the state to start from")
+    p_get = sub.add_parser('get', help="regenerate the state at a slot")
+    p_get.add_argument('slot', type=int)
+    p_get.add_argument('--out', help="write the state as a snapshot to this file")
+    for p in (p_build, p_get):
+        p.add_argument('--blocks', default='blocks', help="block store directory")
+        p.add_argument('--snapshots', default='snapshots', help="snapshot directory")
+        p.add_argument('--snapshot-epochs', type=int, default=DEFAULT_SNAPSHOT_EPOCHS,
+                       help="epochs between snapshots: larger saves disk, smaller makes lookups faster")
+        p.add_argument('--head', type=bytes.fromhex, default=None,
+                       help="root (hex) of the head block of the chain, default: the block of the highest slot")
+    args = parser.parse_args(args)
+
+    with BlockStore(args.blocks) as store:
+        regen = StateRegen(store, args.snapshots, snapshot_epochs=args.snapshot_epochs)
+        if args.cmd == 'build':
+            state, epochs_ctx = read_snapshot(args.anchor)
+            regen.add_snapshot(epochs_ctx, state)
+            written = build_snapshots(regen, epochs_ctx, state, args.head)
+            print(f"wrote {written} snapshots, {len(regen.snapshots)} in {args.snapshots}")
+        else:
+            start = time.perf_counter()
+            state, epochs_ctx = regen.get_state(Slot(args.slot), args.head)
+            print(f"state at slot {state.slot}: {state.hash_tree_root().hex()} "
+                  f"in {time.perf_counter() - start:.2f}s, {regen.stats.to_dict()}")
+            if args.out:
+                write_snapshot(args.out, state, epochs_ctx)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
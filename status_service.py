@@ -0,0 +1,97 @@
+import io
+from typing import Optional
+
+from fastspec import BeaconState, Bytes32, Epoch, Root, Slot, Version, GENESIS_FORK_VERSION
+from messages import Status
+from reqresp_codec import RESULT_SUCCESS, encode_response_chunk
+
+
+class StatusService(object):
+    """
+    Our Status, with its encodings computed once. They only change when the head or finalized checkpoint does,
+    so serving a status request is a lookup of pre-encoded bytes:
+
+        status = StatusService.from_state_file('genesis.ssz')
+        await morty.rpc.status.resp.chunk.raw(req_id, status.hex, done=True)
+        status.update_head(block_root, slot)
+    """
+    fork_version: Version
+    genesis_root: Root
+    finalized_root: Root
+    finalized_epoch: Epoch
+    head_root: Root
+    head_slot: Slot
+
+    def __init__(self, genesis_root: Root, fork_version: Version = GENESIS_FORK_VERSION):
+        self.fork_version = fork_version
+        self.genesis_root = genesis_root
+        self.finalized_root = genesis_root
+        self.finalized_epoch = Epoch(0)
+        self.head_root = genesis_root
+        self.head_slot = Slot(0)
+        self._status: Optional[Status] = None
+        self._ssz: Optional[bytes] = None
+        self._hex: Optional[str] = None
+        self._chunk: Optional[bytes] = None
+        self.invalidations = 0
+
+    @classmethod
+    def from_state(cls, genesis_state) -> "StatusService":
+        return cls(Root(genesis_state.hash_tree_root()), Version(genesis_state.fork.current_version))
+
+    @classmethod
+    def from_state_file(cls, path: str, state_type=BeaconState) -> "StatusService":
+        # state_type: the BeaconState type the file is encoded with, e.g. the eth2spec one for genesis.ssz
+        with io.open(path, 'rb') as f:
+            return cls.from_state(state_type.decode_bytes(f.read()))
+
+    def _invalidate(self):
+        self._status = None
+        self._ssz = None
+        self._hex = None
+        self._chunk = None
+        self.invalidations += 1
+
+    def update_head(self, head_root: Bytes32, head_slot: Slot):
+        if head_root != self.head_root or head_slot != self.head_slot:
+            self.head_root = Root(head_root)
+            self.head_slot = Slot(head_slot)
+            self._invalidate()
+
+    def update_finalized(self, finalized_root: Bytes32, finalized_epoch: Epoch):
+        if finalized_root != self.finalized_root or finalized_epoch != self.finalized_epoch:
+            self.finalized_root = Root(finalized_root)
+            self.finalized_epoch = Epoch(finalized_epoch)
+            self._invalidate()
+
+    @property
+    def status(self) -> Status:
+        if self._status is None:
+            self._status = Status(
+                version=self.fork_version,
+                finalized_root=self.finalized_root,
+                finalized_epoch=self.finalized_epoch,
+                head_root=self.head_root,
+                head_slot=self.head_slot,
+            )
+        return self._status
+
+    @property
+    def ssz(self) -> bytes:
+        if self._ssz is None:
+            self._ssz = self.status.encode_bytes()
+        return self._ssz
+
+    @property
+    def hex(self) -> str:
+        # Payload for Rumor, e.g. resp.chunk.raw and req.raw
+        if self._hex is None:
+            self._hex = self.ssz.hex()
+        return self._hex
+
+    @property
+    def response_chunk(self) -> bytes:
+        # Complete ssz_snappy success chunk, for the in-process codec
+        if self._chunk is None:
+            self._chunk = encode_response_chunk(RESULT_SUCCESS, self.ssz)
+        return self._chunk
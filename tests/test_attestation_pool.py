@@ -0,0 +1,114 @@
+import pytest
+
+from attestation_pool import AttestationPool, bits_to_int, int_to_bits
+from bench import make_synthetic_state
+from fastspec import (
+    Attestation, AttestationData, Checkpoint, EpochsContext, PendingAttestation,
+    compute_epoch_at_slot, process_attestation,
+)
+
+ATT_SLOT = 150
+
+
+@pytest.fixture(scope='module')
+def head():
+    state = make_synthetic_state(2048)
+    # No attestations of the current epoch in the state yet.
+    state.current_epoch_attestations = state.current_epoch_attestations.__class__()
+    epochs_ctx = EpochsContext()
+    epochs_ctx.load_state(state)
+    return state, epochs_ctx
+
+
+def _bits(*ranges) -> int:
+    value = 0
+    for start, end in ranges:
+        value |= ((1 << (end - start)) - 1) << start
+    return value
+
+
+def _data(state, block_root: int, slot: int = ATT_SLOT, source=None) -> AttestationData:
+    return AttestationData(
+        slot=slot, index=0, beacon_block_root=bytes([block_root]) * 32,
+        source=state.current_justified_checkpoint if source is None else source,
+        target=Checkpoint(epoch=compute_epoch_at_slot(slot)),
+    )
+
+
+def _attestation(data: AttestationData, bits: int, length: int = 64) -> Attestation:
+    return Attestation(aggregation_bits=int_to_bits(bits, length), data=data)
+
+
+def _coverage(attestations):
+    return [bits_to_int(a.aggregation_bits)[0] for a in attestations]
+
+
+def test_bits_round_trip():
+    for bits, length in ((0, 0), (0, 64), (_bits((0, 3), (60, 64)), 64), (1 << 2047, 2048)):
+        assert bits_to_int(int_to_bits(bits, length)) == (bits, length)
+
+
+def test_select_max_coverage(head):
+    state, epochs_ctx = head
+    a, b, c = _bits((0, 32)), _bits((16, 40)), _bits((32, 64))
+    pool = AttestationPool()
+    for i, bits in enumerate((a, b, c)):
+        assert pool.add(_attestation(_data(state, i), bits))
+
+    # b adds nothing once a and c are in.
+    assert sorted(_coverage(pool.select(epochs_ctx, state))) == sorted([a, c])
+    assert len(pool.select(epochs_ctx, state, max_count=1)) == 1
+
+
+def test_select_skips_included(head):
+    state, epochs_ctx = head
+    a, b, c = _bits((0, 32)), _bits((16, 48)), _bits((32, 40))
+    pool = AttestationPool()
+    for i, bits in enumerate((a, b, c)):
+        pool.add(_attestation(_data(state, i), bits))
+
+    state = state.copy()
+    state.current_epoch_attestations.append(PendingAttestation(
+        data=_data(state, 9), aggregation_bits=int_to_bits(a, 64), inclusion_delay=1))
+    # c is covered by b, which adds 16 new validators.
+    assert _coverage(pool.select(epochs_ctx, state)) == [b]
+
+
+def test_add_merges_and_drops_subsets(head):
+    state, _ = head
+    pool = AttestationPool()
+    data = _data(state, 0)
+    assert pool.add(_attestation(data, _bits((0, 8))))
+    assert pool.add(_attestation(data, _bits((8, 16))))  # disjoint: merged
+    assert not pool.add(_attestation(data, _bits((2, 10))))  # covered by the merged aggregate
+    assert pool.add(_attestation(data, _bits((0, 32))))  # covers the merged aggregate, which is dropped
+    (entry,) = pool.entries.values()
+    assert [agg.bits for agg in entry.aggregates] == [_bits((0, 32))]
+    with pytest.raises(ValueError, match="aggregation bits of length"):
+        pool.add(_attestation(data, 1, length=32))
+
+
+def test_select_only_includable(head):
+    state, epochs_ctx = head
+    pool = AttestationPool()
+    good = _bits((0, 4))
+    pool.add(_attestation(_data(state, 0), good))
+    pool.add(_attestation(_data(state, 1, slot=state.slot), _bits((4, 8))))  # before the inclusion delay
+    pool.add(_attestation(_data(state, 2, source=Checkpoint(epoch=1)), _bits((8, 12))))  # wrong source
+    pool.add(_attestation(_data(state, 3), _bits((12, 16)), length=63))  # not the committee size
+
+    selected = pool.select(epochs_ctx, state)
+    assert _coverage(selected) == [good]
+    # And they pass the block checks.
+    state = state.copy()
+    for attestation in selected:
+        process_attestation(epochs_ctx, state, attestation, verify_signatures=False)
+
+
+def test_prune(head):
+    state, _ = head
+    pool = AttestationPool()
+    pool.add(_attestation(_data(state, 0, slot=100), 1))
+    pool.add(_attestation(_data(state, 1), 1))
+    assert pool.prune(ATT_SLOT) == 1
+    assert len(pool) == 1
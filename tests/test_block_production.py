@@ -0,0 +1,58 @@
+import pytest
+
+import fastspec
+from bench import make_block, make_synthetic_state
+from block_production import BlockProducer, prepare_slot, produce_block
+from fastspec import (
+    EpochsContext, SignedBeaconBlock, Slot,
+    hash_tree_root, process_slots, state_transition, SLOTS_PER_EPOCH,
+)
+
+
+@pytest.fixture(scope='module')
+def head():
+    state = make_synthetic_state(2048)
+    epochs_ctx = EpochsContext()
+    epochs_ctx.load_state(state)
+    return state, epochs_ctx
+
+
+@pytest.fixture
+def no_bls(monkeypatch):
+    # The synthetic blocks are not signed.
+    monkeypatch.setattr(fastspec.bls, 'bls_active', False)
+
+
+@pytest.mark.parametrize('slots_ahead', [1, 2])  # the first slot crosses the epoch boundary
+def test_state_root_matches_state_transition(head, no_bls, slots_ahead):
+    state, epochs_ctx = head
+    slot = Slot(state.slot + slots_ahead)
+    body = make_block(epochs_ctx, state, slot).message.body
+
+    prepared = prepare_slot(epochs_ctx, state, slot)
+    block, post_state, _ = produce_block(prepared, body)
+
+    expected_state = state.copy()
+    state_transition(epochs_ctx.copy(), expected_state, SignedBeaconBlock(message=block))
+    assert block.state_root == hash_tree_root(expected_state) == hash_tree_root(post_state)
+
+
+def test_prepared_slot_is_not_modified(head, no_bls):
+    state, epochs_ctx = head
+    slot = Slot(state.slot + 1)
+    body = make_block(epochs_ctx, state, slot).message.body
+    producer = BlockProducer()
+    prepared = producer.prepare(epochs_ctx, state, slot)
+    prepared_root = hash_tree_root(prepared.state)
+    shuffling = prepared.epochs_ctx.current_shuffling
+
+    block, post_state, post_ctx = producer.produce(prepared.parent_root, slot, body)
+    assert post_ctx is not prepared.epochs_ctx
+    # The caller advances its post-state and context past the next epoch boundary.
+    process_slots(post_ctx, post_state, Slot(slot + SLOTS_PER_EPOCH))
+    assert prepared.epochs_ctx.current_shuffling is shuffling
+    assert hash_tree_root(prepared.state) == prepared_root
+
+    again, _, _ = producer.produce(prepared.parent_root, slot, body)
+    assert again.state_root == block.state_root
+    assert producer.hits == 2 and producer.misses == 0
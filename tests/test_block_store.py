@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+from block_store import BlockStore, BlockStoreError, DATA_FILE, INDEX_FILE, MAX_REQUEST_BLOCKS, request_roots
+from fastspec import BeaconBlock, SignedBeaconBlock
+from messages import BlocksByRoot
+from reqresp_codec import RESULT_SUCCESS, decode_response_chunk
+
+
+def _block(slot: int, parent: bytes = b'\x00' * 32) -> SignedBeaconBlock:
+    block = SignedBeaconBlock(message=BeaconBlock(slot=slot, parent_root=parent))
+    block.message.body.graffiti = slot.to_bytes(32, 'little')
+    return block
+
+
+def _chain(*slots: int):
+    blocks = []
+    parent = b'\x00' * 32
+    for slot in slots:
+        blocks.append(_block(slot, parent))
+        parent = bytes(blocks[-1].message.hash_tree_root())
+    return blocks
+
+
+def _store_with(path, blocks, **kwargs) -> BlockStore:
+    store = BlockStore(str(path), **kwargs)
+    for signed_block in blocks:
+        store.append(signed_block)
+    return store
+
+
+def test_append_and_read(tmp_path):
+    blocks = _chain(1, 2, 4, 5)
+    with _store_with(tmp_path, blocks) as store:
+        assert store.append(blocks[0]) is store.get_slot(1)  # already stored
+        assert len(store) == 4
+    with BlockStore(str(tmp_path)) as store:
+        assert len(store) == 4
+        assert store.slot_bounds() == (1, 5)
+        assert [e.slot for e in store.range(1, 5)] == [1, 2, 4, 5]
+        assert [e.slot for e in store.range(2, 2, step=2)] == [2, 4]
+        for signed_block in blocks:
+            entry = store.get_root(signed_block.message.hash_tree_root())
+            assert store.read_block(entry) == signed_block
+            assert store.parent_root(entry) == signed_block.message.parent_root
+
+
+@pytest.mark.parametrize('store_frames', [False, True])
+def test_response_chunk(tmp_path, store_frames):
+    signed_block = _block(1)
+    with _store_with(tmp_path, [signed_block], store_frames=store_frames) as store:
+        entry = store.get_slot(1)
+        assert bool(entry.frames_length) == store_frames
+        for compression in (False, True):
+            chunk = store.response_chunk(entry, compression=compression)
+            result, ssz_bytes, end = decode_response_chunk(chunk, compression=compression)
+            assert (result, ssz_bytes, end) == (RESULT_SUCCESS, signed_block.encode_bytes(), len(chunk))
+
+
+def _file_size(path, name):
+    return os.path.getsize(os.path.join(str(path), name))
+
+
+def test_torn_record(tmp_path):
+    # The index row of the last block made it to disk, the end of its record did not.
+    blocks = _chain(1, 2, 3)
+    _store_with(tmp_path, blocks).close()
+    index_size = _file_size(tmp_path, INDEX_FILE)
+    with open(os.path.join(str(tmp_path), DATA_FILE), 'r+b') as f:
+        f.truncate(_file_size(tmp_path, DATA_FILE) - 1)
+
+    with BlockStore(str(tmp_path)) as store:
+        assert [e.slot for e in store.range(1, 3)] == [1, 2]
+        assert _file_size(tmp_path, DATA_FILE) == store.get_slot(2).end
+        assert _file_size(tmp_path, INDEX_FILE) < index_size
+        store.append(blocks[2])
+    with BlockStore(str(tmp_path)) as store:
+        assert [store.read_block(e) for e in store.range(1, 3)] == blocks
+
+
+def test_torn_index_row(tmp_path):
+    blocks = _chain(1, 2)
+    _store_with(tmp_path, blocks).close()
+    index_size = _file_size(tmp_path, INDEX_FILE)
+    data_size = _file_size(tmp_path, DATA_FILE)
+    # A partial index row, and the unindexed record of a third block.
+    with open(os.path.join(str(tmp_path), INDEX_FILE), 'ab') as f:
+        f.write(b'\x03' * 10)
+    with open(os.path.join(str(tmp_path), DATA_FILE), 'ab') as f:
+        f.write(_block(3).encode_bytes())
+
+    with BlockStore(str(tmp_path)) as store:
+        assert len(store) == 2
+        assert _file_size(tmp_path, INDEX_FILE) == index_size
+        assert _file_size(tmp_path, DATA_FILE) == data_size
+        store.append(_block(3))
+    with BlockStore(str(tmp_path)) as store:
+        assert [e.slot for e in store.range(1, 3)] == [1, 2, 3]
+
+
+def test_request_roots():
+    roots = [bytes([i]) * 32 for i in range(3)]
+    assert request_roots(BlocksByRoot(*roots).encode_bytes()) == roots
+    assert request_roots(b'') == []
+    with pytest.raises(ValueError, match="invalid BlocksByRoot request length"):
+        request_roots(b'\x00' * 33)
+    with pytest.raises(ValueError, match="exceeds"):
+        request_roots(b'\x00' * 32 * (MAX_REQUEST_BLOCKS + 1))
+
+
+def test_lookup_roots(tmp_path):
+    blocks = _chain(1, 2, 3, 4)
+    roots = [bytes(signed_block.message.hash_tree_root()) for signed_block in blocks]
+    unknown = b'\xff' * 32
+    with _store_with(tmp_path, blocks) as store:
+        # Request order, not file order, and unknown roots are skipped.
+        entries = store.lookup_roots([roots[3], unknown, roots[0], roots[2]])
+        assert [e.slot for e in entries] == [4, 1, 3]
+        assert [store.read_block(e) for e in entries] == [blocks[3], blocks[0], blocks[2]]
+        assert store.lookup_roots([unknown]) == []
+
+
+def test_bad_index(tmp_path):
+    with open(os.path.join(str(tmp_path), INDEX_FILE), 'wb') as f:
+        f.write(b'NOTINDEX' + b'\x00' * 8)
+    with pytest.raises(BlockStoreError, match="bad magic"):
+        BlockStore(str(tmp_path))
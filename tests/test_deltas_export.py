@@ -0,0 +1,84 @@
+import random
+
+import pytest
+
+from bench import make_synthetic_state
+from deltas_export import DeltasError, DeltasExport, DeltasFile, deltas_path, write_deltas
+from fastspec import AttestationDeltasDetail, EpochsContext, Epoch, Slot, process_slots, SLOTS_PER_EPOCH
+
+REWARDS = ('source_reward', 'target_reward', 'head_reward', 'inclusion_reward', 'proposer_reward')
+PENALTIES = ('source_penalty', 'target_penalty', 'head_penalty', 'inactivity_penalty')
+
+
+@pytest.fixture
+def detail():
+    rng = random.Random(4)
+    detail = AttestationDeltasDetail(Epoch(7), 100)
+    for values in detail.columns().values():
+        for i in range(len(values)):
+            values[i] = rng.randrange(2**64)
+    detail.inactivity_penalty[0] = 2**64 - 1
+    return detail
+
+
+def test_round_trip(tmp_path, detail):
+    path = str(tmp_path / 'deltas.bin')
+    write_deltas(path, detail)
+    with DeltasFile(path) as deltas:
+        assert (deltas.epoch, deltas.validator_count) == (7, 100)
+        assert deltas.names == list(AttestationDeltasDetail.COLUMNS)
+        for name, values in detail.columns().items():
+            assert list(deltas.column(name, verify_checksum=True)) == list(values)
+        assert deltas.validator(0) == {name: values[0] for name, values in detail.columns().items()}
+        with pytest.raises(DeltasError, match="no column"):
+            deltas.column('nope')
+
+
+def test_checksum_mismatch(tmp_path, detail):
+    path = str(tmp_path / 'deltas.bin')
+    write_deltas(path, detail)
+    with open(path, 'r+b') as f:
+        f.seek(-1, 2)  # last byte of the last column
+        last = f.read(1)
+        f.seek(-1, 2)
+        f.write(bytes((last[0] ^ 1,)))
+    with DeltasFile(path) as deltas:
+        last_column = deltas.names[-1]
+        deltas.column(last_column)
+        with pytest.raises(DeltasError, match="checksum mismatch"):
+            deltas.column(last_column, verify_checksum=True)
+
+
+def test_invalid_files(tmp_path, detail):
+    path = str(tmp_path / 'deltas.bin')
+    with open(path, 'wb') as f:
+        f.write(b'NOTDELTA' + bytes(56))
+    with pytest.raises(DeltasError, match="bad magic"):
+        DeltasFile(path)
+
+    write_deltas(path, detail)
+    with open(path, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 8)
+    with pytest.raises(DeltasError, match="truncated"):
+        DeltasFile(path)
+
+
+def test_export_matches_balance_changes(tmp_path):
+    state = make_synthetic_state(2048)
+    epochs_ctx = EpochsContext()
+    epochs_ctx.load_state(state)
+    pre_balances = list(state.balances)
+    export = DeltasExport(str(tmp_path))
+    next_epoch_slot = Slot((state.slot // SLOTS_PER_EPOCH + 1) * SLOTS_PER_EPOCH)
+    process_slots(epochs_ctx, state, next_epoch_slot, export)
+
+    prev_epoch = next_epoch_slot // SLOTS_PER_EPOCH - 2
+    assert export.written == [deltas_path(str(tmp_path), prev_epoch)]
+    with DeltasFile(export.written[0]) as deltas:
+        assert (deltas.epoch, deltas.validator_count) == (prev_epoch, len(pre_balances))
+        rewards = [deltas.column(name) for name in REWARDS]
+        penalties = [deltas.column(name) for name in PENALTIES]
+        assert all(any(column) for column in rewards[:3])
+        for i, (pre, post) in enumerate(zip(pre_balances, state.balances)):
+            balance = pre + sum(column[i] for column in rewards)
+            assert post == max(0, balance - sum(column[i] for column in penalties))
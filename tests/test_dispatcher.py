@@ -0,0 +1,61 @@
+import pytest
+import trio
+
+from dispatcher import RequestDispatcher
+
+
+class _Resp(object):
+    def __init__(self):
+        self.errors = []
+
+    async def server_error(self, req_id, message):
+        self.errors.append((req_id, message))
+
+
+class _Rpc(object):
+    def __init__(self):
+        self.resp = _Resp()
+
+
+def _request(req_id, peer_id):
+    return {'req_id': req_id, 'from': peer_id, 'protocol': '/eth2/beacon_chain/req/status/1/ssz',
+            'chunk': {'data': ''}}
+
+
+def test_rate_limit_per_peer():
+    rpc = _Rpc()
+    handled = []
+
+    async def handler(req):
+        handled.append(req['req_id'])
+
+    async def main():
+        async with trio.open_nursery() as nursery:
+            # Practically no refill, so every peer gets exactly its burst.
+            dispatcher = RequestDispatcher(nursery, peer_rate=1e-9, peer_burst=2)
+            for i in range(3):
+                await dispatcher.dispatch(rpc, _request(f'a{i}', 'peer-a'), handler)
+            await dispatcher.dispatch(rpc, _request('b0', 'peer-b'), handler)
+        return dispatcher.stats
+
+    stats = trio.run(main)
+    assert sorted(handled) == ['a0', 'a1', 'b0']
+    assert rpc.resp.errors == [('a2', "rate limited")]
+    assert (stats.accepted, stats.rate_limited, stats.completed) == (3, 1, 3)
+
+
+def test_request_without_peer():
+    rpc = _Rpc()
+
+    async def handler(req):
+        pass
+
+    async def main():
+        async with trio.open_nursery() as nursery:
+            dispatcher = RequestDispatcher(nursery)
+            req = _request('r0', 'peer-a')
+            del req['from']
+            with pytest.raises(ValueError, match="no peer"):
+                await dispatcher.dispatch(rpc, req, handler)
+
+    trio.run(main)
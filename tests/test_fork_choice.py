@@ -0,0 +1,92 @@
+import pytest
+
+from fastspec import BeaconBlock, BeaconState, Checkpoint, Root, Slot
+from fork_choice import ForkChoice, ForkChoiceError
+
+ANCHOR = Root(b'\x01' * 32)
+
+
+def _root(n: int) -> Root:
+    return Root(bytes([n]) * 32)
+
+
+def _fork_choice(balances=(10, 10, 10)) -> ForkChoice:
+    checkpoint = Checkpoint(epoch=0, root=ANCHOR)
+    return ForkChoice(ANCHOR, Slot(0), checkpoint, checkpoint, balances)
+
+
+def _import(fc: ForkChoice, slot: int, root: Root, parent_root: Root):
+    fc.on_block(BeaconBlock(slot=slot, parent_root=parent_root), root, BeaconState())
+
+
+def test_head_follows_weight():
+    fc = _fork_choice()
+    assert fc.get_head() == ANCHOR
+    _import(fc, 1, _root(2), ANCHOR)
+    _import(fc, 1, _root(3), ANCHOR)
+    _import(fc, 2, _root(4), _root(2))
+    # The head is the best descendant: votes for a child count for its ancestors.
+    fc.process_votes([0], _root(4), 1)
+    fc.process_votes([1, 2], _root(3), 1)
+    assert fc.get_head() == _root(3)
+    # Only a vote of a later target epoch replaces the previous one.
+    fc.process_votes([1], _root(4), 1)
+    assert fc.get_head() == _root(3)
+    fc.process_votes([1], _root(4), 2)
+    assert fc.get_head() == _root(4)
+    assert fc.proto_array.nodes[fc.proto_array.indices[_root(2)]].weight == 20
+
+
+def test_tie_breaks_on_root():
+    fc = _fork_choice()
+    _import(fc, 1, _root(2), ANCHOR)
+    _import(fc, 1, _root(3), ANCHOR)
+    assert fc.get_head() == _root(3)
+    fc.process_votes([0], _root(2), 1)
+    assert fc.get_head() == _root(2)
+
+
+def test_vote_for_unknown_block():
+    fc = _fork_choice()
+    _import(fc, 1, _root(2), ANCHOR)
+    # The vote arrives before its block: it carries no weight yet.
+    fc.process_votes([0, 1], _root(3), 1)
+    assert fc.get_head() == _root(2)
+    # Counted once the block is imported.
+    _import(fc, 1, _root(3), ANCHOR)
+    assert fc.get_head() == _root(3)
+    assert fc.proto_array.nodes[fc.proto_array.indices[_root(3)]].weight == 20
+    # And taken off again when the vote changes, without going negative.
+    fc.process_votes([0, 1], _root(2), 2)
+    assert fc.get_head() == _root(2)
+    assert fc.proto_array.nodes[fc.proto_array.indices[_root(3)]].weight == 0
+    assert fc.proto_array.nodes[fc.proto_array.indices[_root(2)]].weight == 20
+
+
+def test_vote_for_unknown_block_changed_before_import():
+    fc = _fork_choice()
+    fc.process_votes([0], _root(3), 1)
+    assert fc.get_head() == ANCHOR
+    _import(fc, 1, _root(2), ANCHOR)
+    fc.process_votes([0], _root(2), 2)
+    _import(fc, 1, _root(3), ANCHOR)
+    assert fc.get_head() == _root(2)
+    assert fc.proto_array.nodes[fc.proto_array.indices[_root(3)]].weight == 0
+
+
+def test_balance_change_moves_weight():
+    fc = _fork_choice()
+    _import(fc, 1, _root(2), ANCHOR)
+    _import(fc, 1, _root(3), ANCHOR)
+    fc.process_votes([0], _root(2), 1)
+    fc.process_votes([1], _root(3), 1)
+    assert fc.get_head() == _root(3)
+    fc.balances = [30, 10, 10]
+    assert fc.get_head() == _root(2)
+    assert fc.proto_array.nodes[fc.proto_array.indices[_root(2)]].weight == 30
+
+
+def test_unknown_parent():
+    fc = _fork_choice()
+    with pytest.raises(ForkChoiceError):
+        _import(fc, 1, _root(3), _root(2))
@@ -0,0 +1,84 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from bench import BENCH_EPOCH, make_synthetic_state
+from fastspec import (
+    EpochsContext, EpochProcess, FlatValidator, Epoch, FAR_FUTURE_EPOCH, EJECTION_BALANCE,
+    EPOCHS_PER_SLASHINGS_VECTOR, compute_activation_exit_epoch, prepare_epoch_process_state,
+)
+from parallel_epoch import ParallelEpochPreparer
+
+VALIDATOR_COUNT = 2048
+
+
+@pytest.fixture(scope='module')
+def state_and_ctx():
+    state = make_synthetic_state(VALIDATOR_COUNT)
+    epochs_ctx = EpochsContext()
+    epochs_ctx.load_state(state)
+    # Cover every branch of the per-validator loop. The context keeps the shuffling of the unmodified state,
+    # which matches the pending attestations.
+    for i in range(0, VALIDATOR_COUNT, 3):
+        v = state.validators[i]
+        kind = (i // 3) % 7
+        if kind == 0:
+            v.slashed = True
+            v.withdrawable_epoch = BENCH_EPOCH + EPOCHS_PER_SLASHINGS_VECTOR // 2
+        elif kind == 1:
+            v.slashed = True
+            v.withdrawable_epoch = BENCH_EPOCH + 3
+        elif kind == 2:
+            v.exit_epoch = compute_activation_exit_epoch(Epoch(BENCH_EPOCH))
+        elif kind == 3:
+            v.exit_epoch = BENCH_EPOCH - 1
+        elif kind == 4:
+            v.activation_epoch = FAR_FUTURE_EPOCH
+            v.activation_eligibility_epoch = i % 4
+        elif kind == 5:
+            v.activation_epoch = FAR_FUTURE_EPOCH
+            v.activation_eligibility_epoch = FAR_FUTURE_EPOCH
+        else:
+            v.effective_balance = EJECTION_BALANCE
+        state.validators[i] = v
+    # The end of the exit queue, below the churn limit.
+    for i in (1, 2):
+        state.validators[i].exit_epoch = compute_activation_exit_epoch(Epoch(BENCH_EPOCH)) + 1
+    return state, epochs_ctx
+
+
+def _summary(process: EpochProcess) -> dict:
+    out = dict(vars(process))
+    out['statuses'] = [
+        (s.flags, s.proposer_index, s.inclusion_delay, s.active,
+         tuple((type(getattr(s.validator, f)), getattr(s.validator, f)) for f in FlatValidator.__slots__))
+        for s in process.statuses
+    ]
+    for name in ('prev_epoch_stake', 'curr_epoch_stake'):
+        stake = getattr(process, name)
+        out[name] = tuple(getattr(stake, f) for f in stake.__slots__)
+    return out
+
+
+@pytest.mark.parametrize('shards', [1, 3, 8])
+def test_parallel_matches_serial(state_and_ctx, shards):
+    state, epochs_ctx = state_and_ctx
+    expected = _summary(prepare_epoch_process_state(epochs_ctx, state))
+    assert expected['indices_to_slash'] and expected['indices_to_eject'] and expected['indices_to_maybe_activate']
+    assert expected['indices_to_set_activation_eligibility'] and expected['exit_queue_end_churn']
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        preparer = ParallelEpochPreparer(executor, shards=shards, min_validators=0)
+        try:
+            got = _summary(preparer.prepare(epochs_ctx, state))
+        finally:
+            preparer.close()
+    assert got == expected
+
+
+def test_install_swaps_fastspec(state_and_ctx):
+    import fastspec
+    original = fastspec.prepare_epoch_process_state
+    with ParallelEpochPreparer(shards=2, min_validators=0) as preparer:
+        assert fastspec.prepare_epoch_process_state == preparer.prepare
+    assert fastspec.prepare_epoch_process_state is original
@@ -0,0 +1,106 @@
+import pytest
+
+from reqresp_codec import (
+    CodecError, STREAM_IDENTIFIER, RESULT_SUCCESS, RESULT_SERVER_ERROR, MAX_FRAME_DATA,
+    compress_frames, decompress_frames, decode_request, decode_response_chunk, decode_uvarint, encode_request,
+    encode_response_chunk, encode_uvarint, iter_response_chunks, masked_crc32c, _crc32c,
+)
+
+# Frames as written by the framing encoder of python-snappy (snappy.StreamCompressor).
+HELLO_FRAMES = STREAM_IDENTIFIER + b'\x01\x09\x00\x00\xbb\x1f\x1c\x19hello'
+HELLO_100_FRAMES = STREAM_IDENTIFIER + b'\x00\x24\x00\x00\xd6\x6c\xd8\x61\xf4\x03\x10hello' \
+    + b'\xfe\x05\x00' * 7 + b'\xba\x05\x00'
+
+
+@pytest.mark.parametrize('data, crc', [
+    (b'123456789', 0xe3069283),  # the CRC-32C check value
+    (b'\x00' * 32, 0x8a9136aa),  # RFC 3720, B.4
+    (b'\xff' * 32, 0x62a8ab43),
+])
+def test_crc32c(data, crc):
+    assert _crc32c(data) == crc
+
+
+def test_masked_crc32c():
+    assert masked_crc32c(b'hello') == int.from_bytes(HELLO_FRAMES[14:18], 'little')
+
+
+@pytest.mark.parametrize('n, encoded', [
+    (0, b'\x00'),
+    (1, b'\x01'),
+    (127, b'\x7f'),
+    (128, b'\x80\x01'),
+    (300, b'\xac\x02'),
+    (2**64 - 1, b'\xff' * 9 + b'\x01'),
+])
+def test_uvarint(n, encoded):
+    assert encode_uvarint(n) == encoded
+    assert decode_uvarint(encoded + b'\x99') == (n, len(encoded))
+
+
+def test_uvarint_errors():
+    with pytest.raises(CodecError, match="end of input"):
+        decode_uvarint(b'\x80\x80')
+    with pytest.raises(CodecError, match="overflows"):
+        decode_uvarint(b'\xff' * 10 + b'\x01')
+
+
+@pytest.mark.parametrize('data, frames', [
+    (b'hello', HELLO_FRAMES),  # does not compress, stored as an uncompressed frame
+    (b'hello' * 100, HELLO_100_FRAMES),
+], ids=['uncompressed', 'compressed'])
+def test_frames(data, frames):
+    assert compress_frames(data) == frames
+    assert decompress_frames(frames) == (data, len(frames))
+
+
+def test_frames_multiple():
+    data = bytes(range(256)) * (MAX_FRAME_DATA // 128)  # two full frames
+    frames = compress_frames(data)
+    assert decompress_frames(frames, 0, len(data)) == (data, len(frames))
+
+
+def test_frames_checksum_mismatch():
+    frames = bytearray(HELLO_FRAMES)
+    frames[-1] ^= 1
+    with pytest.raises(CodecError, match="checksum mismatch"):
+        decompress_frames(frames)
+    assert decompress_frames(frames, verify_checksums=False)[0] == b'helln'
+
+
+def test_frames_skippable():
+    padded = STREAM_IDENTIFIER + b'\xfe\x02\x00\x00\x00\x00' + HELLO_FRAMES[len(STREAM_IDENTIFIER):]
+    assert decompress_frames(padded)[0] == b'hello'
+    with pytest.raises(CodecError, match="unskippable"):
+        decompress_frames(STREAM_IDENTIFIER + b'\x02\x00\x00\x00')
+
+
+def test_request():
+    assert encode_request(b'hello') == b'\x05' + HELLO_FRAMES
+    assert encode_request(b'hello', compression=False) == b'\x05hello'
+    assert decode_request(b'\x05' + HELLO_FRAMES) == b'hello'
+    assert decode_request(b'\x05hello', compression=False) == b'hello'
+    # An empty payload still has the stream identifier.
+    assert encode_request(b'') == b'\x00' + STREAM_IDENTIFIER
+    assert decode_request(b'\x00' + STREAM_IDENTIFIER) == b''
+
+
+def test_request_errors():
+    with pytest.raises(CodecError, match="trailing"):
+        decode_request(b'\x05' + HELLO_FRAMES + b'\x00')
+    with pytest.raises(CodecError, match="expected 6 bytes"):
+        decode_request(b'\x06' + HELLO_FRAMES)
+    with pytest.raises(CodecError, match="exceeds max"):
+        decode_request(encode_uvarint(2**20 + 1) + HELLO_FRAMES)
+
+
+def test_response_chunks():
+    chunk = encode_response_chunk(RESULT_SUCCESS, b'hello')
+    assert chunk == b'\x00\x05' + HELLO_FRAMES
+    error = encode_response_chunk(RESULT_SERVER_ERROR, b'busy')
+    assert decode_response_chunk(chunk + error) == (RESULT_SUCCESS, b'hello', len(chunk))
+    assert list(iter_response_chunks(chunk + chunk + error)) == [
+        (RESULT_SUCCESS, b'hello'), (RESULT_SUCCESS, b'hello'), (RESULT_SERVER_ERROR, b'busy'),
+    ]
+    with pytest.raises(CodecError, match="expected result byte"):
+        decode_response_chunk(chunk, len(chunk))
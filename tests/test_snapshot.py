@@ -0,0 +1,126 @@
+import pytest
+
+from bench import make_synthetic_state
+from fastspec import BeaconState, EpochsContext, shuffling_registry
+from snapshot import (
+    Snapshot, SnapshotError, read_snapshot, write_snapshot, _collect_tree_roots, _seed_tree_roots,
+    SECTION_STATE, DEFAULT_TREE_ROOTS_DEPTH,
+)
+
+
+@pytest.fixture(scope='module')
+def head():
+    state = make_synthetic_state(2048)
+    epochs_ctx = EpochsContext()
+    epochs_ctx.load_state(state)
+    return state, epochs_ctx
+
+
+@pytest.fixture
+def snapshot_path(head, tmp_path):
+    state, epochs_ctx = head
+    path = str(tmp_path / 'head.snap')
+    write_snapshot(path, state, epochs_ctx)
+    return path
+
+
+@pytest.fixture
+def cleared_registry(head):
+    # Restores new shuffling objects, to compare them with the live ones. The live ones are registered again after.
+    shuffling_registry.clear()
+    yield
+    state, epochs_ctx = head
+    shuffling_registry.clear()
+    for shuffling in (epochs_ctx.previous_shuffling, epochs_ctx.current_shuffling, epochs_ctx.next_shuffling):
+        shuffling_registry.register(state, shuffling)
+
+
+def _flip_byte(path, offset):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        b = f.read(1)
+        f.seek(offset)
+        f.write(bytes((b[0] ^ 0xff,)))
+
+
+def _state_offset(path):
+    with Snapshot(path) as snap:
+        return snap._sections[SECTION_STATE][0]
+
+
+def test_round_trip(head, snapshot_path, cleared_registry):
+    state, epochs_ctx = head
+    restored_state, restored_ctx = read_snapshot(snapshot_path)
+    assert restored_state.encode_bytes() == state.encode_bytes()
+    assert restored_state.hash_tree_root() == state.hash_tree_root()
+    assert restored_ctx.index2pubkey == epochs_ctx.index2pubkey
+    assert restored_ctx.pubkey2index == epochs_ctx.pubkey2index
+    assert restored_ctx.proposers == epochs_ctx.proposers
+    for name in ('previous_shuffling', 'current_shuffling', 'next_shuffling'):
+        restored, live = getattr(restored_ctx, name), getattr(epochs_ctx, name)
+        assert restored is not live
+        assert restored.epoch == live.epoch
+        assert restored.active_indices == live.active_indices
+        assert restored.shuffling == live.shuffling
+        assert [list(map(list, c)) for c in restored.committees] == [list(map(list, c)) for c in live.committees]
+
+
+def test_seeded_tree_roots(head, snapshot_path):
+    state, _ = head
+    restored_state, _ = read_snapshot(snapshot_path)
+    # The seeded roots are the roots of a full re-hash of the state data.
+    rehashed = BeaconState.decode_bytes(state.encode_bytes())
+    rehashed.hash_tree_root()
+    assert _collect_tree_roots(restored_state.get_backing(), DEFAULT_TREE_ROOTS_DEPTH) == \
+        _collect_tree_roots(rehashed.get_backing(), DEFAULT_TREE_ROOTS_DEPTH)
+
+
+def test_seed_other_tree_shape(head):
+    state, _ = head
+    flags, roots = _collect_tree_roots(state.get_backing(), DEFAULT_TREE_ROOTS_DEPTH)
+    other = make_synthetic_state(1024)
+    with pytest.raises(SnapshotError, match="tree roots do not match"):
+        _seed_tree_roots(BeaconState.decode_bytes(other.encode_bytes()).get_backing(), flags, roots)
+
+
+def test_verify_root(head, snapshot_path):
+    state, _ = head
+    restored_state, _ = read_snapshot(snapshot_path, verify_root=True)
+    assert restored_state.hash_tree_root() == state.hash_tree_root()
+
+    # genesis_time is the first field of the state, the section checksum is skipped to get the change through.
+    _flip_byte(snapshot_path, _state_offset(snapshot_path))
+    with pytest.raises(SnapshotError, match="checksum mismatch"):
+        read_snapshot(snapshot_path)
+    with pytest.raises(SnapshotError, match="does not match the stored state root"):
+        read_snapshot(snapshot_path, verify_checksums=False, verify_root=True)
+
+
+def test_not_a_snapshot(tmp_path):
+    path = tmp_path / 'garbage.snap'
+    path.write_bytes(b'\x00' * 64)
+    with pytest.raises(SnapshotError, match="bad magic"):
+        read_snapshot(str(path))
+
+
+def test_shufflings_are_registered(head, snapshot_path):
+    _, epochs_ctx = head
+    _, restored_ctx = read_snapshot(snapshot_path)
+    assert restored_ctx.previous_shuffling is epochs_ctx.previous_shuffling
+    assert restored_ctx.current_shuffling is epochs_ctx.current_shuffling
+    assert restored_ctx.next_shuffling is epochs_ctx.next_shuffling
+
+
+def test_restored_shufflings_are_shared(head, snapshot_path):
+    state, _ = head
+    shuffling_registry.clear()
+    _, first_ctx = read_snapshot(snapshot_path)
+    _, second_ctx = read_snapshot(snapshot_path)
+    assert second_ctx.current_shuffling is first_ctx.current_shuffling
+    assert second_ctx.next_shuffling is first_ctx.next_shuffling
+
+    # A context loaded from the state later gets the restored shufflings from the registry.
+    live_ctx = EpochsContext()
+    live_ctx.load_state(state)
+    assert live_ctx.current_shuffling is first_ctx.current_shuffling
+    assert live_ctx.next_shuffling is first_ctx.next_shuffling
@@ -0,0 +1,109 @@
+import pytest
+
+import fastspec
+from bench import make_block, make_synthetic_state
+from block_production import prepare_slot, produce_block
+from block_store import BlockStore
+from epoch_precompute import head_block_root
+from fastspec import EpochsContext, SignedBeaconBlock, Slot, hash_tree_root
+from state_regen import StateRegen, StateRegenError, build_snapshots
+
+
+@pytest.fixture(scope='module')
+def anchor():
+    state = make_synthetic_state(2048)
+    epochs_ctx = EpochsContext()
+    epochs_ctx.load_state(state)
+    return state, epochs_ctx
+
+
+@pytest.fixture
+def no_bls(monkeypatch):
+    # The synthetic blocks are not signed.
+    monkeypatch.setattr(fastspec.bls, 'bls_active', False)
+
+
+def _child(parent, slot: int, graffiti: int = 0):
+    state, epochs_ctx = parent
+    body = make_block(epochs_ctx, state, Slot(slot)).message.body
+    body.graffiti = bytes([graffiti]) * 32
+    block, post_state, post_ctx = produce_block(prepare_slot(epochs_ctx, state, Slot(slot)), body)
+    return SignedBeaconBlock(message=block), (post_state, post_ctx)
+
+
+@pytest.fixture(scope='module')
+def forked(anchor):
+    # a1 (160) <- a2 (162) is the canonical chain, b1 (161) and b2 (162) are on an orphaned branch,
+    # written after a1 and a2: the slot index has b1 at 161 and b2 at 162.
+    bls_active = fastspec.bls.bls_active
+    fastspec.bls.bls_active = False
+    try:
+        a1, a1_post = _child(anchor, 160)
+        a2, a2_post = _child(a1_post, 162)
+        b1, b1_post = _child(a1_post, 161, graffiti=1)
+        b2, b2_post = _child(b1_post, 162, graffiti=2)
+    finally:
+        fastspec.bls.bls_active = bls_active
+    return [a1, a2, b1, b2], {'a1': a1_post, 'a2': a2_post, 'b1': b1_post, 'b2': b2_post}
+
+
+@pytest.fixture
+def regen(tmp_path, anchor, forked, no_bls):
+    blocks, _ = forked
+    store = BlockStore(str(tmp_path / 'blocks'))
+    for signed_block in blocks:
+        store.append(signed_block)
+    regen = StateRegen(store, str(tmp_path / 'snapshots'))
+    state, epochs_ctx = anchor
+    regen.add_snapshot(epochs_ctx, state)
+    yield regen
+    store.close()
+
+
+def _root(signed_block) -> bytes:
+    return bytes(hash_tree_root(signed_block.message))
+
+
+def test_replays_the_chain_of_the_head(regen, forked):
+    blocks, posts = forked
+    a1, a2, b1, b2 = blocks
+    assert regen.store.get_slot(Slot(162)).root == _root(b2)
+
+    state, _ = regen.get_state(Slot(162), _root(a2))
+    assert hash_tree_root(state) == hash_tree_root(posts['a2'][0])
+    # The orphaned block of the skipped slot 161 is not applied.
+    state, _ = regen.get_state(Slot(161), _root(a2))
+    assert head_block_root(state) == _root(a1)
+    assert state.slot == 161
+
+    state, _ = regen.get_state(Slot(162), _root(b2))
+    assert hash_tree_root(state) == hash_tree_root(posts['b2'][0])
+    # Default head: the block written last for the highest slot.
+    state, _ = regen.get_state(Slot(162))
+    assert hash_tree_root(state) == hash_tree_root(posts['b2'][0])
+
+
+def test_cache_is_per_chain(regen, forked):
+    blocks, posts = forked
+    a1, a2, b1, b2 = blocks
+    regen.get_state(Slot(161), _root(b2))
+    state, _ = regen.get_state(Slot(162), _root(a2))
+    assert hash_tree_root(state) == hash_tree_root(posts['a2'][0])
+    state, _ = regen.get_state(Slot(162), _root(b2))
+    assert hash_tree_root(state) == hash_tree_root(posts['b2'][0])
+    assert regen.stats.snapshot_loads == 2  # b2 at 162 continues from the cached b1 state at 161
+    regen.get_state(Slot(162), _root(a2))
+    assert regen.stats.cache_hits == 1
+
+
+def test_unknown_head(regen):
+    with pytest.raises(StateRegenError):
+        regen.get_state(Slot(162), b'\x11' * 32)
+
+
+def test_build_snapshots_follows_the_head(tmp_path, regen, anchor, forked):
+    blocks, posts = forked
+    state, epochs_ctx = anchor
+    state, epochs_ctx = state.copy(), epochs_ctx.copy()
+    build_snapshots(regen, epochs_ctx, state, _root(blocks[1]))
+    assert hash_tree_root(state) == hash_tree_root(posts['a2'][0])